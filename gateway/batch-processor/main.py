@@ -1,5 +1,6 @@
 import os
 import traceback
+import threading
 import firebase_admin
 from firebase_admin import credentials, firestore
 from vertexai.language_models import TextEmbeddingModel
@@ -22,11 +23,29 @@ SESSIONS_COLLECTION = 'sessions'
 ANALYSES_COLLECTION = 'analyses'
 VECTOR_CACHE_COLLECTION = 'vector_cache' # ベクトル化した結果を保存するコレクション
 
+EMBEDDING_MODEL_NAME = "text-multilingual-embedding-002"
+# ユーザーごとのテキストは長い(入力あたり最大2048トークン)ため、1リクエストのトークン上限(20,000)に収まる件数にする
+EMBEDDING_BATCH_SIZE = 5
+
+# from_pretrained はモデル情報の取得を伴うため、プロセスごとに一度だけロードして全ユーザーで使い回す
+_embedding_model = None
+_embedding_model_lock = threading.Lock()
+
+def _get_embedding_model():
+    """TextEmbeddingModel をプロセス内で一度だけロードして返す"""
+    global _embedding_model
+    if _embedding_model is None:
+        with _embedding_model_lock:
+            if _embedding_model is None:
+                _embedding_model = TextEmbeddingModel.from_pretrained(EMBEDDING_MODEL_NAME)
+                print(f"✅ Loaded embedding model: {EMBEDDING_MODEL_NAME}")
+    return _embedding_model
+
 @retry(wait=wait_exponential(multiplier=1, min=2, max=10), stop=stop_after_attempt(3))
 def get_embeddings(texts: list[str]) -> list[list[float]]:
-    """指定されたテキストのリストから埋め込みベクトルを取得する"""
+    """指定されたテキストのリストから埋め込みベクトルを取得する (1回のAPI呼び出し)"""
     if not texts: return []
-    model = TextEmbeddingModel.from_pretrained("text-multilingual-embedding-002")
+    model = _get_embedding_model()
     try:
         embeddings = model.get_embeddings(texts)
         return [embedding.values for embedding in embeddings]
@@ -35,6 +54,13 @@ def get_embeddings(texts: list[str]) -> list[list[float]]:
         traceback.print_exc()
         raise
 
+def get_embeddings_in_batches(texts: list[str], batch_size: int = EMBEDDING_BATCH_SIZE) -> list[list[float]]:
+    """テキストを batch_size 件ずつまとめてベクトル化し、入力と同じ順序で返す"""
+    all_embeddings = []
+    for i in range(0, len(texts), batch_size):
+        all_embeddings.extend(get_embeddings(texts[i:i + batch_size]))
+    return all_embeddings
+
 def _get_all_insights_for_user(user_id: str) -> str:
     """指定されたユーザーIDの全ての分析結果(insights)を1つのテキストに結合して返す"""
     if not db: return ""
@@ -66,6 +92,28 @@ def _get_all_insights_for_user(user_id: str) -> str:
     print(f"  - Found and combined insights for user: {user_id}")
     return "".join(all_insights)
 
+def _embed_and_save_user_vectors(pending: list[tuple[str, str]]):
+    """複数ユーザーのテキストを1回のAPI呼び出しでベクトル化し、Firestoreにまとめて保存する"""
+    user_ids = [user_id for user_id, _ in pending]
+    print(f"  - Generating embeddings for {len(pending)} users: {', '.join(user_ids)}")
+    vectors = get_embeddings_in_batches([text for _, text in pending])
+    if len(vectors) != len(pending):
+        print(f"  ⚠️ Embedding count mismatch ({len(vectors)} for {len(pending)} users). Skipping this batch.")
+        return
+
+    # 3. ベクトル化されたデータをFirestoreに保存する
+    batch = db.batch()
+    for (user_id, all_insights_text), vector in zip(pending, vectors):
+        vector_data = {
+            "user_id": user_id,
+            "embedding": vector,
+            "source_text_digest": all_insights_text[:500], # 確認用
+            "updated_at": firestore.SERVER_TIMESTAMP
+        }
+        batch.set(db.collection(VECTOR_CACHE_COLLECTION).document(user_id), vector_data)
+    batch.commit()
+    print(f"  ✅ Successfully generated and saved embeddings for users: {', '.join(user_ids)}")
+
 def process_all_users_insights(request):
     """
     全てのユーザーの分析結果を集計し、ベクトル化して保存するCloud Function
@@ -80,6 +128,8 @@ def process_all_users_insights(request):
 
 
     try:
+        # ベクトル化待ちの (user_id, テキスト)。EMBEDDING_BATCH_SIZE 件たまるごとにまとめて処理する
+        pending = []
         users_ref = db.collection(USER_COLLECTION).stream()
         for user in users_ref:
             user_id = user.id
@@ -88,24 +138,18 @@ def process_all_users_insights(request):
             # 1. ユーザーの全てのセッションから分析結果(insights)を収集する (ロジックを実装)
             all_insights_text = _get_all_insights_for_user(user_id)
 
-            # 2. 収集したテキストが空でなければ、ベクトル化を行う
+            # 2. 収集したテキストが空でなければ、ベクトル化の対象に追加する
             if all_insights_text:
-                print(f"  - Generating embedding for user {user_id}...")
-                vectors = get_embeddings([all_insights_text])
-                
-                # 3. ベクトル化されたデータをFirestoreに保存する
-                if vectors:
-                    vector_data = {
-                        "user_id": user_id,
-                        "embedding": vectors[0],
-                        "source_text_digest": all_insights_text[:500], # 確認用
-                        "updated_at": firestore.SERVER_TIMESTAMP
-                    }
-                    db.collection(VECTOR_CACHE_COLLECTION).document(user_id).set(vector_data)
-                    print(f"  ✅ Successfully generated and saved embedding for user {user_id}")
+                pending.append((user_id, all_insights_text))
+                if len(pending) >= EMBEDDING_BATCH_SIZE:
+                    _embed_and_save_user_vectors(pending)
+                    pending = []
             else:
                 print(f"  - No insights found for user {user_id}. Skipping.")
 
+        if pending:
+            _embed_and_save_user_vectors(pending)
+
     except Exception as e:
         print(f"❌ An unexpected error occurred in process_all_users_insights: {e}")
         traceback.print_exc()
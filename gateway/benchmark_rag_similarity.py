@@ -0,0 +1,67 @@
+"""
+RAG の関連チャンク選択 (_top_k_similar_chunks) と、以前の Python ループによる実装の速度を比較するマイクロベンチマーク。
+
+リポジトリのルートで実行する:
+    python -m gateway.benchmark_rag_similarity
+"""
+import time
+
+import numpy as np
+
+from gateway.main import _stack_embeddings, _top_k_similar_chunks
+
+DIM = 768  # text-multilingual-embedding-002 の次元数
+CHUNK_COUNTS = [50, 250, 5000]
+TOP_K = 3
+
+
+def legacy_top_k(query_embedding, embeddings, chunks, k=TOP_K):
+    """以前の実装: チャンクごとに np.array を作り、内積とノルムを計算して、タプルのリストをソートする"""
+    query_embedding = np.array(query_embedding)
+    similarities = []
+    for i, emb in enumerate(embeddings):
+        chunk_embedding = np.array(emb)
+        dot_product = np.dot(chunk_embedding, query_embedding)
+        norm_product = np.linalg.norm(chunk_embedding) * np.linalg.norm(query_embedding)
+        similarity = dot_product / norm_product if norm_product != 0 else 0.0
+        similarities.append((similarity, chunks[i]))
+    similarities.sort(key=lambda x: x[0], reverse=True)
+    return [chunk for sim, chunk in similarities[:k]]
+
+
+def best_of(fn, repeat):
+    """repeat 回実行したうちの最短時間 (ミリ秒)"""
+    best = float('inf')
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - started_at)
+    return best * 1000
+
+
+def main():
+    rng = np.random.default_rng(0)
+    # vectorized はリストからの行列化を含む時間、kernel は行列化済みの入力に対する採点と選択だけの時間
+    print(f"{'chunks':>7} {'legacy (ms)':>12} {'vectorized (ms)':>16} {'kernel (ms)':>12} {'speedup':>8} {'kernel speedup':>15}")
+    for count in CHUNK_COUNTS:
+        chunks = [f"chunk-{i}" for i in range(count)]
+        # 本番と同じく、キャッシュ由来の行列と新たに生成したベクトルのリストが混在する入力にする
+        cached = rng.standard_normal((count // 2, DIM)).astype(np.float32)
+        fresh = rng.standard_normal((count - count // 2, DIM)).tolist()
+        query = rng.standard_normal(DIM).tolist()
+        legacy_embeddings = cached.tolist() + fresh
+        repeat = 20 if count <= 250 else 5
+
+        assert legacy_top_k(query, legacy_embeddings, chunks) == \
+            _top_k_similar_chunks(query, _stack_embeddings([cached, fresh]), chunks, k=TOP_K)
+
+        legacy_ms = best_of(lambda: legacy_top_k(query, legacy_embeddings, chunks), repeat)
+        vectorized_ms = best_of(lambda: _top_k_similar_chunks(query, _stack_embeddings([cached, fresh]), chunks, k=TOP_K), repeat)
+        matrix = _stack_embeddings([cached, fresh])
+        kernel_ms = best_of(lambda: _top_k_similar_chunks(query, matrix, chunks, k=TOP_K), repeat)
+        print(f"{count:>7} {legacy_ms:>12.2f} {vectorized_ms:>16.2f} {kernel_ms:>12.2f} "
+              f"{legacy_ms / vectorized_ms:>7.1f}x {legacy_ms / kernel_ms:>14.1f}x")
+
+
+if __name__ == '__main__':
+    main()
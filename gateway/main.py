@@ -1,31 +1,133 @@
+import time
+_STARTUP_STARTED_AT = time.perf_counter()
+
 import firebase_admin
 from firebase_admin import credentials, firestore, auth, app_check
-from flask import Flask, request, jsonify, Blueprint, abort
+from flask import Flask, request, jsonify, Blueprint, abort, Response, stream_with_context, g, has_request_context
 from flask_cors import CORS
 
 import os
+import sys
 import json
+import copy
 import re
 import traceback
 import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
+import importlib
 import requests
+from requests.adapters import HTTPAdapter
 import urllib.parse
-from bs4 import BeautifulSoup
 import numpy as np
 import hashlib
 import uuid
 from datetime import datetime, timedelta, timezone
-from collections import Counter
+from collections import Counter, OrderedDict
 import textwrap
+import unicodedata
 
-from google.cloud import aiplatform
-from google.cloud import tasks_v2
 from tenacity import retry, stop_after_attempt, wait_exponential
-import vertexai
-from vertexai.generative_models import GenerativeModel, GenerationConfig
-from vertexai.language_models import TextEmbeddingModel
-from google.cloud import discoveryengine_v1 as discoveryengine
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+from google.api_core import exceptions as google_exceptions
+from google.protobuf import timestamp_pb2
+
+_EAGER_IMPORT_SECONDS = time.perf_counter() - _STARTUP_STARTED_AT
+
+
+# ===== 遅延インポート (Cold Start 対策) =====
+# Vertex AI / LangChain / Discovery Engine / BeautifulSoup などの重いSDKは、import だけで数秒かかる。
+# record_swipe などの多くのリクエストはこれらを使わないため、最初に使われたタイミングで import・初期化する。
+_lazy_init_lock = threading.RLock()
+_IMPORT_COSTS = {}  # モジュール名 -> import に要した秒数
+
+
+def _import_module_timed(module_name: str):
+    """モジュールを import し、初回の import コストを記録する"""
+    if module_name in sys.modules:
+        return sys.modules[module_name]
+    started_at = time.perf_counter()
+    module = importlib.import_module(module_name)
+    elapsed = time.perf_counter() - started_at
+    _IMPORT_COSTS[module_name] = elapsed
+    print(f"📦 Lazy-loaded {module_name} in {elapsed * 1000:.0f}ms")
+    return module
+
+
+class _LazyImport:
+    """
+    属性アクセスまたは呼び出しの時点で初めてモジュール(またはその属性)を import するプロキシ。
+    on_load が指定されていれば、初回ロード時に一度だけ実行する (vertexai.init など)。
+    """
+
+    def __init__(self, module_name: str, attr_name: str = None, on_load=None):
+        self._module_name = module_name
+        self._attr_name = attr_name
+        self._on_load = on_load
+        self._target = None
+
+    def _load(self):
+        if self._target is None:
+            with _lazy_init_lock:
+                if self._target is None:
+                    module = _import_module_timed(self._module_name)
+                    target = getattr(module, self._attr_name) if self._attr_name else module
+                    if self._on_load:
+                        self._on_load()
+                    self._target = target
+        return self._target
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self._load(), name)
+
+    def __call__(self, *args, **kwargs):
+        return self._load()(*args, **kwargs)
+
+    def __repr__(self):
+        name = f"{self._module_name}.{self._attr_name}" if self._attr_name else self._module_name
+        state = "loaded" if self._target is not None else "deferred"
+        return f"<lazy {name} ({state})>"
+
+
+_vertexai_initialized = False
+
+def _init_vertexai():
+    """Gemini / Embedding モデルを初めて使う直前に Vertex AI を初期化する"""
+    global _vertexai_initialized
+    if _vertexai_initialized:
+        return
+    with _lazy_init_lock:
+        if _vertexai_initialized:
+            return
+        try:
+            vertexai.init(project=project_id, location=gemini_region)
+            print(f"✅ Vertex AI initialized for project: {project_id}. Gemini region: {gemini_region}, Vector Search region: {vector_search_region}")
+        except Exception as e:
+            print(f"❌ Failed to initialize Vertex AI: {e}")
+            traceback.print_exc()
+        _vertexai_initialized = True
+
+
+vertexai = _LazyImport('vertexai')
+aiplatform = _LazyImport('google.cloud.aiplatform')
+tasks_v2 = _LazyImport('google.cloud.tasks_v2')
+discoveryengine = _LazyImport('google.cloud.discoveryengine_v1')
+GenerativeModel = _LazyImport('vertexai.generative_models', 'GenerativeModel', on_load=_init_vertexai)
+GenerationConfig = _LazyImport('vertexai.generative_models', 'GenerationConfig')
+TextEmbeddingModel = _LazyImport('vertexai.language_models', 'TextEmbeddingModel', on_load=_init_vertexai)
+BeautifulSoup = _LazyImport('bs4', 'BeautifulSoup')
+RecursiveCharacterTextSplitter = _LazyImport('langchain.text_splitter', 'RecursiveCharacterTextSplitter')
+
+_LAZY_MODULES = [vertexai, aiplatform, tasks_v2, discoveryengine, GenerativeModel, TextEmbeddingModel, BeautifulSoup, RecursiveCharacterTextSplitter]
+
+
+def _import_cost_report() -> dict:
+    """起動時 (eager) と遅延ロードされたモジュールの import コストをミリ秒単位で返す"""
+    return {
+        "eager_imports_ms": round(_EAGER_IMPORT_SECONDS * 1000, 1),
+        "lazy_imports_ms": {name: round(sec * 1000, 1) for name, sec in _IMPORT_COSTS.items()},
+        "deferred": [repr(m) for m in _LAZY_MODULES if m._target is None],
+    }
 
 
 # --- GCP & Firebase 初期化 ---
@@ -43,12 +145,12 @@ try:
     vector_search_region = os.getenv('GCP_VERTEX_AI_REGION', 'asia-northeast1')
     # Geminiモデルは米国中部リージョン (`us-central1`) を使用
     gemini_region = os.getenv('GCP_GEMINI_REGION', 'us-central1')
-    
-    vertexai.init(project=project_id, location=gemini_region)
-    print(f"✅ Vertex AI initialized for project: {project_id}. Gemini region: {gemini_region}, Vector Search region: {vector_search_region}")
+    # vertexai.init は Gemini / Embedding の初回利用時に _init_vertexai() で実行する
 
     # Cloud Tasks Client Initialization
+    # クライアント自体は最初のタスク作成時に _get_tasks_client() で生成する
     tasks_client = None
+    tasks_enabled = False
     GCP_TASK_QUEUE = None
     GCP_TASK_QUEUE_LOCATION = None
     GCP_TASK_SA_EMAIL = None
@@ -71,12 +173,8 @@ try:
         missing_vars = [key for key, value in required_vars.items() if not value]
 
         if not missing_vars:
-            try:
-                tasks_client = tasks_v2.CloudTasksClient()
-                print(f"✅ Cloud Tasks client initialized. Queue: {GCP_TASK_QUEUE} in {GCP_TASK_QUEUE_LOCATION}")
-            except Exception as e:
-                print(f"❌ Failed to initialize Cloud Tasks client, even though variables were set: {e}")
-                traceback.print_exc()
+            tasks_enabled = True
+            print(f"ℹ️ Cloud Tasks is configured. Queue: {GCP_TASK_QUEUE} in {GCP_TASK_QUEUE_LOCATION} (client is created on first use)")
         else:
             # This is the key log message for debugging
             print(f"⚠️ Cloud Tasks is disabled. Missing environment variables: {', '.join(missing_vars)}. Background tasks will not be created.")
@@ -153,6 +251,139 @@ def verify_app_check():
             return jsonify({"error": f"Invalid App Check token: {e}"}), 401
 
 
+# --- リクエスト単位のメモ化 ---
+class _RequestContext:
+    """1回のAPI呼び出しの間だけ、ユーザーのセッション・グラフ・推薦キャッシュの読み込み結果を保持する"""
+
+    def __init__(self):
+        self._values = {}
+        self.reads = 0
+        self.saved_reads = 0
+
+    def get_or_load(self, key, loader):
+        if key in self._values:
+            self.saved_reads += 1
+            return self._values[key]
+        self.reads += 1
+        value = loader()
+        self._values[key] = value
+        return value
+
+    def forget(self, key):
+        self._values.pop(key, None)
+
+def _request_context():
+    """現在のリクエストの _RequestContext を返す。リクエスト外 (バックグラウンドスレッド等) では None。"""
+    if not has_request_context():
+        return None
+    if 'request_context' not in g:
+        g.request_context = _RequestContext()
+    return g.request_context
+
+def _read_document_once(collection: str, doc_id: str):
+    """
+    collection/doc_id を読み込み、存在すれば dict を、なければ None を返す。
+    同じリクエスト内の2回目以降の読み込みは Firestore に問い合わせずに前回の結果を返す。
+    """
+    def load():
+        doc = db_firestore.collection(collection).document(doc_id).get()
+        return (doc.to_dict() or {}) if doc.exists else None
+
+    context = _request_context()
+    if context is None:
+        return load()
+    return context.get_or_load((collection, doc_id), load)
+
+def _forget_document_read(collection: str, doc_id: str):
+    """書き込んだドキュメントについて、リクエスト内に保持している古い読み込み結果を破棄する"""
+    context = _request_context()
+    if context is not None:
+        context.forget((collection, doc_id))
+
+# --- 条件付き GET (ETag) ---
+def _make_etag(*parts):
+    """キャッシュドキュメントの version や更新時刻から強い ETag の値を作る。材料が欠けている場合は None。"""
+    if any(part is None for part in parts):
+        return None
+    material = "|".join(part.isoformat() if isinstance(part, datetime) else str(part) for part in parts)
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()[:32]
+
+def _conditional_json(etag, build_payload, status: int = 200):
+    """
+    If-None-Match が etag と一致すれば本文なしの 304 を、そうでなければ build_payload() の JSON を ETag 付きで返す。
+    304 の場合は本文の組み立てと JSON シリアライズを行わない。
+    """
+    if etag and request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = jsonify(build_payload())
+        response.status_code = status
+    if etag:
+        response.set_etag(etag)
+        # ユーザーごとのデータなので共有キャッシュには置かせず、毎回再検証させる
+        response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+@api_bp.after_request
+def report_graph_cache_status(response):
+    # 'stale' の場合、クライアントは表示中のグラフがバックグラウンドで更新中であることを示せる
+    status = g.get('graph_cache_status')
+    if status:
+        response.headers['X-Graph-Cache'] = status
+    return response
+
+@api_bp.after_request
+def report_saved_reads(response):
+    context = g.get('request_context')
+    if context is not None:
+        response.headers['X-Firestore-Reads'] = str(context.reads)
+        response.headers['X-Firestore-Reads-Saved'] = str(context.saved_reads)
+        if context.saved_reads:
+            print(f"♻️ Request context saved {context.saved_reads} duplicate Firestore read(s) on {request.path}")
+    return response
+
+# --- プロセス内の統計の定期出力 ---
+# キャッシュのヒット率やタスクの集約数などのカウンターはインスタンスごとにメモリに持つため、
+# STATS_LOG_INTERVAL_SECONDS ごとに1行の JSON として標準出力に書き出し、Cloud Logging の jsonPayload として集計できるようにする。
+STATS_LOG_INTERVAL_SECONDS = float(os.getenv('STATS_LOG_INTERVAL_SECONDS', '300'))
+_stats_lock = threading.Lock()
+_stats_reporters = {}  # 名前 -> スナップショットを返す関数
+_stats_next_log_at = time.monotonic() + STATS_LOG_INTERVAL_SECONDS
+
+def _increment_stat(counter: Counter, key, amount: int = 1):
+    """gunicorn のスレッド間で共有するカウンターを加算する"""
+    with _stats_lock:
+        counter[key] += amount
+
+def _reports_stats(name: str):
+    """スナップショット関数を定期出力の対象に登録するデコレーター"""
+    def register(snapshot):
+        _stats_reporters[name] = snapshot
+        return snapshot
+    return register
+
+def _log_process_stats():
+    """登録されたすべての統計を1行の構造化ログとして出力する"""
+    stats = {}
+    for name, snapshot in _stats_reporters.items():
+        try:
+            stats[name] = snapshot()
+        except Exception as e:
+            stats[name] = {'error': str(e)}
+    print(json.dumps({'severity': 'INFO', 'message': 'process stats', 'process_stats': stats}, ensure_ascii=False, default=str))
+
+@api_bp.after_request
+def log_process_stats_periodically(response):
+    global _stats_next_log_at
+    now = time.monotonic()
+    with _stats_lock:
+        if now < _stats_next_log_at:
+            return response
+        _stats_next_log_at = now + STATS_LOG_INTERVAL_SECONDS
+    _log_process_stats()
+    return response
+
+
 # --- CORS設定 ---
 prod_origin = os.getenv('PROD_ORIGIN_URL')
 
@@ -179,10 +410,69 @@ def index():
 # ===== RAG Cache Settings =====
 RAG_CACHE_COLLECTION = 'rag_cache'
 RAG_CACHE_TTL_DAYS = 7 # Cache expires after 7 days
+# ベクトルの保存形式: 'float32' | 'float16' | 'int8' (行ごとのスケール付き)。768次元 x 50チャンクで float16 なら約75KB
+RAG_CACHE_VECTOR_ENCODING = os.getenv('RAG_CACHE_VECTOR_ENCODING', 'float16')
+
+# ===== RAG URL Processing Settings =====
+RAG_MAX_URLS = 5  # 1回の RAG で読み込む URL の上限
+RAG_URL_CONCURRENCY = int(os.getenv('RAG_URL_CONCURRENCY', '5'))
+RAG_URL_DEADLINE_SECONDS = float(os.getenv('RAG_URL_DEADLINE_SECONDS', '15'))     # 1つの URL の取得・分割・ベクトル化の期限
+RAG_FETCH_DEADLINE_SECONDS = float(os.getenv('RAG_FETCH_DEADLINE_SECONDS', '25'))  # 全 URL の読み込みを待つ期限
+RAG_SEARCH_TIMEOUT_SECONDS = float(os.getenv('RAG_SEARCH_TIMEOUT_SECONDS', '8'))    # 検索エンジンごとの応答を待つ期限
+
+# Firestore を使う永続キャッシュ層は Cloud Run 上でのみ既定で有効にする (ローカル/テストではプロセス内キャッシュのみ)
+PERSISTENT_CACHE_ENABLED = os.getenv('PERSISTENT_CACHE_ENABLED', 'true' if 'K_SERVICE' in os.environ else 'false').lower() == 'true'
+
+# ===== LLM Response Cache Settings =====
+LLM_CACHE_COLLECTION = 'llm_response_cache'
+LLM_CACHE_MAX_ENTRIES = int(os.getenv('LLM_CACHE_MAX_ENTRIES', '256'))
+# 呼び出し元ごとの TTL。ここに登録された呼び出し元の応答だけがキャッシュされる
+LLM_CACHE_TTLS = {
+    'initial_questions': timedelta(hours=24),  # 新規ユーザー向けの初期質問 (トピックのみに依存)
+    'topic_suggestions': timedelta(hours=12),  # 対話履歴が変わらない限り同じ入力になる
+    'book_keywords': timedelta(days=7),        # 書籍検索キーワードの抽出
+}
+
+# ===== Embedding Cache Settings =====
+# (モデル, 正規化したテキスト) のハッシュをキーに、ベクトルをプロセス内の LRU と Firestore に保持する
+EMBEDDING_CACHE_COLLECTION = 'embedding_cache'
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv('EMBEDDING_CACHE_MAX_ENTRIES', '4096'))
+EMBEDDING_CACHE_TTL = timedelta(days=30)
+# Firestore 層に保存するベクトルの形式 (_encode_vectors の encoding)。検索・類似度の精度を保つため既定は float32
+EMBEDDING_CACHE_VECTOR_ENCODING = os.getenv('EMBEDDING_CACHE_VECTOR_ENCODING', 'float32')
+
+FIRESTORE_BATCH_LIMIT = 500  # 1回のバッチ書き込み・get_all で扱うドキュメント数の上限
 
 # ★★★ 修正: セッションの最大ターン数を定義 ★★★
 MAX_TURNS = 5 # セッションの最大ターン数（初期ターンを含む）
 
+# ===== Gemini モデル設定 =====
+# モデル名はプロセス起動時に一度だけ解決し、各ヘルパーで共有する
+GEMINI_FLASH_NAME = os.getenv('GEMINI_FLASH_NAME', 'gemini-1.5-flash-preview-05-20')
+GEMINI_PRO_NAME = os.getenv('GEMINI_PRO_NAME', 'gemini-1.5-pro-preview-05-20')
+
+# (モデル名, 生成設定) -> GenerativeModel のプロセス全体で共有するレジストリ
+_generative_models = {}
+_generative_models_lock = threading.Lock()
+
+def _get_generative_model(model_name: str, generation_config: dict = None):
+    """
+    GenerativeModel をモデル名と生成設定の組ごとに一度だけ生成し、以降はそれを使い回す。
+    gunicorn のスレッド間で共有されるため、生成はロックで保護する。
+    """
+    config_key = json.dumps(generation_config, sort_keys=True, ensure_ascii=False) if generation_config else None
+    key = (model_name, config_key)
+    model = _generative_models.get(key)
+    if model is None:
+        with _generative_models_lock:
+            model = _generative_models.get(key)
+            if model is None:
+                config = GenerationConfig(**generation_config) if generation_config else None
+                model = GenerativeModel(model_name, generation_config=config)
+                _generative_models[key] = model
+                print(f"✅ Registered Gemini model: {model_name} (config: {config_key or 'default'})")
+    return model
+
 # ===== JSONスキーマ定義 =====
 QUESTIONS_SCHEMA = {"type": "object","properties": {"questions": {"type": "array","items": {"type": "object","properties": {"question_text": {"type": "string"}},"required": ["question_text"]}}},"required": ["questions"]}
 SUMMARY_SCHEMA = {"type": "object","properties": {"title": {"type": "string", "description": "このセッション全体を要約する15文字程度の短いタイトル"},"insights": {"type": "string", "description": "指定されたMarkdown形式でのユーザーの心理分析レポート"}},"required": ["title", "insights"]}
@@ -277,6 +567,21 @@ GRAPH_ANALYSIS_PROMPT_TEMPLATE = """
 # セッション記録
 """
 
+SESSION_GRAPH_PROMPT_TEMPLATE = """
+あなたはデータサイエンティストです。ユーザーの「新しいセッション記録」だけを分析し、既存の思考グラフに追加するためのグラフデータにしてください。
+# グラフのルール
+1. 構造: グラフは必ず「topic -> issue -> (keywordまたはemotion)」という厳密な階層構造に従ってください。
+2. ノード:
++ idは日本語の短い単語にしてください。
++ 既存のグラフに同じ意味のノードがある場合は、必ずその id をそのまま使ってください。
++ ノード数は8個以内にしてください。
++ size は、このセッションでの重要度を 1〜10 で表してください。
+# 既存のグラフのノード
+{existing_nodes}
+# 新しいセッション記録
+{session_text}
+"""
+
 CHAT_PROMPT_TEMPLATE = """
 あなたは、ユーザーの心理分析の専門家であり、共感力と洞察力に優れたカウンセラー「ココロの分析官」です。
 ユーザーは、自身の思考を可視化したグラフを見ながら、あなたと対話しようとしています
@@ -318,6 +623,202 @@ PROACTIVE_KEYWORDS = [
     "ストレス", "プレッシャー", "不安"
 ]
 
+# ===== HTTP 接続プール =====
+# Ollama / Google Books / ページのスクレイピングは、宛先ごとの requests.Session を gunicorn のスレッド間で共有し、
+# Keep-Alive で TCP+TLS ハンドシェイクを使い回す。
+# pool_connections: 保持するホスト単位のプール数, pool_maxsize: 1ホストあたりの最大コネクション数
+HTTP_DESTINATIONS = {
+    'ollama': {
+        'timeout': float(os.getenv('OLLAMA_TIMEOUT_SECONDS', '60')),
+        'pool_connections': 1,
+        'pool_maxsize': int(os.getenv('OLLAMA_POOL_MAXSIZE', '8')),
+    },
+    'google_books': {
+        'timeout': float(os.getenv('GOOGLE_BOOKS_TIMEOUT_SECONDS', '10')),
+        'pool_connections': 1,
+        'pool_maxsize': int(os.getenv('GOOGLE_BOOKS_POOL_MAXSIZE', '4')),
+    },
+    'scrape': {
+        'timeout': float(os.getenv('SCRAPE_TIMEOUT_SECONDS', '10')),
+        'pool_connections': int(os.getenv('SCRAPE_POOL_CONNECTIONS', '20')),
+        'pool_maxsize': int(os.getenv('SCRAPE_POOL_MAXSIZE', '2')),
+    },
+}
+
+_http_sessions = {}
+_http_sessions_lock = threading.Lock()
+_http_request_counts = Counter()  # (宛先, 'requests' | 'errors') -> 回数
+
+def _get_http_session(destination: str) -> requests.Session:
+    """宛先ごとに接続プール付きの requests.Session を一度だけ生成して返す"""
+    session = _http_sessions.get(destination)
+    if session is None:
+        with _http_sessions_lock:
+            session = _http_sessions.get(destination)
+            if session is None:
+                config = HTTP_DESTINATIONS[destination]
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=config['pool_connections'], pool_maxsize=config['pool_maxsize'])
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _http_sessions[destination] = session
+    return session
+
+def _http_request(destination: str, method: str, url: str, **kwargs) -> requests.Response:
+    """宛先ごとの共有セッションとタイムアウトで HTTP リクエストを送る"""
+    kwargs.setdefault('timeout', HTTP_DESTINATIONS[destination]['timeout'])
+    _increment_stat(_http_request_counts, (destination, 'requests'))
+    try:
+        return _get_http_session(destination).request(method, url, **kwargs)
+    except requests.RequestException:
+        _increment_stat(_http_request_counts, (destination, 'errors'))
+        raise
+
+@_reports_stats('http')
+def _http_request_stats() -> dict:
+    """宛先ごとのリクエスト数とエラー数を返す (_http_request で数えた値だけを使い、urllib3 の内部状態は参照しない)"""
+    with _stats_lock:
+        counts = dict(_http_request_counts)
+    return {
+        destination: {
+            "requests": counts.get((destination, 'requests'), 0),
+            "errors": counts.get((destination, 'errors'), 0),
+            "pool_maxsize": config['pool_maxsize'],
+        }
+        for destination, config in HTTP_DESTINATIONS.items()
+    }
+
+
+# ===== GCP クライアントキャッシュ =====
+# Discovery Engine の SearchServiceClient や Vector Search の MatchingEngineIndex(Endpoint) は、
+# 生成時にチャネル確立やリソースの GET を伴うため、プロセスごとに一度だけ生成して使い回す。
+# 呼び出しが失敗した場合は、次回の呼び出しで作り直されるようにキャッシュから破棄する。
+_gcp_clients = {}
+_gcp_clients_lock = threading.Lock()
+_gcp_client_stats = {}  # クライアント種別 -> 生成・呼び出しの回数と所要時間
+
+def _record_gcp_client_stat(kind: str, field: str, seconds: float = None):
+    stats = _gcp_client_stats.setdefault(kind, {
+        "constructions": 0, "construction_seconds": 0.0,
+        "calls": 0, "call_seconds": 0.0, "errors": 0,
+    })
+    if field == "construction":
+        stats["constructions"] += 1
+        stats["construction_seconds"] += seconds
+    elif field == "call":
+        stats["calls"] += 1
+        stats["call_seconds"] += seconds
+    elif field == "error":
+        stats["errors"] += 1
+
+def _get_gcp_client(kind: str, resource_name: str, factory):
+    """(種別, リソース名) ごとにクライアントを一度だけ生成して返す。生成時間は呼び出し時間とは別に記録する。"""
+    key = (kind, resource_name)
+    client = _gcp_clients.get(key)
+    if client is None:
+        with _gcp_clients_lock:
+            client = _gcp_clients.get(key)
+            if client is None:
+                started_at = time.perf_counter()
+                client = factory()
+                elapsed = time.perf_counter() - started_at
+                _record_gcp_client_stat(kind, "construction", elapsed)
+                _gcp_clients[key] = client
+                print(f"✅ Created {kind} client for {resource_name or 'default'} in {elapsed * 1000:.0f}ms")
+    return client
+
+def _call_gcp_client(kind: str, resource_name: str, factory, operation):
+    """キャッシュ済みクライアントで operation(client) を実行する。失敗時はクライアントを破棄して例外を送出する。"""
+    client = _get_gcp_client(kind, resource_name, factory)
+    started_at = time.perf_counter()
+    try:
+        return operation(client)
+    except Exception:
+        _record_gcp_client_stat(kind, "error")
+        with _gcp_clients_lock:
+            if _gcp_clients.get((kind, resource_name)) is client:
+                del _gcp_clients[(kind, resource_name)]
+        print(f"⚠️ Discarded cached {kind} client for {resource_name or 'default'} after an error.")
+        raise
+    finally:
+        _record_gcp_client_stat(kind, "call", time.perf_counter() - started_at)
+
+def _gcp_client_stats_snapshot() -> dict:
+    """クライアント種別ごとの生成・呼び出し統計のコピーを返す"""
+    return {kind: dict(stats) for kind, stats in _gcp_client_stats.items()}
+
+
+# ===== ローカル言語判定 =====
+# 明らかに日本語/英語の応答はローカルで判定し、判断がつかないものだけを Gemma に回す
+LANG_DETECT_MIN_LETTERS = 20       # ラテン文字を含み、これより文字数が少ない場合は判定しない (エスカレーション)
+LANG_DETECT_MIN_JAPANESE_ONLY = 3  # ラテン文字を含まない場合は、仮名・漢字がこれ以上あれば日本語
+LANG_DETECT_JAPANESE_RATIO = 0.3   # 仮名・漢字の割合がこれ以上なら日本語
+LANG_DETECT_ENGLISH_RATIO = 0.05   # 仮名・漢字の割合がこれ以下なら英語
+_JAPANESE_CHAR_PATTERN = re.compile(r"[\u3040-\u309f\u30a0-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uff66-\uff9f]")
+_LATIN_CHAR_PATTERN = re.compile(r"[A-Za-z]")
+_language_check_stats = Counter()  # 'local_japanese' | 'local_english' | 'escalated' -> 回数
+
+def _collect_json_strings(value) -> list:
+    """JSON の値から文字列だけを再帰的に取り出す (キー名は判定に含めない)"""
+    if isinstance(value, str):
+        return [value]
+    if isinstance(value, dict):
+        return [s for v in value.values() for s in _collect_json_strings(v)]
+    if isinstance(value, list):
+        return [s for v in value for s in _collect_json_strings(v)]
+    return []
+
+def _detect_language_locally(text: str):
+    """
+    JSON 応答の文字列値に含まれるラテン文字と仮名・漢字の比率から言語を判定する。
+    ラテン文字を含まない場合は、短くても仮名・漢字がいくつかあれば日本語とする。
+    'ja' か 'en' を返し、判断がつかない場合は None を返す。
+    """
+    candidate = text.strip()
+    if candidate.startswith("```"):
+        candidate = re.sub(r"^```(?:json)?|```$", "", candidate).strip()
+    try:
+        sample = " ".join(_collect_json_strings(json.loads(candidate)))
+    except (json.JSONDecodeError, ValueError):
+        sample = candidate
+
+    japanese = len(_JAPANESE_CHAR_PATTERN.findall(sample))
+    latin = len(_LATIN_CHAR_PATTERN.findall(sample))
+    if latin == 0:
+        # 「ストレス管理」のような短い日本語はラテン文字との比率を見るまでもない
+        return 'ja' if japanese >= LANG_DETECT_MIN_JAPANESE_ONLY else None
+    total = japanese + latin
+    if total < LANG_DETECT_MIN_LETTERS:
+        return None
+    ratio = japanese / total
+    if ratio >= LANG_DETECT_JAPANESE_RATIO:
+        return 'ja'
+    if ratio <= LANG_DETECT_ENGLISH_RATIO:
+        return 'en'
+    return None
+
+def _is_english_response(text: str) -> bool:
+    """明らかなケースはローカルで判定し、曖昧なテキストだけを Gemma の判定に回す"""
+    language = _detect_language_locally(text)
+    if language == 'ja':
+        _increment_stat(_language_check_stats, 'local_japanese')
+        return False
+    if language == 'en':
+        _increment_stat(_language_check_stats, 'local_english')
+        return True
+    _increment_stat(_language_check_stats, 'escalated')
+    return _is_english_with_gemma(text)
+
+@_reports_stats('language_check')
+def _language_check_stats_snapshot() -> dict:
+    """ローカル判定と Gemma へのエスカレーションの件数を返す"""
+    with _stats_lock:
+        snapshot = dict(_language_check_stats)
+    total = sum(snapshot.values())
+    snapshot['escalation_rate'] = snapshot.get('escalated', 0) / total if total else 0.0
+    return snapshot
+
+
 def _is_english_with_gemma(text: str) -> bool:
     """
     Ollama/Gemma を呼び出して、テキストが英語かどうかを判定します。
@@ -341,7 +842,9 @@ RESPONSE:
 """
     try:
         print(f"--- Checking for language with Gemma ({OLLAMA_MODEL_NAME}) ---")
-        response = requests.post(
+        response = _http_request(
+            'ollama',
+            'POST',
             f"{OLLAMA_ENDPOINT}/api/generate",
             json={
                 "model": OLLAMA_MODEL_NAME,
@@ -349,8 +852,7 @@ RESPONSE:
                 "stream": False,
                 # 判定なので temperature は低くする
                 "options": { "temperature": 0.0 }
-            },
-            timeout=60
+            }
         )
         response.raise_for_status()
         gemma_response = response.json().get('response', '').strip().upper()
@@ -371,17 +873,17 @@ def _call_gemini_with_schema(prompt: str, schema: dict, model_name: str, safety_
     Calls a Gemini model with a specified response schema, including an optional language check with Gemma.
     If the response is in English, it will retry the call with a request to regenerate in Japanese.
     """
-    model = GenerativeModel(model_name)
+    model = _get_generative_model(model_name, {"response_mime_type": "application/json", "response_schema": schema})
     attempt_num = _call_gemini_with_schema.retry.statistics.get('attempt_number', 1)
     print(f"--- Calling Gemini ({model_name}) with schema (Attempt: {attempt_num}) ---")
     response = None # responseを事前に初期化
     try:
-        response = model.generate_content(prompt, generation_config=GenerationConfig(response_mime_type="application/json", response_schema=schema))
+        response = model.generate_content(prompt)
         response_text = response.text.strip()
 
-        # Gemmaによる言語チェック
-        if safety_check and _is_english_with_gemma(response_text):
-            print("⚠️ English response detected by Gemma. Retrying Gemini call with Japanese enforcement.")
+        # 言語チェック (曖昧な場合のみ Gemma で判定)
+        if safety_check and _is_english_response(response_text):
+            print("⚠️ English response detected. Retrying Gemini call with Japanese enforcement.")
             # 新しいプロンプトを生成
             japanese_enforcement_prompt = f"""
 The following response was generated, but it appears to be in English.
@@ -415,6 +917,130 @@ Please provide the revised, Japanese-language response now:
         traceback.print_exc()
         raise
 
+class _LRUCache:
+    """スレッドセーフな TTL 付き LRU キャッシュ。ttl が None のエントリは期限切れにならない。"""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (value, expires_at_monotonic)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and time.monotonic() >= expires_at:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl: timedelta = None):
+        expires_at = time.monotonic() + ttl.total_seconds() if ttl is not None else None
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+_llm_response_cache = _LRUCache(LLM_CACHE_MAX_ENTRIES)
+_llm_cache_stats = Counter()  # (呼び出し元, 'memory_hit' | 'firestore_hit' | 'miss' | 'bypass') -> 回数
+
+def _normalize_prompt(prompt: str) -> str:
+    """インデントや行末の空白、連続する空行の違いでキャッシュキーが変わらないようにプロンプトを正規化する"""
+    lines = [line.rstrip() for line in textwrap.dedent(prompt).strip().splitlines()]
+    return re.sub(r"\n{3,}", "\n\n", "\n".join(lines))
+
+def _llm_cache_key(model_name: str, schema: dict, prompt: str) -> str:
+    schema_json = json.dumps(schema, sort_keys=True, ensure_ascii=False)
+    material = "\n".join([model_name, schema_json, _normalize_prompt(prompt)])
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+def _get_persisted_llm_response(cache_key: str):
+    """Firestore 層から期限内のキャッシュ済み応答を取得する。見つからない場合は (None, None)。"""
+    try:
+        doc = db_firestore.collection(LLM_CACHE_COLLECTION).document(cache_key).get()
+        if not doc.exists:
+            return None, None
+        data = doc.to_dict() or {}
+        expires_at = data.get('expires_at')
+        response = data.get('response')
+        if not isinstance(expires_at, datetime) or not isinstance(response, dict):
+            return None, None
+        remaining = expires_at - datetime.now(timezone.utc)
+        if remaining <= timedelta(0):
+            return None, None
+        return response, remaining
+    except Exception as e:
+        print(f"❌ LLM CACHE: Failed to read Firestore cache: {e}")
+        return None, None
+
+def _persist_llm_response(cache_key: str, call_site: str, model_name: str, response: dict, ttl: timedelta):
+    try:
+        db_firestore.collection(LLM_CACHE_COLLECTION).document(cache_key).set({
+            'call_site': call_site,
+            'model': model_name,
+            'response': response,
+            'created_at': firestore.SERVER_TIMESTAMP,
+            # Firestore の TTL ポリシーをこのフィールドに設定すると、期限切れのドキュメントが自動削除される
+            'expires_at': datetime.now(timezone.utc) + ttl,
+        })
+    except Exception as e:
+        print(f"❌ LLM CACHE: Failed to write Firestore cache: {e}")
+
+def _call_gemini_cached(prompt: str, schema: dict, model_name: str, call_site: str, bypass_cache: bool = False) -> dict:
+    """
+    プロンプトだけで結果が決まる _call_gemini_with_schema の呼び出しを、(モデル, スキーマ, 正規化したプロンプト) のハッシュでキャッシュする。
+    プロセス内の LRU を優先し、次に Firestore 層を参照する。TTL は LLM_CACHE_TTLS で呼び出し元ごとに設定する。
+    """
+    ttl = LLM_CACHE_TTLS.get(call_site)
+    if ttl is None or bypass_cache:
+        _increment_stat(_llm_cache_stats, (call_site, 'bypass'))
+        return _call_gemini_with_schema(prompt, schema, model_name=model_name)
+
+    cache_key = _llm_cache_key(model_name, schema, prompt)
+    cached = _llm_response_cache.get(cache_key)
+    if cached is not None:
+        _increment_stat(_llm_cache_stats, (call_site, 'memory_hit'))
+        print(f"✅ LLM CACHE HIT (memory): {call_site}")
+        return copy.deepcopy(cached)
+
+    if PERSISTENT_CACHE_ENABLED:
+        cached, remaining = _get_persisted_llm_response(cache_key)
+        if cached is not None:
+            _increment_stat(_llm_cache_stats, (call_site, 'firestore_hit'))
+            print(f"✅ LLM CACHE HIT (firestore): {call_site}")
+            _llm_response_cache.set(cache_key, cached, min(ttl, remaining))
+            return copy.deepcopy(cached)
+
+    _increment_stat(_llm_cache_stats, (call_site, 'miss'))
+    result = _call_gemini_with_schema(prompt, schema, model_name=model_name)
+    if isinstance(result, dict):
+        _llm_response_cache.set(cache_key, copy.deepcopy(result), ttl)
+        if PERSISTENT_CACHE_ENABLED:
+            threading.Thread(target=_persist_llm_response, args=(cache_key, call_site, model_name, copy.deepcopy(result), ttl)).start()
+    return result
+
+@_reports_stats('llm_cache')
+def _llm_cache_stats_snapshot() -> dict:
+    """呼び出し元ごとのヒット/ミス件数を返す"""
+    with _stats_lock:
+        counts = dict(_llm_cache_stats)
+    snapshot = {}
+    for (call_site, outcome), count in counts.items():
+        snapshot.setdefault(call_site, {})[outcome] = count
+    return snapshot
+
 def generate_initial_questions(topic, user_id):
     """トピックと過去の対話履歴に基づいて、新しい初期質問を生成する"""
     past_insights = _get_all_insights_as_text(user_id)
@@ -446,8 +1072,10 @@ def generate_initial_questions(topic, user_id):
 生成するのは質問リストのみとし、番号や前置き、解説は一切含めないでください。
 """
     prompt = textwrap.dedent(prompt)
-    flash_model = os.getenv('GEMINI_FLASH_NAME', 'gemini-1.5-flash-preview-05-20')
-    return _call_gemini_with_schema(prompt, QUESTIONS_SCHEMA, model_name=flash_model).get("questions", [])
+    if past_insights:
+        return _call_gemini_with_schema(prompt, QUESTIONS_SCHEMA, model_name=GEMINI_FLASH_NAME).get("questions", [])
+    # 新規ユーザー向けのプロンプトはトピックだけで決まるため、キャッシュを使う
+    return _call_gemini_cached(prompt, QUESTIONS_SCHEMA, GEMINI_FLASH_NAME, 'initial_questions').get("questions", [])
 
 def generate_follow_up_questions(insights):
     """対話の要約に基づいてフォローアップ質問を生成する（シンプルなバージョン）"""
@@ -459,9 +1087,8 @@ def generate_follow_up_questions(insights):
 {insights}
 """
     prompt = textwrap.dedent(prompt)
-    flash_model = os.getenv('GEMINI_FLASH_NAME', 'gemini-1.5-flash-preview-05-20')
     try:
-        result = _call_gemini_with_schema(prompt, QUESTIONS_SCHEMA, model_name=flash_model)
+        result = _call_gemini_with_schema(prompt, QUESTIONS_SCHEMA, model_name=GEMINI_FLASH_NAME)
         return result.get("questions", []) if result else None
     except Exception as e:
         print(f"❌ Failed to generate follow up questions: {e}")
@@ -469,23 +1096,125 @@ def generate_follow_up_questions(insights):
 
 def generate_summary_only(topic, swipes_text):
     prompt = SUMMARY_ONLY_PROMPT_TEMPLATE.format(topic=topic, swipes_text=swipes_text)
-    flash_model = os.getenv('GEMINI_FLASH_NAME', 'gemini-1.5-flash-preview-05-20')
     try:
-        return _call_gemini_with_schema(prompt, SUMMARY_SCHEMA, model_name=flash_model)
+        return _call_gemini_with_schema(prompt, SUMMARY_SCHEMA, model_name=GEMINI_FLASH_NAME)
     except Exception as e:
         print(f"❌ Failed to generate summary: {e}")
         return None
 
+def _extract_partial_json_string(raw: str, key: str):
+    """
+    生成途中の JSON テキストから、指定したキーの文字列値を取り出す。
+    (デコード済みの値, 値の終端の引用符まで届いているか) を返し、キーがまだ現れていなければ (None, False) を返す。
+    """
+    match = re.search(r'"%s"\s*:\s*"' % re.escape(key), raw)
+    if not match:
+        return None, False
+    start = i = match.end()
+    closed = False
+    while i < len(raw):
+        char = raw[i]
+        if char == '\\':
+            # エスケープシーケンスが途中で切れている場合は、その手前までをデコードする
+            step = 6 if raw[i + 1:i + 2] == 'u' else 2
+            if i + step > len(raw):
+                break
+            i += step
+        elif char == '"':
+            closed = True
+            break
+        else:
+            i += 1
+    value = json.loads('"' + raw[start:i] + '"', strict=False)
+    if not closed and value and '\ud800' <= value[-1] <= '\udbff':
+        # サロゲートペアの前半だけの場合は、後半が届くまで保留する
+        value = value[:-1]
+    return value, closed
+
+@retry(wait=wait_exponential(multiplier=1, min=2, max=10), stop=stop_after_attempt(3))
+def _open_generation_stream(model, prompt: str):
+    """
+    ストリーミング生成を開始し、最初のチャンクを受け取るまでを行う。接続やモデルの一時的なエラーは
+    _call_gemini_with_schema と同じ条件でリトライする。最初のチャンクから始まるチャンクのイテレーターを返す。
+    """
+    stream = iter(model.generate_content(prompt, stream=True))
+    first = next(stream, None)
+
+    def chunks():
+        if first is not None:
+            yield first
+        yield from stream
+    return chunks()
+
+def stream_summary_only(topic, swipes_text):
+    """
+    generate_summary_only のストリーミング版。('title', タイトル) を一度だけ、続いて ('insights', 追加分) を順に yield し、
+    最後に ('result', 要約の dict) を yield する。SUMMARY_SCHEMA のプロパティ順 (title → insights) で生成される前提。
+    途中経過は生成済みのテキストが日本語だとローカルで判定できるまで送らずに溜めておく。
+    送った後で英語と分かった場合や生成が途中で失敗した場合は、('reset', None) を送ってから作り直した結果を 'result' として返す。
+    """
+    prompt = SUMMARY_ONLY_PROMPT_TEMPLATE.format(topic=topic, swipes_text=swipes_text)
+    model = _get_generative_model(GEMINI_FLASH_NAME, {"response_mime_type": "application/json", "response_schema": SUMMARY_SCHEMA})
+    raw = ""
+    title_sent = False
+    insights_sent = 0
+    japanese = False
+
+    def progress_events():
+        nonlocal title_sent, insights_sent
+        if not title_sent:
+            title, title_complete = _extract_partial_json_string(raw, 'title')
+            if title_complete:
+                title_sent = True
+                yield 'title', title
+        insights, _ = _extract_partial_json_string(raw, 'insights')
+        if insights and len(insights) > insights_sent:
+            yield 'insights', insights[insights_sent:]
+            insights_sent = len(insights)
+
+    try:
+        for chunk in _open_generation_stream(model, prompt):
+            try:
+                raw += chunk.text
+            except ValueError:
+                continue
+            if not japanese:
+                title, _ = _extract_partial_json_string(raw, 'title')
+                insights, _ = _extract_partial_json_string(raw, 'insights')
+                japanese = _detect_language_locally(json.dumps([title or "", insights or ""], ensure_ascii=False)) == 'ja'
+                if not japanese:
+                    continue
+            yield from progress_events()
+    except Exception as e:
+        # 途中で切れたストリームは再開できないため、リトライ付きの非ストリーミングの生成で作り直す
+        print(f"⚠️ Summary stream failed ({e}). Regenerating without streaming.")
+        if title_sent or insights_sent:
+            yield 'reset', None
+        yield 'result', generate_summary_only(topic, swipes_text)
+        return
+
+    response_text = raw.strip()
+    if response_text.startswith("```"):
+        response_text = re.sub(r"^```(?:json)?|```$", "", response_text).strip()
+    if _is_english_response(response_text):
+        print("⚠️ English summary detected while streaming. Regenerating without streaming.")
+        if title_sent or insights_sent:
+            yield 'reset', None
+        yield 'result', generate_summary_only(topic, swipes_text)
+        return
+    # 最後まで日本語と判定できずに溜めていた途中経過は、ここでまとめて送る
+    yield from progress_events()
+    yield 'result', json.loads(response_text)
+
 def generate_graph_data(all_insights_text):
     prompt = GRAPH_ANALYSIS_PROMPT_TEMPLATE + all_insights_text
-    pro_model = os.getenv('GEMINI_PRO_NAME', 'gemini-1.5-pro-preview-05-20')
     try:
-        return _call_gemini_with_schema(prompt, GRAPH_SCHEMA, model_name=pro_model)
+        return _call_gemini_with_schema(prompt, GRAPH_SCHEMA, model_name=GEMINI_PRO_NAME)
     except Exception as e:
         print(f"❌ Failed to generate graph data: {e}")
         return None
 
-def generate_chat_response(session_summary, chat_history, user_message, rag_context=""):
+def _build_chat_prompt(session_summary, chat_history, user_message, rag_context=""):
     history_str = "\n".join([f"{msg['author']}: {msg['text']}" for msg in chat_history])
     
     if rag_context:
@@ -512,12 +1241,27 @@ def generate_chat_response(session_summary, chat_history, user_message, rag_cont
     else:
         # RAGコンテキストがない場合は、元のプロンプトを使用
         prompt = CHAT_PROMPT_TEMPLATE.format(session_summary=session_summary, chat_history=history_str, user_message=user_message)
+    return prompt
 
-    pro_model = os.getenv('GEMINI_PRO_NAME', 'gemini-1.5-pro-preview-05-20')
-    model = GenerativeModel(pro_model)
+def generate_chat_response(session_summary, chat_history, user_message, rag_context=""):
+    prompt = _build_chat_prompt(session_summary, chat_history, user_message, rag_context)
+    model = _get_generative_model(GEMINI_PRO_NAME)
     return model.generate_content(prompt).text.strip()
 
-def generate_topic_suggestions(insights_text: str):
+def stream_chat_response(session_summary, chat_history, user_message, rag_context=""):
+    """generate_chat_response のストリーミング版。Gemini が返したテキストの断片を順に yield する。"""
+    prompt = _build_chat_prompt(session_summary, chat_history, user_message, rag_context)
+    model = _get_generative_model(GEMINI_PRO_NAME)
+    for chunk in model.generate_content(prompt, stream=True):
+        try:
+            text = chunk.text
+        except ValueError:
+            # セーフティフィルタ等でテキストを含まない断片はスキップする
+            continue
+        if text:
+            yield text
+
+def generate_topic_suggestions(insights_text: str, bypass_cache: bool = False):
     """ユーザーの過去の対話履歴のサマリーに基づき、新しい対話トピックを3つ提案する"""
     prompt = f"""
 あなたは、ユーザーの思考の整理を手伝う、優れたカウンセラーです。
@@ -531,9 +1275,8 @@ def generate_topic_suggestions(insights_text: str):
 - 提案は3つ生成してください。
 - 必ず、指定されたJSON形式で出力してください。
 """
-    pro_model = os.getenv('GEMINI_PRO_NAME', 'gemini-1.5-pro-preview-05-20')
     try:
-        result = _call_gemini_with_schema(prompt, TOPIC_SUGGESTION_SCHEMA, model_name=pro_model)
+        result = _call_gemini_cached(prompt, TOPIC_SUGGESTION_SCHEMA, GEMINI_PRO_NAME, 'topic_suggestions', bypass_cache=bypass_cache)
         return result.get("suggestions", []) if result else None
     except Exception as e:
         print(f"❌ Failed to generate topic suggestions: {e}")
@@ -555,8 +1298,7 @@ def _extract_keywords_for_search(analysis_text: str) -> str:
 # キーワード:
 """
     try:
-        flash_model = os.getenv('GEMINI_FLASH_NAME', 'gemini-1.5-flash-preview-05-20')
-        model = GenerativeModel(flash_model)
+        model = _get_generative_model(GEMINI_FLASH_NAME)
         print("--- Calling Gemini to extract search keywords ---")
         response = model.generate_content(prompt)
         keywords = response.text.strip()
@@ -572,8 +1314,7 @@ def _summarize_internal_context(context: str, keyword: str) -> str:
         return "このテーマについて、これまで具体的なお話はなかったようです。"
     try:
         prompt = INTERNAL_CONTEXT_PROMPT_TEMPLATE.format(context=context, keyword=keyword)
-        flash_model = os.getenv('GEMINI_FLASH_NAME', 'gemini-1.5-flash-preview-05-20')
-        model = GenerativeModel(flash_model)
+        model = _get_generative_model(GEMINI_FLASH_NAME)
         print(f"--- Calling Gemini to summarize internal context for '{keyword}' ---")
         response = model.generate_content(prompt)
         summary = response.text.strip()
@@ -586,72 +1327,301 @@ def _summarize_internal_context(context: str, keyword: str) -> str:
 
 # ===== RAG (Retrieval-Augmented Generation) Helper Functions =====
 
+EMBEDDING_MODEL_NAME = "text-multilingual-embedding-002"
+
+# モデル名 -> TextEmbeddingModel。from_pretrained はモデル情報の取得を伴うため、プロセスごとに一度だけ行う
+_embedding_models = {}
+_embedding_models_lock = threading.Lock()
+
+def _get_embedding_model(model_name: str = EMBEDDING_MODEL_NAME):
+    """TextEmbeddingModel をプロセス内で一度だけロードし、スレッド間で共有する"""
+    model = _embedding_models.get(model_name)
+    if model is None:
+        with _embedding_models_lock:
+            model = _embedding_models.get(model_name)
+            if model is None:
+                model = TextEmbeddingModel.from_pretrained(model_name)
+                _embedding_models[model_name] = model
+                print(f"✅ Loaded embedding model: {model_name}")
+    return model
+
+# 埋め込み API の1リクエストあたりの上限 (text-multilingual-embedding-002: 250 件 / 20,000 トークン)
+EMBEDDING_MAX_INSTANCES_PER_REQUEST = int(os.getenv('EMBEDDING_MAX_INSTANCES_PER_REQUEST', '250'))
+EMBEDDING_MAX_TOKENS_PER_REQUEST = int(os.getenv('EMBEDDING_MAX_TOKENS_PER_REQUEST', '20000'))
+EMBEDDING_MAX_CONCURRENCY = int(os.getenv('EMBEDDING_MAX_CONCURRENCY', '4'))
+
+def _estimate_embedding_tokens(text: str) -> int:
+    """トークナイザを使わない控えめな見積もり。日本語はほぼ1文字1トークン、英語では多めに見積もる。"""
+    return max(1, len(text))
+
+def _plan_embedding_batches(texts: list[str]) -> list[tuple[int, int]]:
+    """件数とトークン数の上限に収まるよう、先頭から詰めたバッチの (開始, 終了) インデックスを返す"""
+    batches = []
+    start, tokens = 0, 0
+    for i, text in enumerate(texts):
+        text_tokens = _estimate_embedding_tokens(text)
+        if i > start and (i - start >= EMBEDDING_MAX_INSTANCES_PER_REQUEST or tokens + text_tokens > EMBEDDING_MAX_TOKENS_PER_REQUEST):
+            batches.append((start, i))
+            start, tokens = i, 0
+        tokens += text_tokens
+    if start < len(texts):
+        batches.append((start, len(texts)))
+    return batches
+
 @retry(wait=wait_exponential(multiplier=1, min=2, max=10), stop=stop_after_attempt(3))
-def _get_embeddings(texts: list[str]) -> list[list[float]]:
-    if not texts: return []
-    model = TextEmbeddingModel.from_pretrained("text-multilingual-embedding-002")
-    BATCH_SIZE = 15 
-    all_embeddings = []
-    print(f"--- RAG: Generating embeddings for {len(texts)} texts in batches of {BATCH_SIZE} ---")
+def _embed_batch(batch: list[str]) -> list[list[float]]:
+    """1つのバッチをベクトル化する。失敗した場合はこのバッチだけがリトライされる。"""
     try:
-        for i in range(0, len(texts), BATCH_SIZE):
-            batch = texts[i:i + BATCH_SIZE]
-            responses = model.get_embeddings(batch)
-            for response in responses:
-                all_embeddings.append(response.values)
-            print(f"--- RAG: Processed embedding batch {i//BATCH_SIZE + 1}/{-(-len(texts) // BATCH_SIZE)} ---")
-        return all_embeddings
+        return [response.values for response in _get_embedding_model().get_embeddings(batch)]
     except Exception as e:
         print(f"❌ RAG: An error occurred during embedding generation: {e}")
         traceback.print_exc()
         # ★★★ 修正: 例外を再raiseしてretryをトリガーする ★★★
         raise
 
+def _request_embeddings(texts: list[str]) -> list[list[float]]:
+    """キャッシュを介さずに埋め込み API を呼び出す。複数のバッチは並行して送り、結果は入力順に並べる。"""
+    if not texts: return []
+    batches = _plan_embedding_batches(texts)
+    print(f"--- RAG: Generating embeddings for {len(texts)} texts in {len(batches)} batch(es) ---")
+    if len(batches) == 1:
+        return _embed_batch(texts)
+
+    with ThreadPoolExecutor(max_workers=min(EMBEDDING_MAX_CONCURRENCY, len(batches))) as executor:
+        futures = [executor.submit(_embed_batch, texts[start:end]) for start, end in batches]
+        all_embeddings = []
+        for future in futures:
+            all_embeddings.extend(future.result())
+    return all_embeddings
+
+_embedding_cache = _LRUCache(EMBEDDING_CACHE_MAX_ENTRIES)
+_embedding_cache_stats = Counter()  # 'memory_hit' | 'firestore_hit' | 'miss' -> テキスト数
+
+def _normalize_embedding_text(text: str) -> str:
+    """前後の空白と連続する空白の違いでキャッシュキーが変わらないようにする"""
+    return re.sub(r'\s+', ' ', str(text or '')).strip()
+
+def _embedding_cache_key(model_name: str, normalized_text: str) -> str:
+    return hashlib.sha256(f"{model_name}\n{normalized_text}".encode('utf-8')).hexdigest()
+
+def _get_persisted_embeddings(cache_keys: list) -> dict:
+    """Firestore 層から期限内のベクトルをまとめて取得する。{キャッシュキー: ベクトル}"""
+    found = {}
+    try:
+        collection = db_firestore.collection(EMBEDDING_CACHE_COLLECTION)
+        now = datetime.now(timezone.utc)
+        for start in range(0, len(cache_keys), FIRESTORE_BATCH_LIMIT):
+            refs = [collection.document(key) for key in cache_keys[start:start + FIRESTORE_BATCH_LIMIT]]
+            for doc in db_firestore.get_all(refs):
+                if not doc.exists:
+                    continue
+                data = doc.to_dict() or {}
+                expires_at = data.get('expires_at')
+                if not isinstance(expires_at, datetime) or expires_at <= now:
+                    continue
+                matrix = _decode_vectors(data)
+                if matrix is not None and len(matrix) == 1:
+                    found[doc.id] = matrix[0].tolist()
+    except Exception as e:
+        print(f"❌ EMBEDDING CACHE: Failed to read Firestore cache: {e}")
+    return found
+
+def _persist_embeddings(model_name: str, entries: dict):
+    """ベクトルを _encode_vectors のバイト列にして Firestore 層に保存する。{キャッシュキー: float32 の配列}"""
+    try:
+        items = list(entries.items())
+        for start in range(0, len(items), FIRESTORE_BATCH_LIMIT):
+            batch = db_firestore.batch()
+            for key, vector in items[start:start + FIRESTORE_BATCH_LIMIT]:
+                batch.set(db_firestore.collection(EMBEDDING_CACHE_COLLECTION).document(key), {
+                    'model': model_name,
+                    **_encode_vectors([vector], EMBEDDING_CACHE_VECTOR_ENCODING),
+                    # Firestore の TTL ポリシーをこのフィールドに設定すると、期限切れのドキュメントが自動削除される
+                    'expires_at': datetime.now(timezone.utc) + EMBEDDING_CACHE_TTL,
+                })
+            batch.commit()
+    except Exception as e:
+        print(f"❌ EMBEDDING CACHE: Failed to write Firestore cache: {e}")
+
+def _get_embeddings(texts: list[str], cache: bool = True) -> list[list[float]]:
+    """
+    テキストのベクトルを入力と同じ順序で返す。プロセス内の LRU、Firestore 層の順に参照し、
+    どちらにもないテキストだけを (重複を除いて) 埋め込み API に送る。
+    RAG のチャンクのようにベクトルを rag_cache に保存するテキストは、cache=False でどちらの層も使わない。
+    """
+    if not texts: return []
+    normalized = [_normalize_embedding_text(text) for text in texts]
+    keys = [_embedding_cache_key(EMBEDDING_MODEL_NAME, text) for text in normalized]
+
+    # プロセス内の層には float32 の配列で保持する (768 次元で約 3KB。float のタプルの約 1/8)
+    vectors = {}
+    if cache:
+        for key in keys:
+            if key not in vectors:
+                cached = _embedding_cache.get(key)
+                if cached is not None:
+                    vectors[key] = cached
+                    _embedding_cache_stats['memory_hit'] += 1
+
+    missing = [key for key in dict.fromkeys(keys) if key not in vectors]
+    if missing and cache and PERSISTENT_CACHE_ENABLED:
+        for key, vector in _get_persisted_embeddings(missing).items():
+            vectors[key] = np.asarray(vector, dtype=np.float32)
+            _embedding_cache.set(key, vectors[key], EMBEDDING_CACHE_TTL)
+            _embedding_cache_stats['firestore_hit'] += 1
+
+    missing_texts = {}  # キャッシュキー -> 正規化したテキスト (入力順)
+    for key, text in zip(keys, normalized):
+        if key not in vectors:
+            missing_texts.setdefault(key, text)
+    if missing_texts:
+        new_vectors = dict(zip(missing_texts, (np.asarray(v, dtype=np.float32) for v in _request_embeddings(list(missing_texts.values())))))
+        if len(new_vectors) != len(missing_texts):
+            raise ValueError(f"Embedding count mismatch: expected {len(missing_texts)}, got {len(new_vectors)}")
+        vectors.update(new_vectors)
+        if cache:
+            _embedding_cache_stats['miss'] += len(missing_texts)
+            for key, vector in new_vectors.items():
+                _embedding_cache.set(key, vector, EMBEDDING_CACHE_TTL)
+            if PERSISTENT_CACHE_ENABLED:
+                threading.Thread(target=_persist_embeddings, args=(EMBEDDING_MODEL_NAME, new_vectors)).start()
+    else:
+        print(f"✅ EMBEDDING CACHE: All {len(texts)} text(s) served from cache.")
+
+    return [vectors[key].tolist() for key in keys]
+
+def _embedding_cache_stats_snapshot() -> dict:
+    total = sum(_embedding_cache_stats.values())
+    snapshot = dict(_embedding_cache_stats)
+    snapshot['hit_rate'] = round((total - _embedding_cache_stats['miss']) / total, 3) if total else 0.0
+    return snapshot
+
 def _get_url_cache_doc_ref(url: str):
     url_hash = hashlib.sha256(url.encode('utf-8')).hexdigest()
     return db_firestore.collection(RAG_CACHE_COLLECTION).document(url_hash)
 
+def _encode_vectors(embeddings, encoding: str = None) -> dict:
+    """
+    ベクトルの行列を、Firestore の bytes フィールドに収まるリトルエンディアンの連続したバイト列にする。
+    int8 の場合は行ごとに最大絶対値が 127 になるよう量子化し、復元用のスケールを float32 で保存する。
+    """
+    encoding = encoding or RAG_CACHE_VECTOR_ENCODING
+    matrix = np.asarray(embeddings, dtype=np.float32)
+    fields = {'vector_encoding': encoding, 'vector_dim': int(matrix.shape[1])}
+    if encoding == 'int8':
+        scales = np.abs(matrix).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        fields['vectors'] = np.round(matrix / scales[:, None]).astype('<i1').tobytes()
+        fields['vector_scales'] = scales.astype('<f4').tobytes()
+    elif encoding in ('float16', 'float32'):
+        fields['vectors'] = matrix.astype('<f2' if encoding == 'float16' else '<f4').tobytes()
+    else:
+        raise ValueError(f"Unsupported vector encoding: {encoding}")
+    return fields
+
+def _decode_vectors(cache_data: dict):
+    """_encode_vectors で保存したベクトルを (チャンク数, 次元) の float32 行列に戻す。形式が不正なら None。"""
+    encoding = cache_data.get('vector_encoding')
+    dim = cache_data.get('vector_dim')
+    raw = cache_data.get('vectors')
+    if not isinstance(raw, (bytes, bytearray)) or not isinstance(dim, int) or dim <= 0:
+        return None
+    dtype = {'float32': '<f4', 'float16': '<f2', 'int8': '<i1'}.get(encoding)
+    if dtype is None or len(raw) % (np.dtype(dtype).itemsize * dim) != 0:
+        return None
+    matrix = np.frombuffer(raw, dtype=dtype).reshape(-1, dim).astype(np.float32)
+    if encoding == 'int8':
+        scales = np.frombuffer(cache_data.get('vector_scales') or b'', dtype='<f4')
+        if len(scales) != len(matrix):
+            return None
+        matrix *= scales[:, None]
+    return matrix
+
+def _migrate_legacy_rag_cache(doc_ref, url: str, embeddings):
+    """旧形式 ({'vector': [...]} の配列) のキャッシュを、cached_at を変えずにバイト列の形式へ書き換える"""
+    try:
+        doc_ref.update({**_encode_vectors(embeddings), 'embeddings': firestore.DELETE_FIELD})
+        print(f"✅ CACHE MIGRATED: Converted embeddings for {url} to {RAG_CACHE_VECTOR_ENCODING} bytes.")
+    except Exception as e:
+        print(f"❌ Error migrating cache for {url}: {e}")
+
+def _parse_rag_cache_document(url: str, doc_ref, cache_data: dict):
+    """rag_cache のドキュメントの期限と形を検証し、(チャンクのリスト, float32 行列) を返す。使えない場合は (None, None)。"""
+    cached_at = cache_data.get('cached_at')
+    if isinstance(cached_at, datetime):
+        if datetime.now(timezone.utc) - cached_at > timedelta(days=RAG_CACHE_TTL_DAYS):
+            print(f"CACHE STALE: Cache for {url} is older than {RAG_CACHE_TTL_DAYS} days.")
+            return None, None
+    else:
+         print(f"CACHE INVALID: Invalid 'cached_at' field for {url}.")
+         return None, None
+    
+    chunks = cache_data.get('chunks')
+    embeddings = None
+    if 'vectors' in cache_data:
+        embeddings = _decode_vectors(cache_data)
+    elif cache_data.get('embeddings'):
+        # 旧形式: 読み込んだうえで、次回から安く読めるようにバックグラウンドで書き換える
+        vectors = [item['vector'] for item in cache_data['embeddings'] if 'vector' in item]
+        if vectors and len({len(vector) for vector in vectors}) == 1:
+            embeddings = np.asarray(vectors, dtype=np.float32)
+            threading.Thread(target=_migrate_legacy_rag_cache, args=(doc_ref, url, embeddings)).start()
+    
+    if chunks and embeddings is not None and len(chunks) == len(embeddings):
+        print(f"✅ CACHE HIT: Found {len(chunks)} chunks for URL: {url}")
+        return chunks, embeddings
+
+    print(f"CACHE INVALID: Data mismatch for {url}. Re-fetching.")
+    return None, None
+
 def _get_cached_chunks_and_embeddings(url: str):
+    """URL のキャッシュから (チャンクのリスト, (チャンク数, 次元) の float32 行列) を返す。使えない場合は (None, None)。"""
     try:
         doc_ref = _get_url_cache_doc_ref(url)
         doc = doc_ref.get()
         if not doc.exists:
             print(f"CACHE MISS: No cache found for URL: {url}")
             return None, None
-        cache_data = doc.to_dict()
-        cached_at = cache_data.get('cached_at')
-        if isinstance(cached_at, datetime):
-            if datetime.now(timezone.utc) - cached_at > timedelta(days=RAG_CACHE_TTL_DAYS):
-                print(f"CACHE STALE: Cache for {url} is older than {RAG_CACHE_TTL_DAYS} days.")
-                return None, None
-        else:
-             print(f"CACHE INVALID: Invalid 'cached_at' field for {url}.")
-             return None, None
-        
-        chunks = cache_data.get('chunks')
-        embeddings_from_db = cache_data.get('embeddings')
-        
-        if chunks and embeddings_from_db:
-            embeddings = [item['vector'] for item in embeddings_from_db if 'vector' in item]
-            if len(chunks) == len(embeddings):
-                print(f"✅ CACHE HIT: Found {len(chunks)} chunks for URL: {url}")
-                return chunks, embeddings
-
-        print(f"CACHE INVALID: Data mismatch for {url}. Re-fetching.")
-        return None, None
+        return _parse_rag_cache_document(url, doc_ref, doc.to_dict())
     except Exception as e:
         print(f"❌ Error getting cache for {url}: {e}")
         return None, None
 
-def _set_cached_chunks_and_embeddings(url: str, chunks: list, embeddings: list):
-    if not chunks or not embeddings: return
+def _get_cached_chunks_for_urls(urls: list) -> dict:
+    """
+    複数の URL のキャッシュを1回の get_all でまとめて読み込み、使えるものだけを {url: (chunks, embeddings)} で返す。
+    含まれない URL はキャッシュミス。読み込みに失敗した場合は全てミスとして扱う。
+    """
+    if not urls:
+        return {}
+    try:
+        refs = {url: _get_url_cache_doc_ref(url) for url in urls}
+        urls_by_doc_id = {ref.id: url for url, ref in refs.items()}
+        hits = {}
+        for doc in db_firestore.get_all(list(refs.values())):
+            url = urls_by_doc_id.get(doc.id)
+            if url is None:
+                continue
+            if not doc.exists:
+                print(f"CACHE MISS: No cache found for URL: {url}")
+                continue
+            chunks, embeddings = _parse_rag_cache_document(url, refs[url], doc.to_dict() or {})
+            if chunks is not None:
+                hits[url] = (chunks, embeddings)
+        print(f"--- RAG: URL cache lookup: {len(hits)} hit(s), {len(urls) - len(hits)} miss(es) ---")
+        return hits
+    except Exception as e:
+        print(f"❌ Error getting cache for {len(urls)} URL(s): {e}")
+        return {}
+
+def _set_cached_chunks_and_embeddings(url: str, chunks: list, embeddings):
+    if not chunks or embeddings is None or len(embeddings) == 0: return
     try:
         doc_ref = _get_url_cache_doc_ref(url)
-        transformed_embeddings = [{'vector': emb} for emb in embeddings]
         cache_data = {
             'url': url,
             'chunks': chunks,
-            'embeddings': transformed_embeddings,
+            **_encode_vectors(embeddings),
             'cached_at': firestore.SERVER_TIMESTAMP
         }
         doc_ref.set(cache_data)
@@ -660,86 +1630,162 @@ def _set_cached_chunks_and_embeddings(url: str, chunks: list, embeddings: list):
         print(f"❌ Error setting cache for {url}: {e}")
         traceback.print_exc()
 
+def _stack_embeddings(blocks: list) -> np.ndarray:
+    """キャッシュから読んだ行列と新たに生成したベクトルのリストを、1つの (チャンク数, 次元) の float32 行列にまとめる"""
+    matrices = [np.asarray(block, dtype=np.float32).reshape(len(block), -1) for block in blocks if len(block)]
+    if not matrices:
+        return np.zeros((0, 0), dtype=np.float32)
+    return np.vstack(matrices)
+
+def _top_k_similar_chunks(query_embedding, chunk_matrix: np.ndarray, chunks: list, k: int = 3) -> list:
+    """
+    コサイン類似度の高い順に最大 k 個のチャンクを返す。1回の行列ベクトル積を行ノルムで割って全チャンクを採点し
+    (正規化した行列を作るのと同じ結果で、行列のコピーが不要)、argpartition で上位 k 個だけを並べ替える。
+    ゼロベクトル (チャンク・クエリとも) の類似度は 0 として扱う。
+    """
+    if len(chunks) == 0 or chunk_matrix.size == 0:
+        return []
+    query = np.asarray(query_embedding, dtype=np.float32)
+    query_norm = np.linalg.norm(query)
+    if query_norm == 0:
+        scores = np.zeros(len(chunks), dtype=np.float32)
+    else:
+        row_norms = np.linalg.norm(chunk_matrix, axis=1)
+        row_norms[row_norms == 0] = 1.0  # ゼロベクトルの行は内積もゼロ = 類似度 0
+        scores = (chunk_matrix @ query) / (row_norms * query_norm)
+    k = min(k, len(scores))
+    top = np.argpartition(-scores, k - 1)[:k]
+    top = top[np.argsort(-scores[top], kind='stable')]
+    return [chunks[i] for i in top]
+
+def _load_url_chunks(url: str, check_cache: bool = True):
+    """
+    URL のチャンクとベクトルを (chunks, embeddings) で返す。キャッシュがなければ取得・分割・ベクトル化してキャッシュする。
+    呼び出し元でキャッシュを確認済みの場合は check_cache=False で読み込みを省く。
+    """
+    if check_cache:
+        cached_chunks, cached_embeddings = _get_cached_chunks_and_embeddings(url)
+        if cached_chunks and cached_embeddings is not None:
+            return cached_chunks, cached_embeddings
+
+    print(f"SCRAPING: No valid cache for {url}. Fetching content.")
+    page_content = _scrape_text_from_url(url)
+    if not page_content:
+        return None, None
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=1500, chunk_overlap=150)
+    new_chunks_full = text_splitter.split_text(page_content)
+    
+    MAX_CHUNKS_PER_URL = 50  # 1つのURLから取得するチャンクの上限
+    new_chunks = new_chunks_full[:MAX_CHUNKS_PER_URL]
+
+    if len(new_chunks_full) > MAX_CHUNKS_PER_URL:
+        print(f"⚠️ RAG: Content too long. Truncated chunks for {url} from {len(new_chunks_full)} to {len(new_chunks)}.")
+    if not new_chunks:
+        return None, None
+    # チャンクのベクトルは rag_cache に URL ごとに保存するため、埋め込みキャッシュ (プロセス内・Firestore) には入れない
+    new_embeddings = _get_embeddings(new_chunks, cache=False)
+    if not new_embeddings or len(new_chunks) != len(new_embeddings):
+        print(f"⚠️ RAG: Failed to generate embeddings for {url}. Skipping.")
+        return None, None
+    threading.Thread(target=_set_cached_chunks_and_embeddings, args=(url, new_chunks, new_embeddings)).start()
+    return new_chunks, new_embeddings
+
+def _load_urls_in_parallel(urls: list) -> list:
+    """
+    URL のキャッシュを1回の get_all でまとめて確認し、キャッシュのない URL だけを並行して読み込む (_load_url_chunks)。
+    期限内に揃ったものを [(url, chunks, embeddings)] で urls と同じ順序で返す。各 URL はワーカーで読み込みが
+    始まった時刻から RAG_URL_DEADLINE_SECONDS、全体は RAG_FETCH_DEADLINE_SECONDS まで待つ。
+    期限に間に合わなかった読み込みはバックグラウンドで続き、終わればキャッシュされて次回以降に使われる。
+    """
+    if not urls:
+        return []
+    overall_deadline = time.monotonic() + RAG_FETCH_DEADLINE_SECONDS
+    cached = _get_cached_chunks_for_urls(urls)
+    misses = [url for url in urls if url not in cached]
+    started_at = {}  # url -> ワーカーで読み込みを開始した時刻 (time.monotonic)
+    started = {url: threading.Event() for url in misses}
+
+    def load(url):
+        started_at[url] = time.monotonic()
+        started[url].set()
+        return _load_url_chunks(url, check_cache=False)
+
+    executor = ThreadPoolExecutor(max_workers=max(1, min(RAG_URL_CONCURRENCY, len(misses))))
+    futures = {url: executor.submit(load, url) for url in misses}
+    loaded = []
+    try:
+        for url in urls:
+            if url in cached:
+                loaded.append((url, *cached[url]))
+                continue
+            future = futures[url]
+            # ワーカーの空きを待っている URL は、読み込みが始まるまで (全体の期限までは) 待ってから個別の期限を測る
+            if not started[url].wait(timeout=max(0.0, overall_deadline - time.monotonic())):
+                print(f"⚠️ RAG: Timed out before loading {url} started. Skipping.")
+                continue
+            url_deadline = min(overall_deadline, started_at[url] + RAG_URL_DEADLINE_SECONDS)
+            try:
+                chunks, embeddings = future.result(timeout=max(0.0, url_deadline - time.monotonic()))
+            except FuturesTimeoutError:
+                print(f"⚠️ RAG: Timed out loading {url}. Skipping.")
+                continue
+            except Exception as e:
+                print(f"❌ RAG: Failed to load {url}: {e}")
+                continue
+            if chunks:
+                loaded.append((url, chunks, embeddings))
+    finally:
+        # 期限切れの読み込みの完了は待たない (まだ始まっていないものは取り消す)
+        executor.shutdown(wait=False, cancel_futures=True)
+    print(f"--- RAG: Loaded {len(loaded)}/{len(urls)} URL(s) ---")
+    return loaded
+
 def _generate_rag_based_advice(query: str, project_id: str, similar_cases_engine_id: str, suggestions_engine_id: str, rag_type: str = None):
     """
     RAG based on user analysis to generate advice, using a Firestore cache for embeddings.
     Returns a tuple of (advice_text, list_of_source_urls).
     """
+    # クエリのベクトルはキーワードにも検索結果にも依存しないため、キーワード抽出・検索・URL の読み込みと並行して求める
+    query_executor = ThreadPoolExecutor(max_workers=1)
+    query_embedding_future = query_executor.submit(_get_embeddings, [query])
+    query_executor.shutdown(wait=False)
+
     search_query = _extract_keywords_for_search(query)
     if not search_query:
         print("⚠️ RAG: Could not extract keywords. Using original query for search.")
         search_query = query[:512]
     
-    all_found_urls = set()
     if rag_type == 'similar_cases':
         print("--- RAG: Searching for SIMILAR CASES ONLY ---")
-        if similar_cases_engine_id:
-            all_found_urls.update(_search_with_vertex_ai_search(project_id, "global", similar_cases_engine_id, search_query))
+        engines = [('similar_cases', similar_cases_engine_id)]
     elif rag_type == 'suggestions':
         print("--- RAG: Searching for SUGGESTIONS ONLY ---")
-        if suggestions_engine_id:
-            all_found_urls.update(_search_with_vertex_ai_search(project_id, "global", suggestions_engine_id, search_query))
+        engines = [('suggestions', suggestions_engine_id)]
     else: # Default behavior: search both
         print("--- RAG: Searching both similar cases and suggestions ---")
-        if similar_cases_engine_id:
-            all_found_urls.update(_search_with_vertex_ai_search(project_id, "global", similar_cases_engine_id, search_query))
-        if suggestions_engine_id:
-            all_found_urls.update(_search_with_vertex_ai_search(project_id, "global", suggestions_engine_id, search_query))
+        engines = [('similar_cases', similar_cases_engine_id), ('suggestions', suggestions_engine_id)]
+    all_found_urls = _search_engines_concurrently(project_id, [(name, engine_id) for name, engine_id in engines if engine_id], search_query)
 
     if not all_found_urls:
         return "関連する外部情報を見つけることができませんでした。", []
 
-    all_chunks, all_embeddings, urls_with_content = [], [], []
-    urls_to_process = list(all_found_urls)[:5]
+    all_chunks, embedding_blocks, urls_with_content = [], [], []
+    urls_to_process = list(all_found_urls)[:RAG_MAX_URLS]
 
-    for url in urls_to_process:
-        cached_chunks, cached_embeddings = _get_cached_chunks_and_embeddings(url)
-        if cached_chunks and cached_embeddings:
-            all_chunks.extend(cached_chunks)
-            all_embeddings.extend(cached_embeddings)
-            urls_with_content.append(url)
-        else:
-            print(f"SCRAPING: No valid cache for {url}. Fetching content.")
-            page_content = _scrape_text_from_url(url)
-            if page_content:
-                text_splitter = RecursiveCharacterTextSplitter(chunk_size=1500, chunk_overlap=150)
-                new_chunks_full = text_splitter.split_text(page_content)
-                
-                MAX_CHUNKS_PER_URL = 50  # 1つのURLから取得するチャンクの上限
-                new_chunks = new_chunks_full[:MAX_CHUNKS_PER_URL]
-
-                if len(new_chunks_full) > MAX_CHUNKS_PER_URL:
-                    print(f"⚠️ RAG: Content too long. Truncated chunks for {url} from {len(new_chunks_full)} to {len(new_chunks)}.")
-                if new_chunks:
-                    new_embeddings = _get_embeddings(new_chunks)
-                    if new_embeddings and len(new_chunks) == len(new_embeddings):
-                        all_chunks.extend(new_chunks)
-                        all_embeddings.extend(new_embeddings)
-                        urls_with_content.append(url)
-                        threading.Thread(target=_set_cached_chunks_and_embeddings, args=(url, new_chunks, new_embeddings)).start()
-                    else:
-                        print(f"⚠️ RAG: Failed to generate embeddings for {url}. Skipping.")
+    for url, chunks, embeddings in _load_urls_in_parallel(urls_to_process):
+        all_chunks.extend(chunks)
+        embedding_blocks.append(embeddings)
+        urls_with_content.append(url)
     
     if not all_chunks:
         return "関連する外部情報を見つけましたが、内容を読み取ることができませんでした。", urls_to_process
 
     print(f"--- RAG: Finding relevant chunks from {len(all_chunks)} total chunks... ---")
-    query_embedding_list = _get_embeddings([query])
+    query_embedding_list = query_embedding_future.result()
     if not query_embedding_list:
         return "あなたの状況を分析できませんでした。もう一度お試しください。", urls_with_content
     
-    query_embedding = np.array(query_embedding_list[0])
-    
-    similarities = []
-    for i, emb in enumerate(all_embeddings):
-        chunk_embedding = np.array(emb)
-        dot_product = np.dot(chunk_embedding, query_embedding)
-        norm_product = np.linalg.norm(chunk_embedding) * np.linalg.norm(query_embedding)
-        similarity = dot_product / norm_product if norm_product != 0 else 0.0
-        similarities.append((similarity, all_chunks[i]))
-    
-    similarities.sort(key=lambda x: x[0], reverse=True)
-    relevant_chunks = [chunk for sim, chunk in similarities[:3]]
+    relevant_chunks = _top_k_similar_chunks(query_embedding_list[0], _stack_embeddings(embedding_blocks), all_chunks, k=3)
 
     if not relevant_chunks:
         return "関連情報の中から、あなたの状況に特に合致する部分を見つけ出すことができませんでした。", urls_with_content
@@ -790,9 +1836,8 @@ def _generate_rag_based_advice(query: str, project_id: str, similar_cases_engine
 # あなたの応答:
 """
 
-    pro_model_name = os.getenv('GEMINI_PRO_NAME', 'gemini-1.5-pro-preview-05-20')
-    model = GenerativeModel(pro_model_name)
-    advice = model.generate_content(prompt, generation_config=GenerationConfig(temperature=0.7)).text
+    model = _get_generative_model(GEMINI_PRO_NAME, {"temperature": 0.7})
+    advice = model.generate_content(prompt).text
     
     return advice, list(dict.fromkeys(urls_with_content))
 
@@ -800,14 +1845,17 @@ def _search_with_vertex_ai_search(project_id: str, location: str, engine_id: str
     if not engine_id:
         print(f"❌ RAG: Engine ID '{engine_id}' is not configured.")
         return []
-    client = discoveryengine.SearchServiceClient()
     serving_config = (
         f"projects/{project_id}/locations/{location}/collections/default_collection/"
         f"engines/{engine_id}/servingConfigs/default_config"
     )
     request = discoveryengine.SearchRequest(serving_config=serving_config, query=query, page_size=5)
     try:
-        response = client.search(request)
+        response = _call_gcp_client(
+            'discoveryengine_search', None,
+            lambda: discoveryengine.SearchServiceClient(),
+            lambda client: client.search(request)
+        )
         urls = [r.document.derived_struct_data.get('link') for r in response.results if r.document.derived_struct_data.get('link')]
         print(f"✅ RAG: Found URLs from Vertex AI Search: {urls}")
         return urls
@@ -816,6 +1864,38 @@ def _search_with_vertex_ai_search(project_id: str, location: str, engine_id: str
         traceback.print_exc()
         return []
 
+def _search_engines_concurrently(project_id: str, engines: list, query: str) -> dict:
+    """
+    engines ([(名前, エンジンID)]) を並行して検索し、{URL: その URL を返したエンジン名のリスト} を返す。
+    URL は各エンジンの順位を交互にたどった順 (同順位は engines の順) に並べ、重複は最初の位置にまとめる。
+    RAG_SEARCH_TIMEOUT_SECONDS までに応答しなかったエンジンの結果は使わない。
+    """
+    if not engines:
+        return {}
+    deadline = time.monotonic() + RAG_SEARCH_TIMEOUT_SECONDS
+    executor = ThreadPoolExecutor(max_workers=len(engines))
+    futures = [(name, executor.submit(_search_with_vertex_ai_search, project_id, "global", engine_id, query)) for name, engine_id in engines]
+    results = []
+    try:
+        for name, future in futures:
+            try:
+                results.append((name, future.result(timeout=max(0.0, deadline - time.monotonic()))))
+            except FuturesTimeoutError:
+                print(f"⚠️ RAG: Search on '{name}' timed out after {RAG_SEARCH_TIMEOUT_SECONDS}s. Skipping.")
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    provenance = {}
+    for rank in range(max((len(urls) for _, urls in results), default=0)):
+        for name, urls in results:
+            if rank < len(urls):
+                sources = provenance.setdefault(urls[rank], [])
+                if name not in sources:
+                    sources.append(name)
+    for url, sources in provenance.items():
+        print(f"--- RAG: {url} (from {', '.join(sources)}) ---")
+    return provenance
+
 def _scrape_text_from_url(url: str) -> str:
     # ★ 追加: 特定のSNSドメインはスクレイピングをスキップする
     forbidden_domains = ['twitter.com', 'x.com', 'facebook.com', 'instagram.com', 'detail.chiebukuro.yahoo.co.jp']
@@ -825,7 +1905,7 @@ def _scrape_text_from_url(url: str) -> str:
         return ""
     try:
         headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3'}
-        response = requests.get(url, timeout=10, headers=headers)
+        response = _http_request('scrape', 'GET', url, headers=headers)
         response.raise_for_status()
         response.encoding = response.apparent_encoding
         soup = BeautifulSoup(response.text, 'html.parser')
@@ -851,10 +1931,14 @@ def _prefetch_questions_and_save(session_id: str, user_id: str, insights_md: str
     except Exception as e:
         print(f"❌ Error during question prefetch for session {session_id}: {e}")
 
-def _update_graph_cache(user_id: str):
+def _update_graph_cache(user_id: str, session_id: str = None, session_text: str = None):
+    """セッションが指定されていればその差分をマージし、なければグラフ全体を作り直す"""
     print(f"--- Triggered background graph update for user: {user_id} ---")
     try:
-        _get_graph_from_cache_or_generate(user_id, force_regenerate=True)
+        if session_id and session_text:
+            _merge_session_into_graph(user_id, session_id, session_text)
+        else:
+            _get_graph_from_cache_or_generate(user_id, force_regenerate=True)
         print(f"✅ Background graph update for user {user_id} completed.")
     except Exception as e:
         print(f"❌ Error during background graph update for user {user_id}: {e}")
@@ -882,12 +1966,31 @@ def _verify_token(request):
         return jsonify({"error": "Could not verify token"}), 500
 
 # --- Cloud Tasks ヘルパー関数 ---
-def _create_cloud_task(payload: dict, target_uri: str):
-    """Cloud TasksにHTTPタスクを作成する。"""
-    # 環境変数が設定されていない、またはクライアントが初期化されていない場合は何もしない
+def _get_tasks_client():
+    """Cloud Tasks クライアントを初回利用時に生成して返す。無効な場合は None。"""
+    global tasks_client
+    if tasks_client is None and tasks_enabled:
+        with _lazy_init_lock:
+            if tasks_client is None:
+                try:
+                    tasks_client = tasks_v2.CloudTasksClient()
+                    print(f"✅ Cloud Tasks client initialized. Queue: {GCP_TASK_QUEUE} in {GCP_TASK_QUEUE_LOCATION}")
+                except Exception as e:
+                    print(f"❌ Failed to initialize Cloud Tasks client, even though variables were set: {e}")
+                    traceback.print_exc()
+    return tasks_client
+
+def _create_cloud_task(payload: dict, target_uri: str, task_id: str = None, schedule_time: datetime = None):
+    """
+    Cloud TasksにHTTPタスクを作成する。
+    task_id を指定すると同じ名前のタスクは重複として作成されない。schedule_time を指定するとその時刻に実行される。
+    'created' / 'duplicate' / 'failed' / 'skipped' のいずれかを返す。
+    """
+    # 環境変数が設定されていない、またはクライアントが初期化できない場合は何もしない
+    tasks_client = _get_tasks_client()
     if not tasks_client:
         print("⚠️ Cloud Tasks is not configured. Skipping task creation.")
-        return
+        return 'skipped'
 
     parent = tasks_client.queue_path(project_id, GCP_TASK_QUEUE_LOCATION, GCP_TASK_QUEUE)
 
@@ -904,13 +2007,22 @@ def _create_cloud_task(payload: dict, target_uri: str):
             }
         }
     }
+    if task_id:
+        task["name"] = f"{parent}/tasks/{task_id}"
+    if schedule_time:
+        task["schedule_time"] = timestamp_pb2.Timestamp(seconds=int(schedule_time.timestamp()))
 
     try:
         response = tasks_client.create_task(parent=parent, task=task)
         print(f"✅ Created Cloud Task for {target_uri}. Task name: {response.name}")
+        return 'created'
+    except google_exceptions.AlreadyExists:
+        print(f"ℹ️ Cloud Task {task_id} for {target_uri} already exists.")
+        return 'duplicate'
     except Exception as e:
         print(f"❌ Failed to create Cloud Task for {target_uri}: {e}")
         traceback.print_exc()
+        return 'failed'
 
 
 
@@ -1012,13 +2124,78 @@ def record_swipe(session_id):
         return jsonify({"error": "Failed to record swipe"}), 500
 
 
+def _save_summary_and_schedule_tasks(session_ref, session_id, user_id, session_data, summary_data, current_turn):
+    """生成した要約をセッションと summaries/turn_N に保存し、後続のタスクを登録して、クライアントへのレスポンスを返す"""
+    update_data = {
+        'status': 'completed',
+        'title': summary_data.get('title'),
+        'latest_insights': summary_data.get('insights'),
+        'updated_at': firestore.SERVER_TIMESTAMP
+    }
+    session_ref.update(update_data)
+
+    summary_with_turn = summary_data.copy()
+    summary_with_turn['turn'] = current_turn
+    summary_ref = session_ref.collection('summaries').document(f'turn_{current_turn}')
+    summary_ref.set(summary_with_turn)
+
+    _update_insights_digest(user_id, session_id, session_data, summary_data)
+
+    response_data = summary_data.copy()
+    response_data['turn'] = current_turn
+    response_data['max_turns'] = MAX_TURNS
+
+    insights_text = summary_data.get('insights', '')
+
+    if current_turn < MAX_TURNS:
+        prefetch_payload = {
+            'session_id': session_id,
+            'user_id': user_id,
+            'insights_md': insights_text,
+            'current_turn': current_turn
+        }
+        _create_cloud_task(prefetch_payload, '/api/tasks/prefetch_questions')
+
+    _schedule_graph_update(user_id, session_id, f"## {summary_data.get('title', '無題')}\n{insights_text}")
+    _schedule_book_recommendations_update(user_id)
+    return response_data
+
+def _stream_summary_events(session_ref, session_id, user_id, session_data, topic, swipes_text, current_turn):
+    """post_summary のストリーミングモード。生成の途中経過を送り、完了後に保存してから 'done' を送る。"""
+    try:
+        summary_data = None
+        for kind, value in stream_summary_only(topic, swipes_text):
+            if kind == 'title':
+                yield _sse_event('title', {"title": value})
+            elif kind == 'insights':
+                yield _sse_event('insights', {"text": value})
+            elif kind == 'reset':
+                # 送った途中経過は使わず、'done' の結果で表示し直すようクライアントに伝える
+                yield _sse_event('reset', {})
+            else:
+                summary_data = value
+        if not summary_data:
+            raise ValueError("Summary generation returned no result")
+        response_data = _save_summary_and_schedule_tasks(session_ref, session_id, user_id, session_data, summary_data, current_turn)
+        yield _sse_event('done', response_data)
+    except Exception as e:
+        print(f"❌ Error while streaming summary for session {session_id}: {e}")
+        traceback.print_exc()
+        session_ref.update({'status': 'error', 'error_message': str(e)})
+        yield _sse_event('error', {"error": "Failed to generate summary"})
+
 @api_bp.route('/session/<string:session_id>/summary', methods=['POST'])
 def post_summary(session_id):
-    """セッションの要約を生成・保存し、結果を返す"""
+    """
+    セッションの要約を生成・保存し、結果を返す。
+    ?stream=true の場合は SSE で 'title' → 'insights' (追加分) → 'done' (保存済みの最終結果) の順にイベントを送る。
+    途中経過を取り消す必要がある場合 (英語の応答を作り直した場合など) は、'done' の前に 'reset' を送る。
+    """
     user_record = _verify_token(request)
     if not isinstance(user_record, dict):
         return user_record
     user_id = user_record['uid']
+    stream = request.args.get('stream', 'false').lower() == 'true'
 
     session_ref = None  # 変数をNoneで初期化
     try:
@@ -1037,12 +2214,17 @@ def post_summary(session_id):
         if not swipes_docs:
             print(f"No swipes found for session {session_id}, returning empty summary.")
             session_ref.update({'status': 'completed', 'title': '対話の記録がありません'})
-            return jsonify({
+            # sessions から作り直した場合と内容が一致するよう、記録のないセッションもダイジェストに加える
+            _update_insights_digest(user_id, session_id, session_data, {'title': '対話の記録がありません'})
+            empty_summary = {
                 "title": "対話の記録がありません",
                 "insights": "今回は対話の記録がなかったため、要約の作成をスキップしました。",
                 "turn": session_data.get('turn', 1),
                 "max_turns": MAX_TURNS
-            }), 200
+            }
+            if stream:
+                return _sse_response(iter([_sse_event('done', empty_summary)]))
+            return jsonify(empty_summary), 200
 
         questions_ref = session_ref.collection('questions')
         questions_docs = {q.id: q.to_dict() for q in questions_ref.stream()}
@@ -1056,41 +2238,12 @@ def post_summary(session_id):
             swipes_text_parts.append(f"- {q_text}: {answer_text}")
             
         swipes_text = "\n".join(swipes_text_parts)
-        
-        summary_data = generate_summary_only(topic, swipes_text)
 
-        update_data = {
-            'status': 'completed',
-            'title': summary_data.get('title'),
-            'latest_insights': summary_data.get('insights'),
-            'updated_at': firestore.SERVER_TIMESTAMP
-        }
-        session_ref.update(update_data)
+        if stream:
+            return _sse_response(_stream_summary_events(session_ref, session_id, user_id, session_data, topic, swipes_text, current_turn))
 
-        summary_with_turn = summary_data.copy()
-        summary_with_turn['turn'] = current_turn
-        summary_ref = session_ref.collection('summaries').document(f'turn_{current_turn}')
-        summary_ref.set(summary_with_turn)
-
-        response_data = summary_data.copy()
-        response_data['turn'] = session_data.get('turn', 1)
-        response_data['max_turns'] = MAX_TURNS
-
-        insights_text = summary_data.get('insights', '')
-        current_turn = response_data['turn']
-
-        if current_turn < MAX_TURNS:
-            prefetch_payload = {
-                'session_id': session_id,
-                'user_id': user_id,
-                'insights_md': insights_text,
-                'current_turn': current_turn
-            }
-            _create_cloud_task(prefetch_payload, '/api/tasks/prefetch_questions')
-
-        graph_payload = {'user_id': user_id}
-        _create_cloud_task(graph_payload, '/api/tasks/update_graph')
-        
+        summary_data = generate_summary_only(topic, swipes_text)
+        response_data = _save_summary_and_schedule_tasks(session_ref, session_id, user_id, session_data, summary_data, current_turn)
         return jsonify(response_data), 200
     except Exception as e:
         print(f"❌ Error in post_summary for session {session_id}: {e}")
@@ -1201,7 +2354,9 @@ def get_topic_suggestion():
             # 過去の対話がない場合は、空のリストを返す
             return jsonify({"suggestions": []}), 200
 
-        suggestions = generate_topic_suggestions(all_insights_text)
+        # ?refresh=true の場合は応答キャッシュを使わずに新しい提案を生成する
+        bypass_cache = request.args.get('refresh', 'false').lower() == 'true'
+        suggestions = generate_topic_suggestions(all_insights_text, bypass_cache=bypass_cache)
 
         print(f"✅ Generated {len(suggestions)} topic suggestions for user {user_id}.")
         return jsonify({"suggestions": suggestions}), 200
@@ -1211,6 +2366,14 @@ def get_topic_suggestion():
         traceback.print_exc()
         return jsonify({"error": "Failed to get topic suggestions"}), 500
 
+def _summary_etag(user_id: str, summary: dict):
+    """
+    返す集計結果そのものから ETag を作る。セッションの完了経路やダイジェストの作り直しに関係なく、
+    集計結果が変われば必ず ETag も変わる (304 で返せるのは本文の組み立てとシリアライズの分)。
+    """
+    topic_counts = sorted((item['topic'], item['count']) for item in summary.get('topic_counts', []))
+    return _make_etag('analysis_summary', user_id, json.dumps([summary.get('total_sessions'), topic_counts], ensure_ascii=False))
+
 @api_bp.route('/analysis/summary', methods=['GET'])
 def get_analysis_summary():
     """ユーザーの対話履歴の統計情報を返す"""
@@ -1231,10 +2394,11 @@ def get_analysis_summary():
         ]
 
         if not topics:
-            return jsonify({
+            empty_data = {
                 "total_sessions": 0,
                 "topic_counts": [], # ★ 変更: top_topicsから変更
-            }), 200
+            }
+            return _conditional_json(_summary_etag(user_id, empty_data), lambda: empty_data)
 
         # トピックごとの回数を集計
         topic_counts = Counter(topics)
@@ -1254,7 +2418,7 @@ def get_analysis_summary():
         }
         
         print(f"✅ Generated analysis summary for user {user_id}.")
-        return jsonify(response_data), 200
+        return _conditional_json(_summary_etag(user_id, response_data), lambda: response_data)
 
     except Exception as e:
         print(f"❌ Error in get_analysis_summary: {e}")
@@ -1274,15 +2438,15 @@ def get_book_recommendations():
         return jsonify({"error": "Book recommendation service is not configured."}), 500
 
     try:
-        cache_ref = db_firestore.collection('recommendation_cache').document(user_id)
-        cache_doc = cache_ref.get()
+        cached_data = _read_document_once('recommendation_cache', user_id)
 
-        if cache_doc.exists:
-            cached_data = cache_doc.to_dict()
+        if cached_data is not None:
             print(f"✅ Returning cached book recommendations for user: {user_id}")
-            return jsonify(cached_data.get("recommendations", [])), 200
+            etag = _make_etag('book_recommendations', user_id, cached_data.get('timestamp'))
+            return _conditional_json(etag, lambda: cached_data.get("recommendations", []))
         
         print(f"⚠️ No cached recommendations found for user {user_id}. Returning empty list for now.")
+        _schedule_book_recommendations_update(user_id)
         return jsonify([]), 200
 
     except Exception as e:
@@ -1296,7 +2460,7 @@ def search_books_from_api(keyword: str, api_key: str):
     books_found = []
     try:
         print(f"--- Calling Google Books API with keyword: {keyword} ---")
-        response = requests.get(books_api_url, timeout=10)
+        response = _http_request('google_books', 'GET', books_api_url)
         response.raise_for_status()
         search_results = response.json()
         
@@ -1332,11 +2496,10 @@ def _generate_book_recommendations(insights_text: str, api_key: str):
 # 検索キーワード:
 """
     try:
-        flash_model = os.getenv('GEMINI_FLASH_NAME', 'gemini-1.5-flash-preview-05-20')
         print("--- Calling Gemini to extract book search keywords ---")
         
         # ★ 修正: _call_gemini_with_schema を使ってJSON出力を強制する
-        keywords_dict = _call_gemini_with_schema(keyword_extraction_prompt, KEYWORDS_SCHEMA, flash_model)
+        keywords_dict = _call_gemini_cached(keyword_extraction_prompt, KEYWORDS_SCHEMA, GEMINI_FLASH_NAME, 'book_keywords')
         keywords = keywords_dict.get("keywords", [])
         
         print(f"✅ Extracted book search keywords: {keywords}")
@@ -1386,8 +2549,7 @@ def _generate_book_recommendations(insights_text: str, api_key: str):
             # ★★★ 修正: Ollama/Gemmaの処理を完全に削除し、Geminiの処理に一本化 ★★★
             print(f"--- Calling Vertex AI(Gemini) for book: {book['title']} ---")
             prompt = reason_generation_prompt_template.format(insights=insights_text, title=book["title"], author=book["author"])
-            flash_model = os.getenv('GEMINI_FLASH_NAME', 'gemini-2.5-flash-preview-05-20')
-            model = GenerativeModel(flash_model)
+            model = _get_generative_model(GEMINI_FLASH_NAME)
             response = model.generate_content(prompt)
             reason = response.text.strip()
             print(f"✅ Generated reason from Gemini: {reason[:50]}...")
@@ -1415,31 +2577,307 @@ def _generate_book_recommendations(insights_text: str, api_key: str):
 
     return {"recommendations": final_recommendations}
 
+# ===== Insights Digest =====
+# users/{uid}/sessions を毎回クエリする代わりに、ユーザーの対話履歴をユーザーごとに1ドキュメントへ集約する。
+# 履歴は3段階で保持し、プロンプトの長さが履歴の量に比例して増えないようにする:
+#   sessions     : 直近のセッションのサマリー全文 (INSIGHTS_RECENT_SESSIONS 件)
+#   briefs       : それより古いセッションを1件ずつ短く要約したもの (INSIGHTS_MAX_BRIEFS 件)
+#   profile      : さらに古い要約を畳み込んだ、上限付きのユーザープロファイル
+# 直近の枠からあふれたセッションは pending_fold に入り、/api/tasks/fold_insights で briefs / profile に畳み込まれる。
+INSIGHTS_DIGEST_COLLECTION = 'insights_digest'
+INSIGHTS_RECENT_SESSIONS = 3
+INSIGHTS_MAX_BRIEFS = 6
+INSIGHTS_BRIEF_MAX_CHARS = 300
+INSIGHTS_PROFILE_MAX_CHARS = 1200
+INSIGHTS_BACKFILL_SESSIONS = 10
+INSIGHTS_FOLD_WINDOW_SECONDS = int(os.getenv('INSIGHTS_FOLD_WINDOW_SECONDS', '300'))
+
+SESSION_BRIEF_PROMPT_TEMPLATE = """
+以下はユーザーとの過去の対話セッションの心理分析レポートです。
+後から参照するために、ユーザーの感情・関心事・課題・傾向が分かるよう、{max_chars}文字以内の日本語で要点だけをまとめてください。
+前置きや見出しは不要です。
+
+# セッション ({topic})
+### {title}
+{insights}
+"""
+
+PROFILE_FOLD_PROMPT_TEMPLATE = """
+あなたはユーザーの長期的な傾向を記録するカウンセラーです。
+「これまでのプロファイル」に「新たに加える過去セッションの要点」を統合し、ユーザーのプロファイルを更新してください。
+- 繰り返し現れる感情・関心事・課題・価値観を優先し、一度きりの細部は省いてください。
+- 変化が見られる点は「以前は〜だったが、〜」のように経過が分かるように書いてください。
+- 全体で{max_chars}文字以内の日本語で、前置きなしで出力してください。
+
+# これまでのプロファイル
+{profile}
+
+# 新たに加える過去セッションの要点
+{briefs}
+"""
+
+def _query_recent_completed_sessions(user_id: str, limit: int = INSIGHTS_BACKFILL_SESSIONS) -> list:
+    """ダイジェストの初期構築用に、直近の完了セッションを sessions コレクションから取得する"""
+    sessions_ref = db_firestore.collection('users').document(user_id).collection('sessions').where('status', '==', 'completed').order_by('created_at', direction=firestore.Query.DESCENDING).limit(limit)
+    entries = []
+    for session in sessions_ref.stream():
+        session_dict = session.to_dict()
+        entries.append({
+            'session_id': session.id,
+            'created_at': session_dict.get('created_at'),
+            'topic': session_dict.get('topic', '不明なトピック'),
+            'title': session_dict.get('title', '無題'),
+            'insights': session_dict.get('latest_insights', '分析結果がありません。'),
+        })
+    return entries
+
+def _sort_newest_first(entries: list) -> list:
+    return sorted(entries, key=lambda e: e.get('created_at') or datetime.min.replace(tzinfo=timezone.utc), reverse=True)
+
+def _session_label(entry: dict) -> str:
+    session_date = entry['created_at'].strftime('%Y-%m-%d') if entry.get('created_at') else "不明な日付"
+    return f"{session_date} - {entry.get('topic', '不明なトピック')}"
+
+def _format_insights_text(digest: dict) -> str:
+    """ダイジェストを、プロファイル → 過去セッションの要点 → 直近のセッション全文 の順のテキストにする"""
+    parts = []
+    if digest.get('profile'):
+        parts.append(f"## これまでの傾向 (要約)\n{digest['profile']}")
+    briefs = digest.get('briefs') or []
+    if briefs:
+        lines = [f"- ({_session_label(b)}) {b.get('title', '無題')}: {b.get('brief', '')}" for b in briefs]
+        parts.append("## 過去のセッションの要点\n" + "\n".join(lines))
+    # 畳み込み待ちのセッションは、要約されるまで全文のまま含める
+    for entry in _sort_newest_first((digest.get('sessions') or []) + (digest.get('pending_fold') or [])):
+        parts.append("\n".join([
+            f"## セッション記録 ({_session_label(entry)})",
+            f"### {entry.get('title', '無題')}\n{entry.get('insights', '分析結果がありません。')}"
+        ]))
+    return "\n\n".join(parts).strip()
+
+def _split_recent_sessions(entries: list):
+    """新しい順に並べ、直近の枠に収まるものと、畳み込みに回すものに分ける"""
+    entries = _sort_newest_first(entries)
+    return entries[:INSIGHTS_RECENT_SESSIONS], entries[INSIGHTS_RECENT_SESSIONS:]
+
+def _schedule_insights_fold(user_id: str):
+    """
+    畳み込みタスクを、ユーザーと時間枠から決まる名前で枠の終わりに実行されるよう登録する。
+    畳み込み待ちが残っている間に何度サマリーが作られても、1ユーザー・1枠あたりの畳み込みは1回になる。
+    """
+    task_id, run_at = _windowed_task_id('fold-insights', user_id, INSIGHTS_FOLD_WINDOW_SECONDS)
+    return _create_cloud_task({'user_id': user_id}, '/api/tasks/fold_insights', task_id=task_id, schedule_time=run_at)
+
+def _next_digest_version(previous) -> int:
+    """
+    ダイジェストの次の version。ミリ秒単位の現在時刻と「前回 + 1」の大きい方を使うため、
+    ダイジェストが削除されて作り直された場合でも、以前に発行した version より小さくならない。
+    """
+    return max(int(previous or 0) + 1, int(time.time() * 1000))
+
+def _merge_backfilled_sessions(user_id: str, digest: dict):
+    """
+    ダイジェストの sessions / pending_fold を sessions コレクションの直近の完了セッションで補い、(直近, 畳み込み待ち) を返す。
+    briefs にあるセッションと、それより古いセッション (profile に畳み込み済みの可能性がある) は補わない。
+    """
+    briefs = digest.get('briefs') or []
+    folded_ids = {b.get('session_id') for b in briefs}
+    newest_brief = max((b['created_at'] for b in briefs if isinstance(b.get('created_at'), datetime)), default=None)
+    entries = {e.get('session_id'): e for e in (digest.get('sessions') or []) + (digest.get('pending_fold') or [])}
+    for entry in _query_recent_completed_sessions(user_id):
+        if entry['session_id'] in folded_ids:
+            continue
+        if newest_brief and isinstance(entry.get('created_at'), datetime) and entry['created_at'] <= newest_brief:
+            continue
+        entries[entry['session_id']] = entry
+    return _split_recent_sessions(list(entries.values()))
+
+def _repair_insights_digest(user_id: str, digest: dict):
+    """
+    更新に失敗して needs_rebuild が付いたダイジェストの sessions / pending_fold を補って保存する。
+    profile と briefs はそのまま残す。ダイジェストが削除されていた場合は None を返す。
+    """
+    print(f"--- Repairing insights digest for user: {user_id} ---")
+
+    @firestore.transactional
+    def apply_repair(transaction, ref):
+        snapshot = ref.get(transaction=transaction)
+        current = snapshot.to_dict() if snapshot.exists else None
+        if not (current and isinstance(current.get('sessions'), list)):
+            return None
+        if not current.get('needs_rebuild'):
+            return current  # 並行した更新が先に補った
+        recent, overflow = _merge_backfilled_sessions(user_id, current)
+        repaired = {k: v for k, v in current.items() if k != 'needs_rebuild'}
+        repaired.update({'sessions': recent, 'pending_fold': overflow, 'version': _next_digest_version(current.get('version'))})
+        transaction.set(ref, {**repaired, 'updated_at': firestore.SERVER_TIMESTAMP})
+        return repaired
+
+    try:
+        repaired = apply_repair(db_firestore.transaction(), db_firestore.collection(INSIGHTS_DIGEST_COLLECTION).document(user_id))
+    except Exception as e:
+        print(f"⚠️ Insights digest for user {user_id} was not repaired: {e}")
+        recent, overflow = _merge_backfilled_sessions(user_id, digest)
+        return {**digest, 'sessions': recent, 'pending_fold': overflow}
+    _forget_document_read(INSIGHTS_DIGEST_COLLECTION, user_id)
+    if repaired and repaired.get('pending_fold'):
+        _schedule_insights_fold(user_id)
+    return repaired
+
+def _get_insights_digest(user_id: str) -> dict:
+    """
+    ユーザーのダイジェストを返す。
+    まだ存在しない場合は sessions コレクションから構築して保存する。needs_rebuild が付いている場合は補ってから返す。
+    """
+    digest = _read_document_once(INSIGHTS_DIGEST_COLLECTION, user_id)
+    if digest and isinstance(digest.get('sessions'), list):
+        if not digest.get('needs_rebuild'):
+            return digest
+        repaired = _repair_insights_digest(user_id, digest)
+        if repaired is not None:
+            return repaired
+
+    print(f"--- Building insights digest from sessions for user: {user_id} ---")
+    recent, overflow = _split_recent_sessions(_query_recent_completed_sessions(user_id))
+    digest = {'sessions': recent, 'pending_fold': overflow, 'briefs': [], 'profile': '', 'version': _next_digest_version(0)}
+    try:
+        # 並行して post_summary が作成した場合はそちらを優先する
+        db_firestore.collection(INSIGHTS_DIGEST_COLLECTION).document(user_id).create({**digest, 'updated_at': firestore.SERVER_TIMESTAMP})
+        if overflow:
+            _schedule_insights_fold(user_id)
+    except Exception as e:
+        print(f"⚠️ Insights digest for user {user_id} was not saved: {e}")
+    _forget_document_read(INSIGHTS_DIGEST_COLLECTION, user_id)
+    return digest
+
+def _update_insights_digest(user_id: str, session_id: str, session_data: dict, summary_data: dict):
+    """完了したセッションのサマリーでダイジェストを差分更新する (同じセッションの以前のエントリは置き換える)"""
+    digest_ref = db_firestore.collection(INSIGHTS_DIGEST_COLLECTION).document(user_id)
+    entry = {
+        'session_id': session_id,
+        'created_at': session_data.get('created_at') or datetime.now(timezone.utc),
+        'topic': session_data.get('topic', '不明なトピック'),
+        'title': summary_data.get('title') or '無題',
+        'insights': summary_data.get('insights') or '分析結果がありません。',
+    }
+
+    @firestore.transactional
+    def apply_update(transaction, ref):
+        snapshot = ref.get(transaction=transaction)
+        digest = snapshot.to_dict() if snapshot.exists else None
+        if not (digest and isinstance(digest.get('sessions'), list)):
+            recent, overflow = _split_recent_sessions(_query_recent_completed_sessions(user_id))
+            digest = {'sessions': recent, 'pending_fold': overflow, 'briefs': [], 'profile': '', 'version': 0}
+        elif digest.get('needs_rebuild'):
+            # 以前の更新に失敗したダイジェストは、取りこぼしたセッションを補ってから更新する (set で needs_rebuild も消える)
+            digest['sessions'], digest['pending_fold'] = _merge_backfilled_sessions(user_id, digest)
+
+        def others(entries):
+            return [e for e in (entries or []) if e.get('session_id') != session_id]
+
+        recent, overflow = _split_recent_sessions(others(digest['sessions']) + [entry])
+        update = {
+            'sessions': recent,
+            'pending_fold': _sort_newest_first(others(digest.get('pending_fold')) + overflow),
+            'briefs': others(digest.get('briefs')),
+            'profile': digest.get('profile', ''),
+            'version': _next_digest_version(digest.get('version')),
+            'updated_at': firestore.SERVER_TIMESTAMP,
+        }
+        transaction.set(ref, update)
+        return update
+
+    _forget_document_read(INSIGHTS_DIGEST_COLLECTION, user_id)
+    try:
+        update = apply_update(db_firestore.transaction(), digest_ref)
+        print(f"✅ Insights digest updated for user {user_id} (version {update['version']}).")
+        if update['pending_fold']:
+            _schedule_insights_fold(user_id)
+        return update['version']
+    except Exception as e:
+        print(f"❌ Failed to update insights digest for user {user_id}: {e}")
+        # 削除すると sessions から作り直す際に畳み込み済みの profile と briefs が失われるため、印だけを付けて
+        # 次の読み込み・更新で取りこぼしたセッションを補わせる (ダイジェストがまだなければ次の読み込みで構築される)
+        try:
+            digest_ref.update({'needs_rebuild': True})
+        except Exception as mark_error:
+            print(f"⚠️ Failed to mark insights digest for rebuild for user {user_id}: {mark_error}")
+        return None
+
+def _generate_condensed_text(prompt: str, max_chars: int) -> str:
+    model = _get_generative_model(GEMINI_FLASH_NAME)
+    text = model.generate_content(prompt).text.strip()
+    return text[:max_chars]
+
+def _fold_insights_digest(user_id: str) -> bool:
+    """
+    pending_fold のセッションを1件ずつ要点にまとめて briefs に加え、上限を超えた古い要点を profile に畳み込む。
+    LLM の呼び出しはトランザクションの外で行い、書き込み時に他の更新と競合していないかを確認する。
+    """
+    digest_ref = db_firestore.collection(INSIGHTS_DIGEST_COLLECTION).document(user_id)
+    snapshot = digest_ref.get()
+    if not snapshot.exists:
+        return False
+    digest = snapshot.to_dict() or {}
+    pending = digest.get('pending_fold') or []
+    if not pending:
+        return False
+
+    print(f"--- Folding {len(pending)} session(s) into insights profile for user: {user_id} ---")
+    new_briefs = []
+    for entry in pending:
+        prompt = SESSION_BRIEF_PROMPT_TEMPLATE.format(
+            max_chars=INSIGHTS_BRIEF_MAX_CHARS, topic=entry.get('topic', '不明なトピック'),
+            title=entry.get('title', '無題'), insights=entry.get('insights', ''))
+        new_briefs.append({
+            'session_id': entry.get('session_id'),
+            'created_at': entry.get('created_at'),
+            'topic': entry.get('topic', '不明なトピック'),
+            'title': entry.get('title', '無題'),
+            'brief': _generate_condensed_text(prompt, INSIGHTS_BRIEF_MAX_CHARS),
+        })
+
+    briefs = _sort_newest_first((digest.get('briefs') or []) + new_briefs)
+    profile = digest.get('profile', '')
+    if len(briefs) > INSIGHTS_MAX_BRIEFS:
+        briefs, to_fold = briefs[:INSIGHTS_MAX_BRIEFS], briefs[INSIGHTS_MAX_BRIEFS:]
+        prompt = PROFILE_FOLD_PROMPT_TEMPLATE.format(
+            max_chars=INSIGHTS_PROFILE_MAX_CHARS, profile=profile or "(まだありません)",
+            briefs="\n".join(f"- ({_session_label(b)}) {b.get('title', '無題')}: {b.get('brief', '')}" for b in reversed(to_fold)))
+        profile = _generate_condensed_text(prompt, INSIGHTS_PROFILE_MAX_CHARS)
+
+    folded_ids = {entry.get('session_id') for entry in pending}
+    base_briefs_ids = [b.get('session_id') for b in digest.get('briefs') or []]
+
+    @firestore.transactional
+    def apply_fold(transaction, ref):
+        current = ref.get(transaction=transaction).to_dict() or {}
+        if current.get('profile', '') != digest.get('profile', '') or [b.get('session_id') for b in current.get('briefs') or []] != base_briefs_ids:
+            # 別の畳み込みが先に反映された場合は、今回の結果を破棄する (未処理分は次回の畳み込みで扱う)
+            return None
+        remaining = [e for e in current.get('pending_fold') or [] if e.get('session_id') not in folded_ids]
+        version = _next_digest_version(current.get('version'))
+        transaction.update(ref, {
+            'pending_fold': remaining,
+            'briefs': briefs,
+            'profile': profile,
+            'version': version,
+            'updated_at': firestore.SERVER_TIMESTAMP,
+        })
+        return version
+
+    version = apply_fold(db_firestore.transaction(), digest_ref)
+    if version is None:
+        print(f"⚠️ Insights digest for user {user_id} changed while folding. Skipping this fold.")
+        return False
+    print(f"✅ Folded insights profile for user {user_id} (version {version}).")
+    return True
+
 def _get_all_insights_as_text(user_id: str) -> str:
-    """指定されたユーザーの全てのセッションサマリーをテキストとして結合する"""
-    print(f"--- Fetching all session insights for user: {user_id} ---")
-    all_insights_text = ""
+    """ユーザーの対話履歴 (プロファイル + 過去の要点 + 直近のセッション) をプロンプト用のテキストにする"""
+    print(f"--- Fetching insights digest for user: {user_id} ---")
     try:
-        # (★修正) セッションの参照パスをユーザーのサブコレクションに変更
-        sessions_ref = db_firestore.collection('users').document(user_id).collection('sessions').where('status', '==', 'completed').order_by('created_at', direction=firestore.Query.DESCENDING).limit(10)
-        sessions_docs = sessions_ref.stream()
-
-        for session in sessions_docs:
-            session_dict = session.to_dict()
-            # (★修正) created_at, topic, title, latest_insights を直接取得
-            session_date = session_dict.get("created_at").strftime('%Y-%m-%d') if session_dict.get("created_at") else "不明な日付"
-            session_topic = session_dict.get("topic", "不明なトピック")
-            title = session_dict.get('title', '無題')
-            insights = session_dict.get('latest_insights', '分析結果がありません。')
-            
-            summary_text_parts = [
-                f"## セッション記録 ({session_date} - {session_topic})",
-                f"### {title}\n{insights}"
-            ]
-            all_insights_text += "\n\n" + "\n".join(summary_text_parts)
-
-        print(f"✅ Found and compiled insights from past sessions.")
-        return all_insights_text.strip()
+        return _format_insights_text(_get_insights_digest(user_id))
     except Exception as e:
         print(f"❌ Error fetching insights for user {user_id}: {e}")
         return ""
@@ -1456,10 +2894,14 @@ def get_analysis_graph():
     try:
         # ★ 修正: リクエストの 'force' パラメータを読み取り、キャッシュをバイパスするか決定する
         force_regenerate = request.args.get('force', 'false').lower() == 'true'
-        graph_data = _get_graph_from_cache_or_generate(user_id, force_regenerate=force_regenerate)
+        # force の場合は下ですぐに実行される書籍推薦のタスクを登録するため、時間枠のタスクは登録させない
+        graph_data = _get_graph_from_cache_or_generate(user_id, force_regenerate=force_regenerate, schedule_books=not force_regenerate)
+        if force_regenerate:
+            # 書籍推薦は別タスクで並行して作り直す (グラフの応答は待たせない)
+            _schedule_book_recommendations_update(user_id, force=True)
         
         if graph_data and graph_data.get('nodes'): # ★ 修正: ノードが存在する場合のみデータを返す
-            return jsonify(graph_data), 200
+            return _conditional_json(_graph_etag('graph', user_id), lambda: graph_data)
         else:
             # 404を返すことで、フロントエンドが「データなし」と判断できるようにする
             return jsonify({"error": "No data available to generate graph"}), 404
@@ -1468,47 +2910,42 @@ def get_analysis_graph():
         traceback.print_exc()
         return jsonify({"error": "Failed to get analysis graph"}), 500
 
-def _get_graph_from_cache_or_generate(user_id: str, force_regenerate: bool = False):
-    """
-    Firestoreのキャッシュからグラフデータを取得する。
-    キャッシュがない場合やforce_regenerate=Trueの場合は、新たに生成してキャッシュに保存する。
-    """
-    cache_ref = db_firestore.collection('analysis_cache').document(user_id)
-    
-    if not force_regenerate:
-        cache_doc = cache_ref.get()
-        if cache_doc.exists:
-            cached_data = cache_doc.to_dict()
-            # 24時間以内であればキャッシュを返す
-            if datetime.now(timezone.utc) - cached_data.get('timestamp', datetime.min.replace(tzinfo=timezone.utc)) < timedelta(hours=24):
-                print(f"✅ Returning cached graph data for user: {user_id}")
-                # ★ 修正: 'graph_data' キーの値が存在すればそれを、なければNoneを返すように修正
-                return cached_data.get('graph_data')
+def _graph_etag(kind: str, user_id: str):
+    """analysis_cache の更新時刻から、グラフ (とそれから導かれる応答) の ETag を作る"""
+    cached_data = _read_document_once('analysis_cache', user_id) or {}
+    return _make_etag(kind, user_id, cached_data.get('timestamp'))
 
-    print(f"--- Generating new graph data for user: {user_id} (force_regenerate={force_regenerate}) ---")
-    all_insights_text = _get_all_insights_as_text(user_id)
-    if not all_insights_text:
-        return None
+# ===== ノードのベクトル =====
+# vector_embeddings のドキュメントIDと Vector Search のデータポイントIDは (ユーザー, 正規化したラベル) から決まるため、
+# グラフを作り直しても同じラベルは同じIDに上書きされる。グラフから外れたラベルのデータポイントは削除する。
+EMBEDDING_RECONCILE_WINDOW_SECONDS = int(os.getenv('EMBEDDING_RECONCILE_WINDOW_SECONDS', '3600'))
 
-    graph_data = generate_graph_data(all_insights_text)
+def _node_embedding_id(user_id: str, label) -> str:
+    """ユーザーとノードのラベルから決まる、vector_embeddings のドキュメントID (= Vector Search のデータポイントID)"""
+    user_hash = hashlib.sha256(user_id.encode('utf-8')).hexdigest()[:16]
+    label_hash = hashlib.sha256(_graph_label_key(label).encode('utf-8')).hexdigest()[:32]
+    return f"{user_hash}-{label_hash}"
 
-    # グラフデータがない、またはノードがない場合はここで終了
-    if not graph_data or not graph_data.get('nodes'):
-        print(f"No nodes found in graph data for user: {user_id}. Skipping embedding generation.")
-        # 新しいグラフデータ(空の可能性あり)をキャッシュに保存
-        cache_ref.set({
-            'graph_data': graph_data,
-            'timestamp': firestore.SERVER_TIMESTAMP,
-            'user_id': user_id
-        })
-        return graph_data
+def _vector_search_index_call(operation):
+    vector_search_region = os.getenv('GCP_VERTEX_AI_REGION', 'asia-northeast1')
+    index_resource_name = f"projects/{project_id}/locations/{vector_search_region}/indexes/{VECTOR_SEARCH_INDEX_ID}"
+    return _call_gcp_client(
+        'vector_search_index', index_resource_name,
+        lambda: aiplatform.MatchingEngineIndex(index_name=index_resource_name),
+        operation
+    )
 
+def _upsert_node_embeddings(user_id: str, nodes: list):
+    """グラフのノードをベクトル化し、ラベルから決まるIDで Firestore と Vector Search に上書き登録する"""
     try:
         print(f"--- Generating and upserting node embeddings for user: {user_id} ---")
 
-        # 1. グラフからノードのテキスト(ラベル)を抽出
-        nodes = graph_data.get('nodes', [])
-        node_texts = [node.get('id', '') for node in nodes]
+        # 1. グラフからノードのテキスト(ラベル)を抽出 (表記ゆれで同じIDになるものは1つにまとめる)
+        unique_nodes = {}
+        for node in nodes:
+            if _graph_label_key(node.get('id')):
+                unique_nodes.setdefault(_node_embedding_id(user_id, node.get('id')), node)
+        node_texts = [node.get('id', '') for node in unique_nodes.values()]
         
         if not node_texts:
             print(f"No node texts found to generate embeddings for user: {user_id}")
@@ -1516,17 +2953,16 @@ def _get_graph_from_cache_or_generate(user_id: str, force_regenerate: bool = Fal
             # 2. 全ノードのベクトルを一括生成
             node_embeddings = _get_embeddings(node_texts)
 
-            if node_embeddings and len(node_embeddings) == len(nodes):
+            if node_embeddings and len(node_embeddings) == len(unique_nodes):
                 datapoints_to_upsert = []
                 batch = db_firestore.batch()
 
-                for i, node in enumerate(nodes):
+                for (embedding_id, node), embedding in zip(unique_nodes.items(), node_embeddings):
                     node_label = node.get('id')
                     node_id = node.get('id') # ここではラベルをIDとして使う
-                    embedding = node_embeddings[i]
                     
-                    # a. Firestoreに保存するデータを作成し、バッチに追加
-                    embedding_ref = db_firestore.collection('vector_embeddings').document()
+                    # a. Firestoreに保存するデータを作成し、バッチに追加 (同じラベルのドキュメントは上書きされる)
+                    embedding_ref = db_firestore.collection('vector_embeddings').document(embedding_id)
                     batch.set(embedding_ref, {
                         'user_id': user_id,
                         'embedding': embedding,
@@ -1538,21 +2974,17 @@ def _get_graph_from_cache_or_generate(user_id: str, force_regenerate: bool = Fal
                     
                     # b. Vector SearchにUpsertするデータポイントを追加
                     datapoints_to_upsert.append({
-                        "datapoint_id": embedding_ref.id,
+                        "datapoint_id": embedding_id,
                         "feature_vector": embedding
                     })
 
                 # c. バッチ処理でFirestoreに一括書き込み
                 batch.commit()
-                print(f"✅ Saved {len(nodes)} node embeddings to Firestore for user: {user_id}")
+                print(f"✅ Saved {len(unique_nodes)} node embeddings to Firestore for user: {user_id}")
 
                 # d. Vector Search Index にベクトルを一括登録(Upsert)
                 if datapoints_to_upsert:
-                    vector_search_region = os.getenv('GCP_VERTEX_AI_REGION', 'asia-northeast1')
-                    index_resource_name = f"projects/{project_id}/locations/{vector_search_region}/indexes/{VECTOR_SEARCH_INDEX_ID}"
-                    vector_search_index = aiplatform.MatchingEngineIndex(index_name=index_resource_name)
-                    
-                    vector_search_index.upsert_datapoints(datapoints=datapoints_to_upsert)
+                    _vector_search_index_call(lambda index: index.upsert_datapoints(datapoints=datapoints_to_upsert))
                     print(f"✅ Upserted {len(datapoints_to_upsert)} datapoints to Vector Search for user: {user_id}")
             else:
                 print(f"⚠️ Failed to generate embeddings or count mismatch for user: {user_id}")
@@ -1560,32 +2992,456 @@ def _get_graph_from_cache_or_generate(user_id: str, force_regenerate: bool = Fal
     except Exception as e:
         print(f"❌ Error during node embedding generation/upsert: {e}")
         traceback.print_exc()
+
+def _delete_embedding_datapoints(user_id: str, embedding_ids: list):
+    """
+    Vector Search のデータポイントと vector_embeddings のドキュメントを削除する。
+    Vector Search からの削除に失敗した場合は、後で照合ジョブが見つけられるように Firestore 側を残す。
+    """
+    embedding_ids = list(dict.fromkeys(embedding_ids))
+    if not embedding_ids:
+        return 0
+    _vector_search_index_call(lambda index: index.remove_datapoints(datapoint_ids=embedding_ids))
+    for start in range(0, len(embedding_ids), FIRESTORE_BATCH_LIMIT):
+        batch = db_firestore.batch()
+        for embedding_id in embedding_ids[start:start + FIRESTORE_BATCH_LIMIT]:
+            batch.delete(db_firestore.collection('vector_embeddings').document(embedding_id))
+        batch.commit()
+    print(f"🧹 Removed {len(embedding_ids)} stale node embedding(s) for user: {user_id}")
+    return len(embedding_ids)
+
+def _remove_departed_node_embeddings(user_id: str, previous_nodes: list, nodes: list):
+    """previous_nodes にあって nodes にないラベルのベクトルを削除する"""
+    try:
+        remaining = {_graph_label_key(node.get('id')) for node in nodes}
+        departed_ids = [
+            _node_embedding_id(user_id, node.get('id')) for node in previous_nodes
+            if _graph_label_key(node.get('id')) and _graph_label_key(node.get('id')) not in remaining
+        ]
+        _delete_embedding_datapoints(user_id, departed_ids)
+    except Exception as e:
+        print(f"❌ Error removing departed node embeddings for user {user_id}: {e}")
+        traceback.print_exc()
+
+def _reconcile_node_embeddings(user_id: str) -> dict:
+    """
+    ユーザーの vector_embeddings を現在のグラフと突き合わせ、グラフにないドキュメント (ランダムIDで作られた古いものや、
+    外れたラベルのもの) とそのデータポイントを削除し、ベクトルのないノードを登録する。
+    """
+    cached_doc = db_firestore.collection('analysis_cache').document(user_id).get()
+    nodes = ((cached_doc.to_dict() or {}).get('graph_data') or {}).get('nodes', []) if cached_doc.exists else []
+    expected = {_node_embedding_id(user_id, node.get('id')): node for node in nodes if _graph_label_key(node.get('id'))}
+
+    existing_ids = [doc.id for doc in db_firestore.collection('vector_embeddings').where('user_id', '==', user_id).stream()]
+    orphan_ids = [embedding_id for embedding_id in existing_ids if embedding_id not in expected]
+    missing_nodes = [node for embedding_id, node in expected.items() if embedding_id not in set(existing_ids)]
+
+    removed = _delete_embedding_datapoints(user_id, orphan_ids)
+    if missing_nodes:
+        _upsert_node_embeddings(user_id, missing_nodes)
+    print(f"✅ Reconciled node embeddings for user {user_id}: removed {removed}, added {len(missing_nodes)}.")
+    return {'removed': removed, 'added': len(missing_nodes)}
+
+def _schedule_embedding_reconciliation_for_all_users():
+    """vector_embeddings にドキュメントを持つ全ユーザーについて、照合タスクを登録する"""
+    user_ids = {
+        (doc.to_dict() or {}).get('user_id')
+        for doc in db_firestore.collection('vector_embeddings').select(['user_id']).stream()
+    }
+    scheduled = 0
+    for user_id in sorted(uid for uid in user_ids if uid):
+        task_id, _ = _windowed_task_id('reconcile-embeddings', user_id, EMBEDDING_RECONCILE_WINDOW_SECONDS)
+        if _create_cloud_task({'user_id': user_id}, '/api/tasks/reconcile_embeddings', task_id=task_id) == 'created':
+            scheduled += 1
+    print(f"✅ Scheduled embedding reconciliation for {scheduled} user(s).")
+    return scheduled
+
+GRAPH_CACHE_TTL = timedelta(hours=24)
+GRAPH_REFRESH_DEDUP_WINDOW_SECONDS = int(os.getenv('GRAPH_REFRESH_DEDUP_WINDOW_SECONDS', '600'))
+_graph_cache_stats = Counter()  # 'fresh' | 'stale' | 'miss' | 'refresh_scheduled' | 'refresh_deduplicated' -> 回数
+
+def _record_graph_cache_status(status: str):
+    """グラフキャッシュの状態 (fresh / stale / miss) を記録し、レスポンスヘッダーで返せるようにする"""
+    _graph_cache_stats[status] += 1
+    if has_request_context():
+        g.graph_cache_status = status
+
+def _schedule_stale_graph_refresh(user_id: str):
+    """
+    期限切れのグラフを作り直すタスクを登録する。ユーザーと時間枠から決まる名前を使うため、
+    同じ時間枠に何度期限切れのキャッシュが読まれても、作り直しは1回だけになる。
+    """
+    task_id, _ = _windowed_task_id('refresh-graph', user_id, GRAPH_REFRESH_DEDUP_WINDOW_SECONDS)
+    result = _create_cloud_task({'user_id': user_id}, '/api/tasks/update_graph', task_id=task_id)
+    if result == 'created':
+        _graph_cache_stats['refresh_scheduled'] += 1
+    elif result == 'duplicate':
+        _graph_cache_stats['refresh_deduplicated'] += 1
+
+def _get_graph_from_cache_or_generate(user_id: str, force_regenerate: bool = False, schedule_books: bool = True):
+    """
+    Firestoreのキャッシュからグラフデータを取得する。
+    キャッシュが期限切れの場合は古いグラフをそのまま返し、作り直しはバックグラウンドのタスクに任せる (stale-while-revalidate)。
+    キャッシュがない場合やforce_regenerate=Trueの場合は、新たに生成してキャッシュに保存する。
+    呼び出し元が書籍推薦の更新を自分で登録する場合は、schedule_books=False で時間枠のタスクを登録しない。
+    """
+    cache_ref = db_firestore.collection('analysis_cache').document(user_id)
+    
+    if not force_regenerate:
+        cached_data = _read_document_once('analysis_cache', user_id)
+        if cached_data is not None:
+            # 24時間以内であればキャッシュを返す
+            if datetime.now(timezone.utc) - cached_data.get('timestamp', datetime.min.replace(tzinfo=timezone.utc)) < GRAPH_CACHE_TTL:
+                print(f"✅ Returning cached graph data for user: {user_id}")
+                _record_graph_cache_status('fresh')
+                # ★ 修正: 'graph_data' キーの値が存在すればそれを、なければNoneを返すように修正
+                return cached_data.get('graph_data')
+            if cached_data.get('graph_data'):
+                print(f"⚠️ Returning stale graph data for user: {user_id}. Refreshing in background.")
+                _record_graph_cache_status('stale')
+                _schedule_stale_graph_refresh(user_id)
+                return cached_data.get('graph_data')
+        _record_graph_cache_status('miss')
+
+    print(f"--- Generating new graph data for user: {user_id} (force_regenerate={force_regenerate}) ---")
+    # 読み込みを始める前の時刻を base_timestamp にする。これより前に更新待ちになったセッションは、要約がダイジェストに入っているため作り直しに含まれる
+    rebuild_started_at = datetime.now(timezone.utc)
+    all_insights_text = _get_all_insights_as_text(user_id)
+    if not all_insights_text:
+        return None
+    previous_nodes = ((_read_document_once('analysis_cache', user_id) or {}).get('graph_data') or {}).get('nodes', [])
+
+    graph_data = generate_graph_data(all_insights_text)
+    # 全体を作り直したグラフを、以降の差分マージの起点 (base_graph) にする
+    cache_fields = {
+        'base_graph': graph_data,
+        'base_timestamp': rebuild_started_at,
+        'session_graphs': [],
+    }
+
+    # グラフデータがない、またはノードがない場合はここで終了
+    if not graph_data or not graph_data.get('nodes'):
+        print(f"No nodes found in graph data for user: {user_id}. Skipping embedding generation.")
+        _remove_departed_node_embeddings(user_id, previous_nodes, [])
+        # 新しいグラフデータ(空の可能性あり)をキャッシュに保存
+        cache_ref.set({
+            'graph_data': graph_data,
+            'timestamp': firestore.SERVER_TIMESTAMP,
+            'user_id': user_id,
+            **cache_fields
+        })
+        _forget_document_read('analysis_cache', user_id)
+        _drop_graph_updates_covered_by_rebuild(user_id, rebuild_started_at)
+        return graph_data
+
+    _upsert_node_embeddings(user_id, graph_data.get('nodes', []))
+    _remove_departed_node_embeddings(user_id, previous_nodes, graph_data.get('nodes', []))
     
     # 新しいグラフデータをキャッシュに保存
     cache_ref.set({
         'graph_data': graph_data,
         'timestamp': firestore.SERVER_TIMESTAMP,
-        'user_id': user_id
+        'user_id': user_id,
+        **cache_fields
     })
+    _forget_document_read('analysis_cache', user_id)
+    _drop_graph_updates_covered_by_rebuild(user_id, rebuild_started_at)
     print(f"✅ Generated and cached new graph data for user: {user_id}")
 
-    # ★ 修正: このブロック全体のインデントを修正します
+    # 書籍推薦はグラフとは別のタスクで更新する (推薦の元になった対話履歴が変わっていなければタスク側でスキップされる)
+    if schedule_books:
+        _schedule_book_recommendations_update(user_id)
+
+    return graph_data
+
+# ===== グラフの差分マージ =====
+# セッションが完了するたびに全履歴から Pro でグラフを作り直す代わりに、そのセッションだけからノードとエッジを抽出して
+# キャッシュ済みのグラフにマージする。キャッシュには最後に全体を作り直したグラフ (base_graph) と、それ以降の
+# セッションごとの差分 (session_graphs) を保持し、graph_data は常に base_graph + 差分 から組み立てる。
+# 同じセッションの要約が再生成された場合は差分を置き換えるため、二重に加算されない。
+GRAPH_MAX_NODES = 15
+GRAPH_FULL_REBUILD_EVERY = int(os.getenv('GRAPH_FULL_REBUILD_EVERY', '5'))  # この件数の差分がたまったら全体を作り直す
+GRAPH_FULL_REBUILD_MAX_AGE = timedelta(days=7)
+
+def _graph_label_key(label) -> str:
+    """表記ゆれ (全角/半角、大文字/小文字、前後の空白) を吸収した、ノードの同一性判定用のキー"""
+    return unicodedata.normalize('NFKC', str(label or '')).strip().casefold()
+
+def _merge_graph_data(base: dict, additions: list, max_nodes: int = GRAPH_MAX_NODES) -> dict:
+    """
+    base のグラフに additions の各グラフをマージする。同じラベルのノードはサイズを、同じ向きのエッジは重みを合算し、
+    サイズの大きい順に max_nodes 個までのノードと、それらの間のエッジだけを残す。
+    """
+    nodes = {}   # ラベルキー -> ノード
+    edges = {}   # (始点キー, 終点キー) -> エッジ
+    for graph in [base] + list(additions):
+        for node in (graph or {}).get('nodes', []):
+            key = _graph_label_key(node.get('id'))
+            if not key:
+                continue
+            if key in nodes:
+                nodes[key]['size'] = nodes[key].get('size', 0) + node.get('size', 0)
+            else:
+                nodes[key] = {'id': node.get('id').strip(), 'type': node.get('type'), 'size': node.get('size', 0)}
+        for edge in (graph or {}).get('edges', []):
+            pair = (_graph_label_key(edge.get('source')), _graph_label_key(edge.get('target')))
+            if not all(pair) or pair[0] == pair[1]:
+                continue
+            if pair in edges:
+                edges[pair]['weight'] = edges[pair].get('weight', 0) + edge.get('weight', 0)
+            else:
+                edges[pair] = {'weight': edge.get('weight', 0)}
+
+    kept = sorted(nodes.items(), key=lambda item: item[1].get('size', 0), reverse=True)[:max_nodes]
+    kept_keys = {key for key, _ in kept}
+    return {
+        'nodes': [node for _, node in kept],
+        'edges': [
+            {'source': nodes[src]['id'], 'target': nodes[tgt]['id'], 'weight': edge['weight']}
+            for (src, tgt), edge in edges.items() if src in kept_keys and tgt in kept_keys
+        ],
+    }
+
+def generate_session_graph_data(session_text: str, existing_nodes: list):
+    """新しく完了したセッションだけから、既存のラベルを再利用したグラフの差分を抽出する"""
+    prompt = SESSION_GRAPH_PROMPT_TEMPLATE.format(
+        existing_nodes=", ".join(node.get('id', '') for node in existing_nodes) or "(なし)",
+        session_text=session_text)
     try:
-        if all_insights_text and GOOGLE_BOOKS_API_KEY:
-            print(f"--- Triggering background book recommendation update for user: {user_id} ---")
-            recommendations = _generate_book_recommendations(all_insights_text, GOOGLE_BOOKS_API_KEY)
-            if recommendations and recommendations.get("recommendations"):
-                reco_cache_ref = db_firestore.collection('recommendation_cache').document(user_id)
-                reco_cache_ref.set({
-                    'recommendations': recommendations.get("recommendations", []),
-                    'timestamp': firestore.SERVER_TIMESTAMP
-                })
-                print(f"✅ Background book recommendation update for user {user_id} completed.")
+        return _call_gemini_with_schema(prompt, GRAPH_SCHEMA, model_name=GEMINI_FLASH_NAME)
     except Exception as e:
-        print(f"❌ Error during background book recommendation update: {e}")
+        print(f"❌ Failed to generate session graph data: {e}")
+        return None
+
+def _needs_full_graph_rebuild(cached_data, session_ids: list) -> bool:
+    if not cached_data or not cached_data.get('base_graph') or not isinstance(cached_data.get('base_timestamp'), datetime):
+        return True
+    if datetime.now(timezone.utc) - cached_data['base_timestamp'] >= GRAPH_FULL_REBUILD_MAX_AGE:
+        return True
+    other_sessions = [g for g in cached_data.get('session_graphs') or [] if g.get('session_id') not in session_ids]
+    return len(other_sessions) + len(session_ids) > GRAPH_FULL_REBUILD_EVERY
 
+def _merge_sessions_into_graph(user_id: str, sessions: list):
+    """
+    完了したセッション ({'session_id', 'session_text'} と、キュー経由なら 'queued_at' のリスト) の差分をキャッシュ済みのグラフにまとめてマージする。
+    最後に全体を作り直した時点より前に更新待ちになったセッションは読み飛ばす。
+    キャッシュがない・古い・差分がたまっている場合は全体を作り直す。
+    """
+    cached_doc = db_firestore.collection('analysis_cache').document(user_id).get()
+    cached_data = cached_doc.to_dict() if cached_doc.exists else None
+    # base_timestamp 以前に更新待ちになったセッションは、最後の全体の作り直しに含まれているため加算しない
+    base_timestamp = (cached_data or {}).get('base_timestamp')
+    if isinstance(base_timestamp, datetime):
+        covered = {s['session_id'] for s in sessions if isinstance(s.get('queued_at'), datetime) and s['queued_at'] <= base_timestamp}
+        if covered:
+            print(f"⏭️ Skipping session(s) {', '.join(sorted(covered))} already included in the last full rebuild for user: {user_id}")
+            sessions = [s for s in sessions if s['session_id'] not in covered]
+            if not sessions:
+                return cached_data.get('graph_data')
+    session_ids = [session['session_id'] for session in sessions]
+    if _needs_full_graph_rebuild(cached_data, session_ids):
+        print(f"--- Full graph rebuild for user: {user_id} ---")
+        return _get_graph_from_cache_or_generate(user_id, force_regenerate=True)
+
+    print(f"--- Merging session(s) {', '.join(session_ids)} into graph for user: {user_id} ---")
+    base_graph = cached_data['base_graph']
+    current_nodes = (cached_data.get('graph_data') or {}).get('nodes', [])
+    session_graphs = list(cached_data.get('session_graphs') or [])
+    merged_any = False
+    for session in sessions:
+        session_graph = generate_session_graph_data(session['session_text'], current_nodes)
+        if not session_graph or not session_graph.get('nodes'):
+            print(f"⚠️ No nodes extracted for session {session['session_id']}. Skipping it.")
+            continue
+        session_graphs = [g for g in session_graphs if g.get('session_id') != session['session_id']]
+        session_graphs.append({'session_id': session['session_id'], 'graph': session_graph})
+        merged_any = True
+    if not merged_any:
+        print(f"⚠️ Nothing to merge for user {user_id}. Keeping cached graph.")
+        return cached_data.get('graph_data')
+
+    graph_data = _merge_graph_data(base_graph, [g['graph'] for g in session_graphs])
+
+    # 新たに現れたラベルだけをベクトル化する
+    known_labels = {_graph_label_key(node.get('id')) for node in current_nodes}
+    new_nodes = [node for node in graph_data['nodes'] if _graph_label_key(node.get('id')) not in known_labels]
+    if new_nodes:
+        _upsert_node_embeddings(user_id, new_nodes)
+    # ノード数の上限で押し出されたラベルのベクトルは削除する
+    _remove_departed_node_embeddings(user_id, current_nodes, graph_data['nodes'])
+
+    db_firestore.collection('analysis_cache').document(user_id).set({
+        'graph_data': graph_data,
+        'timestamp': firestore.SERVER_TIMESTAMP,
+        'user_id': user_id,
+        'base_graph': base_graph,
+        'base_timestamp': cached_data['base_timestamp'],
+        'session_graphs': session_graphs,
+    })
+    _forget_document_read('analysis_cache', user_id)
+    print(f"✅ Merged {len(sessions)} session(s) into graph for user {user_id} ({len(session_graphs)} incremental update(s) since last rebuild).")
     return graph_data
 
+def _merge_session_into_graph(user_id: str, session_id: str, session_text: str):
+    return _merge_sessions_into_graph(user_id, [{'session_id': session_id, 'session_text': session_text}])
+
+# ===== グラフ更新タスクの集約 =====
+# post_summary のたびにグラフ更新タスクを作る代わりに、更新待ちのセッションを graph_update_queue/{uid} に記録し、
+# ユーザーと時間枠から決まる名前のタスクを枠の終わりに実行されるよう登録する。同じ枠の2回目以降の登録は
+# Cloud Tasks に重複として拒否されるため、1ユーザー・1枠あたりのグラフ更新は最大1回になる。
+GRAPH_UPDATE_QUEUE_COLLECTION = 'graph_update_queue'
+GRAPH_UPDATE_WINDOW_SECONDS = int(os.getenv('GRAPH_UPDATE_WINDOW_SECONDS', '120'))
+_graph_update_stats = Counter()  # 'requested' | 'scheduled' | 'collapsed' | 'runs' | 'empty_runs' | 'sessions_merged' -> 回数
+
+def _windowed_task_id(prefix: str, user_id: str, window_seconds: int, now: float = None):
+    """(タスクID, 実行予定時刻) を返す。同じユーザー・同じ時間枠では同じIDになり、枠の終わりに実行される。"""
+    now = time.time() if now is None else now
+    window = int(now // window_seconds)
+    user_hash = hashlib.sha256(user_id.encode('utf-8')).hexdigest()[:16]
+    run_at = datetime.fromtimestamp((window + 1) * window_seconds, tz=timezone.utc)
+    return f"{prefix}-{user_hash}-{window}", run_at
+
+def _schedule_graph_update(user_id: str, session_id: str, session_text: str):
+    """セッションを更新待ちとして記録し、現在の時間枠のグラフ更新タスクを (まだなければ) 登録する"""
+    _increment_stat(_graph_update_stats, 'requested')
+    db_firestore.collection(GRAPH_UPDATE_QUEUE_COLLECTION).document(user_id).set({
+        'sessions': {session_id: {'session_text': session_text, 'queued_at': datetime.now(timezone.utc)}},
+        'updated_at': firestore.SERVER_TIMESTAMP,
+    }, merge=True)
+
+    task_id, run_at = _windowed_task_id('update-graph', user_id, GRAPH_UPDATE_WINDOW_SECONDS)
+    result = _create_cloud_task({'user_id': user_id, 'coalesced': True}, '/api/tasks/update_graph', task_id=task_id, schedule_time=run_at)
+    if result == 'duplicate':
+        _increment_stat(_graph_update_stats, 'collapsed')
+        print(f"♻️ Graph update for user {user_id} coalesced into task {task_id}.")
+    elif result == 'created':
+        _increment_stat(_graph_update_stats, 'scheduled')
+
+def _process_graph_update_queue(user_id: str):
+    """更新待ちのセッションをまとめてグラフにマージし、処理したものをキューから取り除く"""
+    _increment_stat(_graph_update_stats, 'runs')
+    queue_ref = db_firestore.collection(GRAPH_UPDATE_QUEUE_COLLECTION).document(user_id)
+    queue_doc = queue_ref.get()
+    queued = (queue_doc.to_dict() or {}).get('sessions', {}) if queue_doc.exists else {}
+    if not queued:
+        _increment_stat(_graph_update_stats, 'empty_runs')
+        print(f"No pending graph updates for user {user_id}. Already processed by an earlier task.")
+        return None
+
+    sessions = sorted(
+        ({'session_id': sid, **entry} for sid, entry in queued.items()),
+        key=lambda e: e.get('queued_at') or datetime.min.replace(tzinfo=timezone.utc))
+    graph_data = _merge_sessions_into_graph(user_id, sessions)
+    _increment_stat(_graph_update_stats, 'sessions_merged', len(sessions))
+
+    @firestore.transactional
+    def remove_processed(transaction, ref):
+        current = (ref.get(transaction=transaction).to_dict() or {}).get('sessions', {})
+        # 処理中に同じセッションが再登録された場合は、次の更新で扱うために残す
+        processed = {
+            f"sessions.`{s['session_id']}`": firestore.DELETE_FIELD
+            for s in sessions if (current.get(s['session_id']) or {}).get('queued_at') == s.get('queued_at')
+        }
+        if processed:
+            transaction.update(ref, processed)
+
+    remove_processed(db_firestore.transaction(), queue_ref)
+    return graph_data
+
+def _drop_graph_updates_covered_by_rebuild(user_id: str, base_timestamp: datetime):
+    """
+    全体の作り直しに含まれたセッション (base_timestamp 以前に更新待ちになったもの) をキューから取り除く。
+    残しておくと、後の差分マージで作り直し後の base_graph に同じセッションが二重に加算される。
+    """
+    queue_ref = db_firestore.collection(GRAPH_UPDATE_QUEUE_COLLECTION).document(user_id)
+
+    @firestore.transactional
+    def remove_covered(transaction, ref):
+        snapshot = ref.get(transaction=transaction)
+        current = (snapshot.to_dict() or {}).get('sessions', {}) if snapshot.exists else {}
+        covered = {
+            f"sessions.`{sid}`": firestore.DELETE_FIELD
+            for sid, entry in current.items()
+            if isinstance((entry or {}).get('queued_at'), datetime) and entry['queued_at'] <= base_timestamp
+        }
+        if covered:
+            transaction.update(ref, covered)
+        return len(covered)
+
+    try:
+        dropped = remove_covered(db_firestore.transaction(), queue_ref)
+    except Exception as e:
+        # 取り除けなかったセッションは、差分マージ側で base_timestamp と比べて読み飛ばされる
+        print(f"⚠️ Failed to drop queued graph updates covered by the rebuild for user {user_id}: {e}")
+        return
+    if dropped:
+        print(f"🧹 Dropped {dropped} queued graph update(s) covered by the rebuild for user {user_id}.")
+
+@_reports_stats('graph_updates')
+def _graph_update_stats_snapshot() -> dict:
+    """グラフ更新の要求数と、集約によって省かれたタスク数を返す"""
+    with _stats_lock:
+        snapshot = dict(_graph_update_stats)
+    requested = snapshot.get('requested', 0)
+    snapshot['collapsed_ratio'] = snapshot.get('collapsed', 0) / requested if requested else 0.0
+    return snapshot
+
+# ===== 書籍推薦の更新 =====
+# 書籍推薦 (キーワード抽出 + Google Books + 推薦理由の生成) はグラフの生成とは独立したタスクで更新する。
+# recommendation_cache には推薦の元になったダイジェストの version を保存し、対話履歴が変わっていなければ作り直さない。
+BOOK_UPDATE_WINDOW_SECONDS = int(os.getenv('BOOK_UPDATE_WINDOW_SECONDS', '300'))
+_book_update_stats = Counter()  # 'scheduled' | 'collapsed' | 'updated' | 'up_to_date' | 'empty' -> 回数
+
+def _schedule_book_recommendations_update(user_id: str, force: bool = False):
+    """
+    書籍推薦の更新タスクを登録する。通常は時間枠ごとに1つのタスクに集約し、
+    force=True (ユーザーが明示的に更新を求めた場合) はすぐに実行される別のタスクとして登録する。
+    """
+    if force:
+        _create_cloud_task({'user_id': user_id, 'force': True}, '/api/tasks/update_book_recommendations')
+        _book_update_stats['scheduled'] += 1
+        return
+    task_id, run_at = _windowed_task_id('update-books', user_id, BOOK_UPDATE_WINDOW_SECONDS)
+    result = _create_cloud_task({'user_id': user_id}, '/api/tasks/update_book_recommendations', task_id=task_id, schedule_time=run_at)
+    if result == 'duplicate':
+        _book_update_stats['collapsed'] += 1
+    elif result == 'created':
+        _book_update_stats['scheduled'] += 1
+
+def _update_book_recommendations(user_id: str, force: bool = False):
+    """ダイジェストが推薦の作成時から更新されていれば、書籍推薦を作り直して recommendation_cache に保存する"""
+    if not GOOGLE_BOOKS_API_KEY:
+        print("⚠️ Google Books API key is not configured. Skipping book recommendation update.")
+        return None
+    digest = _get_insights_digest(user_id)
+    insights_version = digest.get('version')
+    all_insights_text = _format_insights_text(digest)
+    if not all_insights_text:
+        _book_update_stats['empty'] += 1
+        return None
+
+    reco_cache_ref = db_firestore.collection('recommendation_cache').document(user_id)
+    cached = reco_cache_ref.get()
+    if not force and cached.exists and (cached.to_dict() or {}).get('insights_version') == insights_version:
+        _book_update_stats['up_to_date'] += 1
+        print(f"✅ Book recommendations for user {user_id} are up to date (insights version {insights_version}).")
+        return None
+
+    print(f"--- Updating book recommendations for user: {user_id} (insights version {insights_version}) ---")
+    recommendations = _generate_book_recommendations(all_insights_text, GOOGLE_BOOKS_API_KEY)
+    if not recommendations or not recommendations.get("recommendations"):
+        print(f"⚠️ No book recommendations generated for user {user_id}. Keeping the cached ones.")
+        return None
+    reco_cache_ref.set({
+        'recommendations': recommendations.get("recommendations", []),
+        'insights_version': insights_version,
+        'timestamp': firestore.SERVER_TIMESTAMP
+    })
+    _forget_document_read('recommendation_cache', user_id)
+    _book_update_stats['updated'] += 1
+    print(f"✅ Book recommendation update for user {user_id} completed.")
+    return recommendations.get("recommendations")
+
 @api_bp.route('/home/suggestion', methods=['GET'])
 def get_home_suggestion():
     """ホーム画面に表示する、過去の対話に基づく提案を返す"""
@@ -1629,7 +3485,7 @@ def get_home_suggestion():
             "nodeLabel": node_label
         }
         print(f"✅ Sending suggestion: {response_data}")
-        return jsonify(response_data), 200
+        return _conditional_json(_graph_etag('home_suggestion', user_id), lambda: response_data)
 
     except Exception as e:
         print(f"❌ Error in get_home_suggestion: {e}")
@@ -1681,8 +3537,7 @@ def get_proactive_suggestion():
 キーワード: {graph_keywords}
 検索クエリ:"""
         
-        flash_model = os.getenv('GEMINI_FLASH_NAME', 'gemini-1.5-flash-preview-05-20')
-        model = GenerativeModel(flash_model)
+        model = _get_generative_model(GEMINI_FLASH_NAME)
         search_query = model.generate_content(search_query_prompt).text.strip()
         print(f"Generated search query: {search_query}")
 
@@ -1713,8 +3568,6 @@ def get_proactive_suggestion():
    - `nodeLabel`: 'AIからの提案' という固定文字列
    - `nodeId`: 'proactive_suggestion' という固定文字列
 """
-        
-        pro_model = os.getenv('GEMINI_PRO_NAME', 'gemini-1.5-pro-preview-05-20')
         response_json = _call_gemini_with_schema(
             final_prompt,
             schema={
@@ -1727,7 +3580,7 @@ def get_proactive_suggestion():
                 },
                 "required": ["initialSummary", "actions", "nodeLabel", "nodeId"]
             },
-            model_name=pro_model
+            model_name=GEMINI_PRO_NAME
         )
 
         print(f"✅ Sending proactive suggestion: {response_json}")
@@ -1849,6 +3702,80 @@ def post_chat_message():
         traceback.print_exc()
         return jsonify({"error": "Failed to process chat message"}), 500
 
+def _sse_event(event: str, data: dict) -> str:
+    """Server-Sent Events の1イベント分の文字列を組み立てる"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def _sse_response(events) -> Response:
+    response = Response(stream_with_context(events), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # プロキシでのバッファリングを無効にし、断片をすぐにクライアントへ届ける
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@api_bp.route('/analysis/chat/stream', methods=['POST'])
+def post_chat_message_stream():
+    """
+    /analysis/chat のストリーミング版。Gemini の応答を 'chunk' イベントとして逐次送り、
+    最後に全文と参照元を含む 'done' イベントを送る。失敗時は 'error' イベントで終了する。
+    """
+    user_record = _verify_token(request)
+    if not isinstance(user_record, dict):
+        return user_record
+
+    data = request.get_json()
+    if not data:
+        return jsonify({"error": "Invalid request: no data provided"}), 400
+
+    chat_history = data.get('chat_history', [])
+    message = data.get('message')
+    use_rag = data.get('use_rag', False)
+    rag_type = data.get('rag_type')
+    user_id = user_record['uid']
+
+    if not message:
+        return jsonify({"error": "Invalid request: 'message' is required"}), 400
+
+    try:
+        if use_rag:
+            # RAG はバックグラウンドタスクで実行されるため、中間応答を 'done' イベントとしてすぐに返す
+            print(f"--- Triggering RAG task (type: {rag_type}) for user: {user_id} (stream) ---")
+            request_id = str(uuid.uuid4())
+            _create_cloud_task({
+                'user_id': user_id,
+                'request_id': request_id,
+                'chat_history': chat_history,
+                'message': message,
+                'rag_type': rag_type,
+            }, '/api/tasks/execute_rag')
+            done = {
+                "response": "承知しました。関連情報を探してきますので、少々お待ちください...",
+                "request_id": request_id,
+                "sources": []
+            }
+            return _sse_response(iter([_sse_event('done', done)]))
+
+        print(f"--- Received chat message from user: {user_id} (stream) ---")
+        session_summary_text = _get_all_insights_as_text(user_id) or ""
+    except Exception as e:
+        print(f"❌ Error in post_chat_message_stream: {e}")
+        traceback.print_exc()
+        return jsonify({"error": "Failed to process chat message"}), 500
+
+    def generate_events():
+        parts = []
+        try:
+            for text in stream_chat_response(session_summary_text, chat_history, message):
+                parts.append(text)
+                yield _sse_event('chunk', {"text": text})
+            yield _sse_event('done', {"response": "".join(parts).strip(), "sources": []})
+        except Exception as e:
+            print(f"❌ Error while streaming chat response: {e}")
+            traceback.print_exc()
+            yield _sse_event('error', {"error": "Failed to process chat message"})
+
+    return _sse_response(generate_events())
+
 @api_bp.route('/tasks/execute_rag', methods=['POST'])
 def handle_execute_rag():
     try:
@@ -1948,12 +3875,14 @@ def get_home_suggestion_v2():
 
         # 2. Vertex AI Vector Search で近傍探索
         endpoint_resource_name = f"projects/{project_id}/locations/{vector_search_region}/indexEndpoints/{VECTOR_SEARCH_ENDPOINT_ID}"
-        my_index_endpoint = aiplatform.MatchingEngineIndexEndpoint(index_endpoint_name=endpoint_resource_name)
-
-        response = my_index_endpoint.find_neighbors(
-            queries=[latest_embedding],
-            num_neighbors=5, # 自分自身が含まれる可能性があるので多めに取得
-            deployed_index_id=VECTOR_SEARCH_DEPLOYED_INDEX_ID
+        response = _call_gcp_client(
+            'vector_search_index_endpoint', endpoint_resource_name,
+            lambda: aiplatform.MatchingEngineIndexEndpoint(index_endpoint_name=endpoint_resource_name),
+            lambda index_endpoint: index_endpoint.find_neighbors(
+                queries=[latest_embedding],
+                num_neighbors=5, # 自分自身が含まれる可能性があるので多めに取得
+                deployed_index_id=VECTOR_SEARCH_DEPLOYED_INDEX_ID
+            )
         )
 
         if not response or not response[0]:
@@ -2029,6 +3958,40 @@ def handle_prefetch_questions():
         # Cloud Tasksがリトライしないように 200 OK を返す
         return "Error processing task, but acknowledging to prevent retry", 200
 
+@api_bp.route('/tasks/fold_insights', methods=['POST'])
+def handle_fold_insights():
+    """Cloud Tasksから呼び出される、古いセッションをプロファイルに畳み込むタスク"""
+    try:
+        data = request.get_json()
+        if not data or 'user_id' not in data:
+            print(f"Task handler missing user_id: {data}")
+            return "user_id is required", 400
+
+        _fold_insights_digest(data['user_id'])
+        return "Successfully processed fold insights task", 200
+    except Exception as e:
+        print(f"❌ Error in /tasks/fold_insights: {e}")
+        traceback.print_exc()
+        # Cloud Tasksがリトライしないように 200 OK を返す
+        return "Error processing task, but acknowledging to prevent retry", 200
+
+@api_bp.route('/tasks/update_book_recommendations', methods=['POST'])
+def handle_update_book_recommendations():
+    """Cloud Tasksから呼び出される、書籍推薦を更新するタスク"""
+    try:
+        data = request.get_json()
+        if not data or 'user_id' not in data:
+            print(f"Task handler missing user_id: {data}")
+            return "user_id is required", 400
+
+        _update_book_recommendations(data['user_id'], force=bool(data.get('force')))
+        return "Successfully processed book recommendation task", 200
+    except Exception as e:
+        print(f"❌ Error in /tasks/update_book_recommendations: {e}")
+        traceback.print_exc()
+        # Cloud Tasksがリトライしないように 200 OK を返す
+        return "Error processing task, but acknowledging to prevent retry", 200
+
 @api_bp.route('/tasks/update_graph', methods=['POST'])
 def handle_update_graph():
     """Cloud Tasksから呼び出される、分析グラフを更新するタスク"""
@@ -2039,14 +4002,41 @@ def handle_update_graph():
             return "user_id is required", 400
         
         user_id = data['user_id']
-        _update_graph_cache(user_id)
+        if data.get('coalesced'):
+            _process_graph_update_queue(user_id)
+        else:
+            _update_graph_cache(user_id, data.get('session_id'), data.get('session_text'))
         return "Successfully processed graph update task", 200
     except Exception as e:
         print(f"❌ Error in /tasks/update_graph: {e}")
         traceback.print_exc()
         return "Error processing task, but acknowledging to prevent retry", 200
 
+@api_bp.route('/tasks/reconcile_embeddings', methods=['POST'])
+def handle_reconcile_embeddings():
+    """
+    Cloud Tasks (user_id 指定) または Cloud Scheduler (指定なし) から呼び出される、ノードのベクトルの照合タスク。
+    user_id がない場合は、ベクトルを持つユーザーごとの照合タスクを登録する。
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        if data.get('user_id'):
+            _reconcile_node_embeddings(data['user_id'])
+        else:
+            _schedule_embedding_reconciliation_for_all_users()
+        return "Successfully processed embedding reconciliation task", 200
+    except Exception as e:
+        print(f"❌ Error in /tasks/reconcile_embeddings: {e}")
+        traceback.print_exc()
+        # Cloud Tasksがリトライしないように 200 OK を返す
+        return "Error processing task, but acknowledging to prevent retry", 200
+
 app.register_blueprint(api_bp)
 
+_import_report = _import_cost_report()
+print(f"📦 Startup import report: eager imports {_import_report['eager_imports_ms']}ms, "
+      f"module init {(time.perf_counter() - _STARTUP_STARTED_AT) * 1000:.0f}ms, "
+      f"deferred: {', '.join(_import_report['deferred']) or 'none'}")
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=int(os.environ.get('PORT', 8080)), debug=True)
\ No newline at end of file
@@ -3,6 +3,9 @@ from gateway.main import app as flask_app
 import gateway.main  # モックの呼び出し検証のために追加
 import json
 import copy
+import threading
+from collections import Counter
+import numpy as np
 from unittest.mock import Mock, MagicMock, patch # ★★★ 修正: MagicMockを追加 ★★★
 from datetime import datetime, timezone, timedelta # ★★★ 修正: timedeltaを追加 ★★★
 import firebase_admin # ★★★ firebase_adminをインポート ★★★
@@ -63,6 +66,39 @@ def client(app):
     """A test client for the app."""
     return app.test_client()
 
+@pytest.fixture(autouse=True)
+def reset_process_caches():
+    """プロセス内で共有されるモデル・クライアントのキャッシュを、テストごとにリセットする"""
+    gateway.main._generative_models.clear()
+    gateway.main._embedding_models.clear()
+    gateway.main._http_sessions.clear()
+    gateway.main._http_request_counts.clear()
+    gateway.main._gcp_clients.clear()
+    gateway.main._gcp_client_stats.clear()
+    gateway.main._llm_response_cache.clear()
+    gateway.main._llm_cache_stats.clear()
+    gateway.main._language_check_stats.clear()
+    gateway.main._graph_update_stats.clear()
+    gateway.main._book_update_stats.clear()
+    gateway.main._graph_cache_stats.clear()
+    gateway.main._embedding_cache.clear()
+    gateway.main._embedding_cache_stats.clear()
+    yield
+    gateway.main._generative_models.clear()
+    gateway.main._embedding_models.clear()
+    gateway.main._http_sessions.clear()
+    gateway.main._http_request_counts.clear()
+    gateway.main._gcp_clients.clear()
+    gateway.main._gcp_client_stats.clear()
+    gateway.main._llm_response_cache.clear()
+    gateway.main._llm_cache_stats.clear()
+    gateway.main._language_check_stats.clear()
+    gateway.main._graph_update_stats.clear()
+    gateway.main._book_update_stats.clear()
+    gateway.main._graph_cache_stats.clear()
+    gateway.main._embedding_cache.clear()
+    gateway.main._embedding_cache_stats.clear()
+
 def test_index_route(client):
     """Test the index route."""
     response = client.get('/api/')
@@ -85,14 +121,19 @@ def test_cloud_tasks_initialization_success(mocker):
     }
     mocker.patch.dict('os.environ', mock_env)
     
-    # CloudTasksClientのコンストラクタ自体をモック
-    mock_tasks_client = mocker.patch('gateway.main.tasks_v2.CloudTasksClient')
+    # CloudTasksClientのコンストラクタ自体をモック (遅延インポートされる実モジュール側をパッチする)
+    mock_tasks_client = mocker.patch('google.cloud.tasks_v2.CloudTasksClient')
 
     # mainモジュールを再読み込みして、トップレベルのコードを実行させる
     with patch('gateway.main.print') as mock_print:
         import importlib
         importlib.reload(gateway.main)
-        
+
+        # クライアントは import 時には生成されず、初回利用時に生成される
+        mock_tasks_client.assert_not_called()
+        assert gateway.main._get_tasks_client() is mock_tasks_client.return_value
+        assert gateway.main._get_tasks_client() is mock_tasks_client.return_value
+
         # 初期化成功のログが出力されたことを確認
         mock_tasks_client.assert_called_once()
         mock_print.assert_any_call("✅ Cloud Tasks client initialized. Queue: test-queue in test-location")
@@ -114,14 +155,16 @@ def test_cloud_tasks_initialization_exception(mocker):
     mocker.patch.dict('os.environ', mock_env)
     
     # CloudTasksClientのコンストラクタが例外を投げるようにモック
-    mocker.patch('gateway.main.tasks_v2.CloudTasksClient', side_effect=Exception("Test Exception"))
+    mocker.patch('google.cloud.tasks_v2.CloudTasksClient', side_effect=Exception("Test Exception"))
     mocker.patch('traceback.print_exc') # traceback.print_excもモックしておく
 
     # mainモジュールを再読み込み
     with patch('gateway.main.print') as mock_print:
         import importlib
         importlib.reload(gateway.main)
-        
+
+        assert gateway.main._get_tasks_client() is None
+
         # 初期化失敗のログが出力されたことを確認
         mock_print.assert_any_call("❌ Failed to initialize Cloud Tasks client, even though variables were set: Test Exception")
 
@@ -299,9 +342,10 @@ def test_post_summary_success(client, mocker):
 
     assert response.status_code == 200, f"API failed: {response.get_data(as_text=True)}"
     
-    # Cloud Tasksの作成関数が2回呼ばれたことを確認
-    # 1回目: 質問のプリフェッチ, 2回目: グラフの更新
-    assert mock_create_task.call_count == 2
+    # Cloud Tasksの作成関数が3回呼ばれたことを確認
+    # 1回目: 質問のプリフェッチ, 2回目: グラフの更新, 3回目: 書籍推薦の更新
+    assert mock_create_task.call_count == 3
+    assert [c.args[1] for c in mock_create_task.call_args_list] == ['/api/tasks/prefetch_questions', '/api/tasks/update_graph', '/api/tasks/update_book_recommendations']
 
 
 def test_start_session_auth_error(client, mocker):
@@ -1242,12 +1286,12 @@ def test_get_embeddings_success(mock_text_embedding_model):
     # model.get_embeddings([{"text": t} for t in batch]) の形式を模倣
     mock_embedding = MagicMock()
     mock_embedding.values = [0.1, 0.2]
-    mock_text_embedding_model.get_embeddings.return_value = [mock_embedding]
+    mock_text_embedding_model.get_embeddings.side_effect = lambda batch: [mock_embedding] * len(batch)
 
     embeddings = gateway.main._get_embeddings(["text1", "text2"])
     
-    assert len(embeddings) == 1
-    assert embeddings[0] == [0.1, 0.2]
+    assert len(embeddings) == 2
+    assert embeddings[0] == pytest.approx([0.1, 0.2])  # キャッシュには float32 で保持する
     mock_text_embedding_model.get_embeddings.assert_called()
 
 def test_get_embeddings_empty_input():
@@ -1298,9 +1342,14 @@ def test_get_cached_chunks_and_embeddings(mocker):
     mock_doc_ref.get.return_value = mock_doc_snapshot
     mocker.patch('gateway.main._get_url_cache_doc_ref', return_value=mock_doc_ref)
 
+    mock_thread = mocker.patch('gateway.main.threading.Thread')
+
     chunks, embeddings = gateway.main._get_cached_chunks_and_embeddings("http://example.com")
     assert chunks == ['chunk1']
-    assert embeddings == [[0.1]]
+    # 旧形式のキャッシュも行列として読み込み、新しい形式への書き換えを予約する
+    assert embeddings.shape == (1, 1)
+    assert embeddings[0][0] == pytest.approx(0.1)
+    assert mock_thread.call_args.kwargs['target'] == gateway.main._migrate_legacy_rag_cache
 
 
 def test_get_cached_chunks_and_embeddings_not_found(mocker):
@@ -1326,7 +1375,9 @@ def test_set_cached_chunks_and_embeddings(mocker):
     mock_doc_ref.set.assert_called_once()
     set_data = mock_doc_ref.set.call_args[0][0]
     assert set_data['chunks'] == ["chunk1"]
-    assert set_data['embeddings'] == [{'vector': [0.1]}]
+    assert 'embeddings' not in set_data
+    assert set_data['vector_encoding'] == gateway.main.RAG_CACHE_VECTOR_ENCODING
+    assert gateway.main._decode_vectors(set_data)[0][0] == pytest.approx(0.1, abs=1e-3)
     # ★★★ 修正: フィールド名を'cached_at'に修正 ★★★
     assert 'cached_at' in set_data
 
@@ -1348,7 +1399,7 @@ def test_search_with_vertex_ai_search(mocker):
 
 def test_scrape_text_from_url_success(mocker):
     """_scrape_text_from_url: 正常系のテスト"""
-    mock_response = mocker.patch('requests.get').return_value
+    mock_response = mocker.patch('requests.Session.request').return_value
     mock_response.status_code = 200
     mock_response.text = "<html><body><p>Hello World</p></body></html>"
     
@@ -1363,14 +1414,15 @@ def test_scrape_text_from_url_skipped_domain():
     assert text == ""
 
 def test_scrape_text_from_url_request_fails(mocker):
-    """_scrape_text_from_url: requests.getが失敗するテスト"""
-    mocker.patch('requests.get', side_effect=requests.exceptions.RequestException("Error"))
+    """_scrape_text_from_url: HTTPリクエストが失敗するテスト"""
+    mocker.patch('requests.Session.request', side_effect=requests.exceptions.RequestException("Error"))
     text = gateway.main._scrape_text_from_url("http://example.com")
     assert text == ""
 
 
 def test_generate_rag_based_advice_no_keywords(mocker):
     """_generate_rag_based_advice: キーワードが抽出できなかった場合のテスト"""
+    mocker.patch('gateway.main._get_embeddings', return_value=[[0.1, 0.2]]) # クエリのベクトル化はキーワード抽出と並行して始まる
     mocker.patch('gateway.main._extract_keywords_for_search', return_value="")
     # この関数が呼ばれないようにモックしておく
     mocker.patch('gateway.main._search_with_vertex_ai_search')
@@ -1383,6 +1435,7 @@ def test_generate_rag_based_advice_no_keywords(mocker):
 
 def test_generate_rag_based_advice_no_search_results(mocker):
     """_generate_rag_based_advice: 検索結果がなかった場合のテスト"""
+    mocker.patch('gateway.main._get_embeddings', return_value=[[0.1, 0.2]]) # クエリのベクトル化はキーワード抽出と並行して始まる
     mocker.patch('gateway.main._extract_keywords_for_search', return_value="キーワード")
     mocker.patch('gateway.main._search_with_vertex_ai_search', return_value=[])
     
@@ -1398,7 +1451,7 @@ def test_generate_rag_based_advice_success_flow(mocker, mock_generative_model):
     mocker.patch('gateway.main._extract_keywords_for_search', return_value="キーワード")
     mocker.patch('gateway.main._search_with_vertex_ai_search', return_value=["http://example.com/page1"])
     # 1. キャッシュは最初は見つからない
-    mocker.patch('gateway.main._get_cached_chunks_and_embeddings', return_value=(None, None))
+    mocker.patch('gateway.main._get_cached_chunks_for_urls', return_value={})
     # 2. スクレイピングは成功する
     mocker.patch('gateway.main._scrape_text_from_url', return_value="スクレイピングしたテキスト")
     # 3. 埋め込みベクトルも生成される
@@ -1416,7 +1469,7 @@ def test_generate_rag_based_advice_success_flow(mocker, mock_generative_model):
     assert sources == ["http://example.com/page1"]
 
     # --- 各モックが期待通りに呼ばれたか検証 ---
-    gateway.main._get_cached_chunks_and_embeddings.assert_called()
+    gateway.main._get_cached_chunks_for_urls.assert_called()
     gateway.main._scrape_text_from_url.assert_called_once_with("http://example.com/page1")
     mock_get_embeddings.assert_called()
     mock_set_cache.assert_called()
@@ -1432,7 +1485,7 @@ def test_generate_rag_based_advice_with_cache(mocker, mock_generative_model):
     # 1. キャッシュが見つかる
     cached_chunks = ["キャッシュされたテキスト"]
     cached_embeddings = [[0.3, 0.4]]
-    mocker.patch('gateway.main._get_cached_chunks_and_embeddings', return_value=(cached_chunks, cached_embeddings))
+    mocker.patch('gateway.main._get_cached_chunks_for_urls', return_value={"http://cached-example.com/page2": (cached_chunks, cached_embeddings)})
     
     # ★★★ 修正: クエリの埋め込みベクトル生成もモックする ★★★
     mock_get_embeddings = mocker.patch('gateway.main._get_embeddings', return_value=[[0.3, 0.4]])
@@ -1503,6 +1556,7 @@ def test_create_cloud_task_success(mocker):
 def test_create_cloud_task_disabled(mocker):
     """_create_cloud_task: Cloud Tasksが無効な場合のテスト"""
     mocker.patch('gateway.main.tasks_client', None) # tasks_clientをNoneに設定
+    mocker.patch('gateway.main.tasks_enabled', False)
     mock_print = mocker.patch('builtins.print')
 
     gateway.main._create_cloud_task({"key": "value"}, "/target")
@@ -1534,6 +1588,9 @@ from gateway.main import app as flask_app
 import gateway.main  # モックの呼び出し検証のために追加
 import json
 import copy
+import threading
+import time
+from collections import Counter
 from unittest.mock import Mock, MagicMock, patch # ★★★ 修正: MagicMockを追加 ★★★
 from datetime import datetime, timezone
 import firebase_admin # ★★★ firebase_adminをインポート ★★★
@@ -1605,14 +1662,19 @@ def test_cloud_tasks_initialization_success(mocker):
     }
     mocker.patch.dict('os.environ', mock_env)
     
-    # CloudTasksClientのコンストラクタ自体をモック
-    mock_tasks_client = mocker.patch('gateway.main.tasks_v2.CloudTasksClient')
+    # CloudTasksClientのコンストラクタ自体をモック (遅延インポートされる実モジュール側をパッチする)
+    mock_tasks_client = mocker.patch('google.cloud.tasks_v2.CloudTasksClient')
 
     # mainモジュールを再読み込みして、トップレベルのコードを実行させる
     with patch('gateway.main.print') as mock_print:
         import importlib
         importlib.reload(gateway.main)
-        
+
+        # クライアントは import 時には生成されず、初回利用時に生成される
+        mock_tasks_client.assert_not_called()
+        assert gateway.main._get_tasks_client() is mock_tasks_client.return_value
+        assert gateway.main._get_tasks_client() is mock_tasks_client.return_value
+
         # 初期化成功のログが出力されたことを確認
         mock_tasks_client.assert_called_once()
         mock_print.assert_any_call("✅ Cloud Tasks client initialized. Queue: test-queue in test-location")
@@ -1634,14 +1696,16 @@ def test_cloud_tasks_initialization_exception(mocker):
     mocker.patch.dict('os.environ', mock_env)
     
     # CloudTasksClientのコンストラクタが例外を投げるようにモック
-    mocker.patch('gateway.main.tasks_v2.CloudTasksClient', side_effect=Exception("Test Exception"))
+    mocker.patch('google.cloud.tasks_v2.CloudTasksClient', side_effect=Exception("Test Exception"))
     mocker.patch('traceback.print_exc') # traceback.print_excもモックしておく
 
     # mainモジュールを再読み込み
     with patch('gateway.main.print') as mock_print:
         import importlib
         importlib.reload(gateway.main)
-        
+
+        assert gateway.main._get_tasks_client() is None
+
         # 初期化失敗のログが出力されたことを確認
         mock_print.assert_any_call("❌ Failed to initialize Cloud Tasks client, even though variables were set: Test Exception")
 
@@ -1819,9 +1883,10 @@ def test_post_summary_success(client, mocker):
 
     assert response.status_code == 200, f"API failed: {response.get_data(as_text=True)}"
     
-    # Cloud Tasksの作成関数が2回呼ばれたことを確認
-    # 1回目: 質問のプリフェッチ, 2回目: グラフの更新
-    assert mock_create_task.call_count == 2
+    # Cloud Tasksの作成関数が3回呼ばれたことを確認
+    # 1回目: 質問のプリフェッチ, 2回目: グラフの更新, 3回目: 書籍推薦の更新
+    assert mock_create_task.call_count == 3
+    assert [c.args[1] for c in mock_create_task.call_args_list] == ['/api/tasks/prefetch_questions', '/api/tasks/update_graph', '/api/tasks/update_book_recommendations']
 
 
 def test_start_session_auth_error(client, mocker):
@@ -2764,12 +2829,12 @@ def test_get_embeddings_success(mock_text_embedding_model):
     # model.get_embeddings([{"text": t} for t in batch]) の形式を模倣
     mock_embedding = MagicMock()
     mock_embedding.values = [0.1, 0.2]
-    mock_text_embedding_model.get_embeddings.return_value = [mock_embedding]
+    mock_text_embedding_model.get_embeddings.side_effect = lambda batch: [mock_embedding] * len(batch)
 
     embeddings = gateway.main._get_embeddings(["text1", "text2"])
     
-    assert len(embeddings) == 1
-    assert embeddings[0] == [0.1, 0.2]
+    assert len(embeddings) == 2
+    assert embeddings[0] == pytest.approx([0.1, 0.2])  # キャッシュには float32 で保持する
     mock_text_embedding_model.get_embeddings.assert_called()
 
 def test_get_embeddings_empty_input():
@@ -2820,9 +2885,14 @@ def test_get_cached_chunks_and_embeddings(mocker):
     mock_doc_ref.get.return_value = mock_doc_snapshot
     mocker.patch('gateway.main._get_url_cache_doc_ref', return_value=mock_doc_ref)
 
+    mock_thread = mocker.patch('gateway.main.threading.Thread')
+
     chunks, embeddings = gateway.main._get_cached_chunks_and_embeddings("http://example.com")
     assert chunks == ['chunk1']
-    assert embeddings == [[0.1]]
+    # 旧形式のキャッシュも行列として読み込み、新しい形式への書き換えを予約する
+    assert embeddings.shape == (1, 1)
+    assert embeddings[0][0] == pytest.approx(0.1)
+    assert mock_thread.call_args.kwargs['target'] == gateway.main._migrate_legacy_rag_cache
 
 
 def test_get_cached_chunks_and_embeddings_not_found(mocker):
@@ -2848,7 +2918,9 @@ def test_set_cached_chunks_and_embeddings(mocker):
     mock_doc_ref.set.assert_called_once()
     set_data = mock_doc_ref.set.call_args[0][0]
     assert set_data['chunks'] == ["chunk1"]
-    assert set_data['embeddings'] == [{'vector': [0.1]}]
+    assert 'embeddings' not in set_data
+    assert set_data['vector_encoding'] == gateway.main.RAG_CACHE_VECTOR_ENCODING
+    assert gateway.main._decode_vectors(set_data)[0][0] == pytest.approx(0.1, abs=1e-3)
     # ★★★ 修正: フィールド名を'cached_at'に修正 ★★★
     assert 'cached_at' in set_data
 
@@ -2870,7 +2942,7 @@ def test_search_with_vertex_ai_search(mocker):
 
 def test_scrape_text_from_url_success(mocker):
     """_scrape_text_from_url: 正常系のテスト"""
-    mock_response = mocker.patch('requests.get').return_value
+    mock_response = mocker.patch('requests.Session.request').return_value
     mock_response.status_code = 200
     mock_response.text = "<html><body><p>Hello World</p></body></html>"
     
@@ -2885,14 +2957,15 @@ def test_scrape_text_from_url_skipped_domain():
     assert text == ""
 
 def test_scrape_text_from_url_request_fails(mocker):
-    """_scrape_text_from_url: requests.getが失敗するテスト"""
-    mocker.patch('requests.get', side_effect=requests.exceptions.RequestException("Error"))
+    """_scrape_text_from_url: HTTPリクエストが失敗するテスト"""
+    mocker.patch('requests.Session.request', side_effect=requests.exceptions.RequestException("Error"))
     text = gateway.main._scrape_text_from_url("http://example.com")
     assert text == ""
 
 
 def test_generate_rag_based_advice_no_keywords(mocker):
     """_generate_rag_based_advice: キーワードが抽出できなかった場合のテスト"""
+    mocker.patch('gateway.main._get_embeddings', return_value=[[0.1, 0.2]]) # クエリのベクトル化はキーワード抽出と並行して始まる
     mocker.patch('gateway.main._extract_keywords_for_search', return_value="")
     # この関数が呼ばれないようにモックしておく
     mocker.patch('gateway.main._search_with_vertex_ai_search')
@@ -2905,6 +2978,7 @@ def test_generate_rag_based_advice_no_keywords(mocker):
 
 def test_generate_rag_based_advice_no_search_results(mocker):
     """_generate_rag_based_advice: 検索結果がなかった場合のテスト"""
+    mocker.patch('gateway.main._get_embeddings', return_value=[[0.1, 0.2]]) # クエリのベクトル化はキーワード抽出と並行して始まる
     mocker.patch('gateway.main._extract_keywords_for_search', return_value="キーワード")
     mocker.patch('gateway.main._search_with_vertex_ai_search', return_value=[])
     
@@ -2920,7 +2994,7 @@ def test_generate_rag_based_advice_success_flow(mocker, mock_generative_model):
     mocker.patch('gateway.main._extract_keywords_for_search', return_value="キーワード")
     mocker.patch('gateway.main._search_with_vertex_ai_search', return_value=["http://example.com/page1"])
     # 1. キャッシュは最初は見つからない
-    mocker.patch('gateway.main._get_cached_chunks_and_embeddings', return_value=(None, None))
+    mocker.patch('gateway.main._get_cached_chunks_for_urls', return_value={})
     # 2. スクレイピングは成功する
     mocker.patch('gateway.main._scrape_text_from_url', return_value="スクレイピングしたテキスト")
     # 3. 埋め込みベクトルも生成される
@@ -2938,7 +3012,7 @@ def test_generate_rag_based_advice_success_flow(mocker, mock_generative_model):
     assert sources == ["http://example.com/page1"]
 
     # --- 各モックが期待通りに呼ばれたか検証 ---
-    gateway.main._get_cached_chunks_and_embeddings.assert_called()
+    gateway.main._get_cached_chunks_for_urls.assert_called()
     gateway.main._scrape_text_from_url.assert_called_once_with("http://example.com/page1")
     mock_get_embeddings.assert_called()
     mock_set_cache.assert_called()
@@ -2954,7 +3028,7 @@ def test_generate_rag_based_advice_with_cache(mocker, mock_generative_model):
     # 1. キャッシュが見つかる
     cached_chunks = ["キャッシュされたテキスト"]
     cached_embeddings = [[0.3, 0.4]]
-    mocker.patch('gateway.main._get_cached_chunks_and_embeddings', return_value=(cached_chunks, cached_embeddings))
+    mocker.patch('gateway.main._get_cached_chunks_for_urls', return_value={"http://cached-example.com/page2": (cached_chunks, cached_embeddings)})
     
     # ★★★ 修正: クエリの埋め込みベクトル生成もモックする ★★★
     mock_get_embeddings = mocker.patch('gateway.main._get_embeddings', return_value=[[0.3, 0.4]])
@@ -3025,6 +3099,7 @@ def test_create_cloud_task_success(mocker):
 def test_create_cloud_task_disabled(mocker):
     """_create_cloud_task: Cloud Tasksが無効な場合のテスト"""
     mocker.patch('gateway.main.tasks_client', None) # tasks_clientをNoneに設定
+    mocker.patch('gateway.main.tasks_enabled', False)
     mock_print = mocker.patch('builtins.print')
 
     gateway.main._create_cloud_task({"key": "value"}, "/target")
@@ -3107,7 +3182,7 @@ def test_search_books_from_api_success(mocker):
             }
         }]
     }
-    mocker.patch('requests.get', return_value=mock_response)
+    mocker.patch('requests.Session.request', return_value=mock_response)
     
     result = gateway.main.search_books_from_api("test", "dummy_key")
     
@@ -3117,7 +3192,7 @@ def test_search_books_from_api_success(mocker):
 
 def test_search_books_from_api_request_fails(mocker):
     """search_books_from_api: Google Books APIリクエストが失敗した場合のテスト"""
-    mocker.patch('requests.get', side_effect=requests.exceptions.RequestException("API Error"))
+    mocker.patch('requests.Session.request', side_effect=requests.exceptions.RequestException("API Error"))
     
     results = gateway.main.search_books_from_api("query", "dummy_key")
     
@@ -3128,7 +3203,7 @@ def test_search_books_from_api_malformed_response(mocker):
     mock_response = MagicMock()
     mock_response.raise_for_status.return_value = None
     mock_response.json.return_value = {"totalItems": 0} # 'items'キーがないレスポンス
-    mocker.patch('requests.get', return_value=mock_response)
+    mocker.patch('requests.Session.request', return_value=mock_response)
     
     results = gateway.main.search_books_from_api("query", "dummy_key")
 
@@ -3248,6 +3323,7 @@ def test_set_cached_chunks_and_embeddings_no_data():
 
 def test_generate_rag_based_advice_no_keywords(mocker):
     """_generate_rag_based_advice: キーワード抽出に失敗した場合のテスト"""
+    mocker.patch('gateway.main._get_embeddings', return_value=[[0.1, 0.2]]) # クエリのベクトル化はキーワード抽出と並行して始まる
     mocker.patch('gateway.main._extract_keywords_for_search', return_value="")
     # 検索クエリが元のクエリの一部になることを確認
     mock_search = mocker.patch('gateway.main._search_with_vertex_ai_search', return_value=[])
@@ -3261,6 +3337,7 @@ def test_generate_rag_based_advice_no_keywords(mocker):
 
 def test_generate_rag_based_advice_no_urls_found(mocker):
     """_generate_rag_based_advice: Vertex AI SearchでURLが見つからなかった場合のテスト"""
+    mocker.patch('gateway.main._get_embeddings', return_value=[[0.1, 0.2]]) # クエリのベクトル化はキーワード抽出と並行して始まる
     mocker.patch('gateway.main._extract_keywords_for_search', return_value="keywords")
     mocker.patch('gateway.main._search_with_vertex_ai_search', return_value=[])
     
@@ -3271,9 +3348,10 @@ def test_generate_rag_based_advice_no_urls_found(mocker):
 
 def test_generate_rag_based_advice_scraping_fails(mocker):
     """_generate_rag_based_advice: スクレイピングと埋め込み生成に失敗した場合のテスト"""
+    mocker.patch('gateway.main._get_embeddings', return_value=[[0.1, 0.2]]) # クエリのベクトル化はキーワード抽出と並行して始まる
     mocker.patch('gateway.main._extract_keywords_for_search', return_value="keywords")
     mocker.patch('gateway.main._search_with_vertex_ai_search', return_value=["http://example.com"])
-    mocker.patch('gateway.main._get_cached_chunks_and_embeddings', return_value=(None, None))
+    mocker.patch('gateway.main._get_cached_chunks_for_urls', return_value={})
     mocker.patch('gateway.main._scrape_text_from_url', return_value="") # スクレイピング失敗
     
     advice, sources = gateway.main._generate_rag_based_advice("test query", "proj", "engine1", "engine2")
@@ -3285,7 +3363,7 @@ def test_generate_rag_based_advice_embedding_fails(mocker):
     """_generate_rag_based_advice: チャンクの埋め込み生成に失敗した場合のテスト"""
     mocker.patch('gateway.main._extract_keywords_for_search', return_value="keywords")
     mocker.patch('gateway.main._search_with_vertex_ai_search', return_value=["http://example.com"])
-    mocker.patch('gateway.main._get_cached_chunks_and_embeddings', return_value=(None, None))
+    mocker.patch('gateway.main._get_cached_chunks_for_urls', return_value={})
     mocker.patch('gateway.main._scrape_text_from_url', return_value="some content")
     mocker.patch('gateway.main._get_embeddings', return_value=[]) # 埋め込み生成失敗
     
@@ -3295,14 +3373,14 @@ def test_generate_rag_based_advice_embedding_fails(mocker):
 
 def test_generate_rag_based_advice_query_embedding_fails(mocker):
     """_generate_rag_based_advice: クエリの埋め込み生成に失敗した場合のテスト"""
-    mocker.patch('threading.Thread') # バックグラウンドでのキャッシュ保存スレッドを無効化
+    mocker.patch('gateway.main._set_cached_chunks_and_embeddings') # バックグラウンドでのキャッシュ保存を無効化 (URL の並行読み込みにはスレッドが必要)
     mocker.patch('gateway.main._extract_keywords_for_search', return_value="keywords")
     mocker.patch('gateway.main._search_with_vertex_ai_search', return_value=["http://example.com"])
-    mocker.patch('gateway.main._get_cached_chunks_and_embeddings', return_value=(None, None))
+    mocker.patch('gateway.main._get_cached_chunks_for_urls', return_value={})
     mocker.patch('gateway.main._scrape_text_from_url', return_value="some content")
     
-    # チャンクの埋め込みは成功するが、クエリの埋め込みで失敗するケース
-    mocker.patch('gateway.main._get_embeddings', side_effect=[[[0.1, 0.2]], []]) 
+    # チャンクの埋め込みは成功するが、クエリの埋め込みで失敗するケース (両者は並行して呼ばれるため、入力で結果を分ける)
+    mocker.patch('gateway.main._get_embeddings', side_effect=lambda texts, cache=True: [] if texts == ["test query"] else [[0.1, 0.2]])
     
     advice, sources = gateway.main._generate_rag_based_advice("test query", "proj", "engine1", "engine2")
 
@@ -3329,10 +3407,10 @@ def test_get_cached_chunks_and_embeddings_stale(mocker):
 
 def test_generate_rag_based_advice_success_for_suggestions(mocker):
     """_generate_rag_based_advice: RAGによる提案生成(suggestions)が成功するかのテスト"""
-    mocker.patch('threading.Thread') # バックグラウンドスレッドを無効化
+    mocker.patch('gateway.main._set_cached_chunks_and_embeddings') # バックグラウンドでのキャッシュ保存を無効化 (URL の並行読み込みにはスレッドが必要)
     mocker.patch('gateway.main._extract_keywords_for_search', return_value="keywords")
     mocker.patch('gateway.main._search_with_vertex_ai_search', return_value=["http://example.com"])
-    mocker.patch('gateway.main._get_cached_chunks_and_embeddings', return_value=(None, None))
+    mocker.patch('gateway.main._get_cached_chunks_for_urls', return_value={})
     mocker.patch('gateway.main._scrape_text_from_url', return_value="some content")
     mocker.patch('gateway.main._get_embeddings', side_effect=[[[0.1, 0.2]], [[0.1, 0.2]]]) 
     
@@ -3355,10 +3433,10 @@ def test_generate_rag_based_advice_success_for_suggestions(mocker):
 
 def test_generate_rag_based_advice_success_for_similar_cases(mocker):
     """_generate_rag_based_advice: RAGによる提案生成(similar_cases)が成功するかのテスト"""
-    mocker.patch('threading.Thread') # バックグラウンドスレッドを無効化
+    mocker.patch('gateway.main._set_cached_chunks_and_embeddings') # バックグラウンドでのキャッシュ保存を無効化 (URL の並行読み込みにはスレッドが必要)
     mocker.patch('gateway.main._extract_keywords_for_search', return_value="keywords")
     mocker.patch('gateway.main._search_with_vertex_ai_search', return_value=["http://example.com"])
-    mocker.patch('gateway.main._get_cached_chunks_and_embeddings', return_value=(None, None))
+    mocker.patch('gateway.main._get_cached_chunks_for_urls', return_value={})
     mocker.patch('gateway.main._scrape_text_from_url', return_value="some content")
     mocker.patch('gateway.main._get_embeddings', side_effect=[[[0.1, 0.2]], [[0.1, 0.2]]]) 
     
@@ -3377,4 +3455,1785 @@ def test_generate_rag_based_advice_success_for_similar_cases(mocker):
     assert advice == "Generated Advice"
     assert "http://example.com" in sources
     final_prompt = mock_model.generate_content.call_args[0][0]
-    assert "聞き上手な友人です" in final_prompt # similar_cases用のプロンプトか確認
\ No newline at end of file
+    assert "聞き上手な友人です" in final_prompt # similar_cases用のプロンプトか確認
+
+
+# --- 遅延インポート (Cold Start 対策) のテスト ---
+
+def test_heavy_sdks_are_deferred_at_import(mocker):
+    """重いSDKはモジュール読み込み時にはロードされず、起動レポートに deferred として載るかのテスト"""
+    cleanup_firebase_app()
+    mocker.patch.dict('os.environ', {}, clear=True)
+    mock_vertexai_init = mocker.patch('vertexai.init')
+
+    with patch('gateway.main.print') as mock_print:
+        import importlib
+        importlib.reload(gateway.main)
+
+        report = gateway.main._import_cost_report()
+        deferred = " ".join(report['deferred'])
+        assert "vertexai.generative_models.GenerativeModel" in deferred
+        assert "langchain.text_splitter.RecursiveCharacterTextSplitter" in deferred
+        assert report['eager_imports_ms'] >= 0
+        mock_vertexai_init.assert_not_called()
+        assert any("Startup import report" in str(c) for c in mock_print.call_args_list)
+
+def test_lazy_import_initializes_vertexai_once(mocker):
+    """GenerativeModel の初回利用時に一度だけ vertexai.init が呼ばれるかのテスト"""
+    mock_vertexai_init = mocker.patch('vertexai.init')
+    mock_model_class = mocker.patch('vertexai.generative_models.GenerativeModel')
+    mocker.patch('gateway.main._vertexai_initialized', False)
+    lazy_model = gateway.main._LazyImport('vertexai.generative_models', 'GenerativeModel', on_load=gateway.main._init_vertexai)
+
+    assert "deferred" in repr(lazy_model)
+    lazy_model("model-a")
+    lazy_model("model-b")
+
+    mock_vertexai_init.assert_called_once()
+    assert mock_model_class.call_count == 2
+    assert "loaded" in repr(lazy_model)
+
+
+# --- Gemini モデルレジストリのテスト ---
+
+def test_get_generative_model_reuses_instance(mocker):
+    """_get_generative_model: 同じモデル名・設定の組では一度だけ生成されるかのテスト"""
+    mock_model_class = mocker.patch('gateway.main.GenerativeModel')
+    mocker.patch('gateway.main.GenerationConfig')
+
+    first = gateway.main._get_generative_model("flash", {"temperature": 0.7})
+    second = gateway.main._get_generative_model("flash", {"temperature": 0.7})
+
+    assert first is second
+    mock_model_class.assert_called_once()
+
+def test_get_generative_model_separates_configs(mocker):
+    """_get_generative_model: モデル名や生成設定が異なる場合は別のインスタンスになるかのテスト"""
+    mock_model_class = mocker.patch('gateway.main.GenerativeModel', side_effect=lambda *a, **k: MagicMock())
+    mocker.patch('gateway.main.GenerationConfig')
+
+    plain = gateway.main._get_generative_model("flash")
+    configured = gateway.main._get_generative_model("flash", {"temperature": 0.7})
+    other = gateway.main._get_generative_model("pro")
+
+    assert len({id(plain), id(configured), id(other)}) == 3
+    assert mock_model_class.call_count == 3
+
+def test_call_gemini_with_schema_reuses_registered_model(mock_generative_model, mocker):
+    """_call_gemini_with_schema: 同じスキーマでの呼び出しではモデルが再生成されないかのテスト"""
+    mock_generative_model.generate_content.return_value.text = '{"key": "value"}'
+
+    gateway.main._call_gemini_with_schema("prompt 1", {"type": "object"}, "test-model")
+    gateway.main._call_gemini_with_schema("prompt 2", {"type": "object"}, "test-model")
+
+    assert gateway.main.GenerativeModel.call_count == 1
+    assert mock_generative_model.generate_content.call_count == 2
+
+
+def test_get_embeddings_loads_model_once(mocker):
+    """_get_embeddings: 呼び出しやリトライのたびに from_pretrained が呼ばれないかのテスト"""
+    mocker.patch('tenacity.nap.sleep')
+    mocker.patch('traceback.print_exc')
+    mock_model = MagicMock()
+    mock_embedding = MagicMock()
+    mock_embedding.values = [0.1, 0.2]
+    mock_model.get_embeddings.side_effect = [Exception("Temporary Error"), [mock_embedding], [mock_embedding]]
+    mock_from_pretrained = mocker.patch('gateway.main.TextEmbeddingModel.from_pretrained', return_value=mock_model)
+
+    assert gateway.main._get_embeddings(["text1"]) == [pytest.approx([0.1, 0.2])]
+    assert gateway.main._get_embeddings(["text2"]) == [pytest.approx([0.1, 0.2])]
+
+    mock_from_pretrained.assert_called_once_with(gateway.main.EMBEDDING_MODEL_NAME)
+    assert mock_model.get_embeddings.call_count == 3
+
+
+# --- HTTP 接続プールのテスト ---
+
+def test_http_session_is_shared_per_destination():
+    """_get_http_session: 同じ宛先には同じセッション、異なる宛先には別のセッションが返るかのテスト"""
+    books_session = gateway.main._get_http_session('google_books')
+
+    assert gateway.main._get_http_session('google_books') is books_session
+    assert gateway.main._get_http_session('scrape') is not books_session
+    adapter = books_session.get_adapter('https://www.googleapis.com')
+    assert adapter._pool_maxsize == gateway.main.HTTP_DESTINATIONS['google_books']['pool_maxsize']
+
+def test_http_request_uses_destination_timeout(mocker):
+    """_http_request: 宛先ごとのタイムアウトが既定値として使われ、件数が集計されるかのテスト"""
+    mock_request = mocker.patch('requests.Session.request')
+
+    gateway.main._http_request('ollama', 'POST', 'http://ollama.local/api/generate', json={})
+    gateway.main._http_request('scrape', 'GET', 'http://example.com', timeout=3)
+
+    assert mock_request.call_args_list[0][1]['timeout'] == gateway.main.HTTP_DESTINATIONS['ollama']['timeout']
+    assert mock_request.call_args_list[1][1]['timeout'] == 3
+    stats = gateway.main._http_request_stats()
+    assert stats['ollama']['requests'] == 1
+    assert stats['scrape']['requests'] == 1
+    assert stats['google_books']['requests'] == 0
+
+def test_http_request_counts_errors(mocker):
+    """_http_request: リクエスト失敗時にエラー件数が集計され、例外はそのまま送出されるかのテスト"""
+    mocker.patch('requests.Session.request', side_effect=requests.exceptions.ConnectionError("down"))
+
+    with pytest.raises(requests.exceptions.ConnectionError):
+        gateway.main._http_request('google_books', 'GET', 'https://www.googleapis.com/books/v1/volumes')
+
+    assert gateway.main._http_request_stats()['google_books']['errors'] == 1
+
+def test_http_request_stats_are_included_in_process_stats_log(mocker, capsys):
+    """_log_process_stats: 宛先ごとのリクエスト数とエラー数が定期出力に含まれるかのテスト"""
+    mocker.patch('requests.Session.request')
+    gateway.main._http_request('scrape', 'GET', 'http://example.com')
+    capsys.readouterr()
+
+    gateway.main._log_process_stats()
+
+    logged = json.loads(capsys.readouterr().out.strip().splitlines()[-1])
+    assert logged['process_stats']['http']['scrape'] == {
+        'requests': 1, 'errors': 0, 'pool_maxsize': gateway.main.HTTP_DESTINATIONS['scrape']['pool_maxsize']}
+
+def test_is_english_with_gemma_uses_pooled_session(mocker):
+    """_is_english_with_gemma: Ollama への判定リクエストが共有セッション経由で送られるかのテスト"""
+    mocker.patch('gateway.main.OLLAMA_ENDPOINT', 'http://ollama.local')
+    mocker.patch('gateway.main.OLLAMA_MODEL_NAME', 'gemma-test')
+    mock_request = mocker.patch('requests.Session.request')
+    mock_request.return_value.json.return_value = {"response": "YES"}
+
+    assert gateway.main._is_english_with_gemma("This is English.") is True
+    assert mock_request.call_args[0][:2] == ('POST', 'http://ollama.local/api/generate')
+
+
+# --- GCP クライアントキャッシュのテスト ---
+
+def _mock_search_response(link):
+    mock_result = MagicMock()
+    mock_result.document.derived_struct_data = {"link": link}
+    mock_search_response = MagicMock()
+    mock_search_response.results = [mock_result]
+    return mock_search_response
+
+def test_search_with_vertex_ai_search_reuses_client(mocker):
+    """_search_with_vertex_ai_search: SearchServiceClient がクエリごとに生成されないかのテスト"""
+    mock_client_class = mocker.patch('gateway.main.discoveryengine.SearchServiceClient')
+    mock_client_class.return_value.search.return_value = _mock_search_response("http://example.com")
+
+    gateway.main._search_with_vertex_ai_search("proj", "global", "engine1", "query 1")
+    gateway.main._search_with_vertex_ai_search("proj", "global", "engine2", "query 2")
+
+    mock_client_class.assert_called_once()
+    assert mock_client_class.return_value.search.call_count == 2
+    stats = gateway.main._gcp_client_stats_snapshot()['discoveryengine_search']
+    assert stats['constructions'] == 1
+    assert stats['calls'] == 2
+
+def test_search_with_vertex_ai_search_refreshes_client_on_error(mocker):
+    """_search_with_vertex_ai_search: 検索に失敗したクライアントは破棄され、次回作り直されるかのテスト"""
+    mocker.patch('traceback.print_exc')
+    broken_client, healthy_client = MagicMock(), MagicMock()
+    broken_client.search.side_effect = Exception("UNAVAILABLE")
+    healthy_client.search.return_value = _mock_search_response("http://example.com")
+    mock_client_class = mocker.patch('gateway.main.discoveryengine.SearchServiceClient', side_effect=[broken_client, healthy_client])
+
+    assert gateway.main._search_with_vertex_ai_search("proj", "global", "engine", "query") == []
+    assert gateway.main._search_with_vertex_ai_search("proj", "global", "engine", "query") == ["http://example.com"]
+
+    assert mock_client_class.call_count == 2
+    stats = gateway.main._gcp_client_stats_snapshot()['discoveryengine_search']
+    assert stats['errors'] == 1
+    assert stats['constructions'] == 2
+
+def test_get_gcp_client_is_keyed_by_resource_name():
+    """_get_gcp_client: リソース名ごとに別のクライアントがキャッシュされるかのテスト"""
+    factory = MagicMock(side_effect=lambda: MagicMock())
+
+    a1 = gateway.main._get_gcp_client('vector_search_index', 'indexes/a', factory)
+    a2 = gateway.main._get_gcp_client('vector_search_index', 'indexes/a', factory)
+    b = gateway.main._get_gcp_client('vector_search_index', 'indexes/b', factory)
+
+    assert a1 is a2
+    assert a1 is not b
+    assert factory.call_count == 2
+
+def test_call_gemini_cached_serves_repeated_prompt_from_memory(mocker):
+    """_call_gemini_cached: 同じプロンプトの2回目はモデルを呼ばずにキャッシュから返すかのテスト"""
+    mock_call = mocker.patch('gateway.main._call_gemini_with_schema', return_value={"keywords": ["自己分析"]})
+
+    first = gateway.main._call_gemini_cached("キーワードを抽出して", {"type": "object"}, "flash", 'book_keywords')
+    # インデントや行末の空白が違っても同じキーになる
+    second = gateway.main._call_gemini_cached("  キーワードを抽出して   \n", {"type": "object"}, "flash", 'book_keywords')
+
+    assert first == second == {"keywords": ["自己分析"]}
+    mock_call.assert_called_once()
+    assert gateway.main._llm_cache_stats_snapshot()['book_keywords'] == {'miss': 1, 'memory_hit': 1}
+
+def test_llm_cache_stats_are_included_in_process_stats_log(mocker, capsys):
+    """_log_process_stats: LLM キャッシュの呼び出し元ごとのヒット/ミス件数が定期出力に含まれるかのテスト"""
+    mocker.patch('gateway.main._call_gemini_with_schema', return_value={"keywords": ["自己分析"]})
+    gateway.main._call_gemini_cached("キーワードを抽出して", {"type": "object"}, "flash", 'book_keywords')
+    gateway.main._call_gemini_cached("キーワードを抽出して", {"type": "object"}, "flash", 'book_keywords')
+    capsys.readouterr()
+
+    gateway.main._log_process_stats()
+
+    logged = json.loads(capsys.readouterr().out.strip().splitlines()[-1])
+    assert logged['process_stats']['llm_cache']['book_keywords'] == {'miss': 1, 'memory_hit': 1}
+
+def test_call_gemini_cached_returns_independent_copies(mocker):
+    """_call_gemini_cached: 呼び出し側が結果を書き換えてもキャッシュが汚れないかのテスト"""
+    mocker.patch('gateway.main._call_gemini_with_schema', return_value={"keywords": ["a"]})
+
+    first = gateway.main._call_gemini_cached("prompt", {}, "flash", 'book_keywords')
+    first["keywords"].append("b")
+
+    assert gateway.main._call_gemini_cached("prompt", {}, "flash", 'book_keywords') == {"keywords": ["a"]}
+
+def test_call_gemini_cached_bypass(mocker):
+    """_call_gemini_cached: bypass_cache=True や未登録の呼び出し元ではキャッシュを使わないかのテスト"""
+    mock_call = mocker.patch('gateway.main._call_gemini_with_schema', return_value={"ok": True})
+
+    gateway.main._call_gemini_cached("prompt", {}, "flash", 'topic_suggestions')
+    gateway.main._call_gemini_cached("prompt", {}, "flash", 'topic_suggestions', bypass_cache=True)
+    gateway.main._call_gemini_cached("prompt", {}, "flash", 'unknown_call_site')
+    gateway.main._call_gemini_cached("prompt", {}, "flash", 'unknown_call_site')
+
+    assert mock_call.call_count == 4
+    stats = gateway.main._llm_cache_stats_snapshot()
+    assert stats['topic_suggestions'] == {'miss': 1, 'bypass': 1}
+    assert stats['unknown_call_site'] == {'bypass': 2}
+
+def test_call_gemini_cached_key_includes_model_and_schema(mocker):
+    """_call_gemini_cached: モデルやスキーマが違えば別のキャッシュエントリになるかのテスト"""
+    mock_call = mocker.patch('gateway.main._call_gemini_with_schema', return_value={"ok": True})
+
+    gateway.main._call_gemini_cached("prompt", {"type": "object"}, "flash", 'book_keywords')
+    gateway.main._call_gemini_cached("prompt", {"type": "object"}, "pro", 'book_keywords')
+    gateway.main._call_gemini_cached("prompt", {"type": "array"}, "flash", 'book_keywords')
+
+    assert mock_call.call_count == 3
+
+def test_call_gemini_cached_expires_after_ttl(mocker):
+    """_call_gemini_cached: TTL を過ぎたエントリは再生成されるかのテスト"""
+    mock_call = mocker.patch('gateway.main._call_gemini_with_schema', return_value={"ok": True})
+    mock_monotonic = mocker.patch('gateway.main.time.monotonic', return_value=1000.0)
+
+    gateway.main._call_gemini_cached("prompt", {}, "flash", 'topic_suggestions')
+    mock_monotonic.return_value = 1000.0 + gateway.main.LLM_CACHE_TTLS['topic_suggestions'].total_seconds() + 1
+    gateway.main._call_gemini_cached("prompt", {}, "flash", 'topic_suggestions')
+
+    assert mock_call.call_count == 2
+
+def test_call_gemini_cached_uses_firestore_tier(mocker):
+    """_call_gemini_cached: プロセス内キャッシュにない場合、期限内の Firestore キャッシュを使うかのテスト"""
+    mocker.patch('gateway.main.PERSISTENT_CACHE_ENABLED', True)
+    mock_call = mocker.patch('gateway.main._call_gemini_with_schema')
+    mock_db = mocker.patch('gateway.main.db_firestore')
+    mock_doc = MagicMock()
+    mock_doc.exists = True
+    mock_doc.to_dict.return_value = {
+        'response': {"suggestions": ["キャリア"]},
+        'expires_at': datetime.now(timezone.utc) + timedelta(hours=1),
+    }
+    mock_db.collection.return_value.document.return_value.get.return_value = mock_doc
+
+    first = gateway.main._call_gemini_cached("prompt", {}, "pro", 'topic_suggestions')
+    second = gateway.main._call_gemini_cached("prompt", {}, "pro", 'topic_suggestions')
+
+    assert first == second == {"suggestions": ["キャリア"]}
+    mock_call.assert_not_called()
+    mock_db.collection.assert_called_with(gateway.main.LLM_CACHE_COLLECTION)
+    assert gateway.main._llm_cache_stats_snapshot()['topic_suggestions'] == {'firestore_hit': 1, 'memory_hit': 1}
+
+def test_get_topic_suggestion_refresh_bypasses_cache(client, mocker):
+    """/session/topic_suggestions: ?refresh=true で応答キャッシュを使わないかのテスト"""
+    mocker.patch('gateway.main._verify_token', return_value={'uid': MOCK_USER_ID})
+    mocker.patch('gateway.main._get_all_insights_as_text', return_value="過去の洞察")
+    mock_generate = mocker.patch('gateway.main.generate_topic_suggestions', return_value=["トピック"])
+
+    response = client.get('/api/session/topic_suggestions?refresh=true', headers={'Authorization': 'Bearer test-token'})
+
+    assert response.status_code == 200
+    mock_generate.assert_called_once_with("過去の洞察", bypass_cache=True)
+
+def test_detect_language_locally_clear_cases():
+    """_detect_language_locally: 明らかな日本語・英語の JSON 応答をローカルで判定できるかのテスト"""
+    japanese = json.dumps({"title": "自己分析のまとめ", "insights": "あなたは新しい環境での挑戦にやりがいを感じる傾向があります。"}, ensure_ascii=False)
+    english = json.dumps({"title": "Summary", "insights": "You tend to find challenges in new environments rewarding."})
+    # JSON のキー名 (英語) は判定に含めない
+    japanese_with_terms = json.dumps({"insights": "最近は Python と AWS の学習を続けていて、キャリアの方向性を考えている。"}, ensure_ascii=False)
+
+    assert gateway.main._detect_language_locally(japanese) == 'ja'
+    assert gateway.main._detect_language_locally("```json\n" + japanese + "\n```") == 'ja'
+    assert gateway.main._detect_language_locally(english) == 'en'
+    assert gateway.main._detect_language_locally(japanese_with_terms) == 'ja'
+
+def test_detect_language_locally_short_japanese():
+    """_detect_language_locally: ラテン文字を含まない短い日本語は、文字数が少なくても日本語と判定するかのテスト"""
+    assert gateway.main._detect_language_locally(json.dumps(["マインドフルネス", "ストレス管理"], ensure_ascii=False)) == 'ja'
+    assert gateway.main._detect_language_locally(json.dumps({"question": "最近、眠れていますか？"}, ensure_ascii=False)) == 'ja'
+    assert gateway.main._detect_language_locally(json.dumps({"title": "休息"}, ensure_ascii=False)) is None
+    # ラテン文字を含む短いテキストは、これまでどおり判定しない
+    assert gateway.main._detect_language_locally(json.dumps({"title": "AIと仕事"}, ensure_ascii=False)) is None
+
+def test_detect_language_locally_ambiguous_cases():
+    """_detect_language_locally: 短い・混在したテキストは判定せずに None を返すかのテスト"""
+    assert gateway.main._detect_language_locally('{"key": "value"}') is None
+    assert gateway.main._detect_language_locally('{"a": 1, "b": [true, null]}') is None
+    mixed = json.dumps({"text": "Career planning and self reflection for engineers 自己分析"}, ensure_ascii=False)
+    assert gateway.main._detect_language_locally(mixed) is None
+
+def test_is_english_response_escalates_only_ambiguous_text(mocker):
+    """_is_english_response: 曖昧なテキストだけが Gemma に回され、件数が記録されるかのテスト"""
+    mock_gemma = mocker.patch('gateway.main._is_english_with_gemma', return_value=False)
+
+    assert gateway.main._is_english_response(json.dumps({"text": "今日はとても良い一日でした。明日も頑張りたいと思います。"}, ensure_ascii=False)) is False
+    assert gateway.main._is_english_response(json.dumps({"text": "Today was a really good day and I want to keep going."})) is True
+    assert gateway.main._is_english_response('{"key": "value"}') is False
+
+    mock_gemma.assert_called_once_with('{"key": "value"}')
+    stats = gateway.main._language_check_stats_snapshot()
+    assert stats['local_japanese'] == 1
+    assert stats['local_english'] == 1
+    assert stats['escalated'] == 1
+    assert stats['escalation_rate'] == pytest.approx(1 / 3)
+
+def test_language_check_stats_are_included_in_process_stats_log(mocker, capsys):
+    """_log_process_stats: ローカル判定と Gemma へのエスカレーションの件数が定期出力に含まれるかのテスト"""
+    mocker.patch('gateway.main._is_english_with_gemma', return_value=False)
+    gateway.main._is_english_response(json.dumps({"text": "今日はとても良い一日でした。"}, ensure_ascii=False))
+    gateway.main._is_english_response('{"key": "value"}')
+    capsys.readouterr()
+
+    gateway.main._log_process_stats()
+
+    logged = json.loads(capsys.readouterr().out.strip().splitlines()[-1])
+    language_check = logged['process_stats']['language_check']
+    assert (language_check['local_japanese'], language_check['escalated']) == (1, 1)
+    assert language_check['escalation_rate'] == pytest.approx(0.5)
+
+def test_call_gemini_with_schema_skips_gemma_for_japanese(mocker):
+    """_call_gemini_with_schema: 明らかに日本語の応答では Gemma を呼ばないかのテスト"""
+    mock_gemma = mocker.patch('gateway.main._is_english_with_gemma')
+    mock_model = MagicMock()
+    mock_model.generate_content.return_value.text = json.dumps({"title": "キャリアについての振り返り", "insights": "挑戦を楽しめるタイプです。"}, ensure_ascii=False)
+    mocker.patch('gateway.main._get_generative_model', return_value=mock_model)
+
+    result = gateway.main._call_gemini_with_schema("prompt", {}, model_name="flash")
+
+    assert result["title"] == "キャリアについての振り返り"
+    mock_gemma.assert_not_called()
+    mock_model.generate_content.assert_called_once()
+
+def _parse_sse(body: str) -> list:
+    """SSE のレスポンス本文を (event, data) のリストに変換する"""
+    events = []
+    for block in body.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.splitlines())
+        events.append((lines['event'], json.loads(lines['data'])))
+    return events
+
+def test_post_chat_message_stream_forwards_chunks(client, mocker):
+    """POST /analysis/chat/stream: Gemini の断片が chunk イベントとして送られ、最後に done イベントが送られるかのテスト"""
+    mocker.patch('gateway.main._verify_token', return_value={'uid': MOCK_USER_ID})
+    mocker.patch('gateway.main._get_all_insights_as_text', return_value="サマリー")
+    chunks = [MagicMock(text="こんにちは。"), MagicMock(text="今日はどうでしたか？")]
+    mock_model = MagicMock()
+    mock_model.generate_content.return_value = iter(chunks)
+    mocker.patch('gateway.main._get_generative_model', return_value=mock_model)
+
+    response = client.post('/api/analysis/chat/stream', json={"message": "こんにちは", "chat_history": []},
+                           headers={'Authorization': 'Bearer test-token'})
+
+    assert response.status_code == 200
+    assert response.mimetype == 'text/event-stream'
+    events = _parse_sse(response.get_data(as_text=True))
+    assert events == [
+        ('chunk', {"text": "こんにちは。"}),
+        ('chunk', {"text": "今日はどうでしたか？"}),
+        ('done', {"response": "こんにちは。今日はどうでしたか？", "sources": []}),
+    ]
+    assert mock_model.generate_content.call_args.kwargs == {"stream": True}
+    assert "サマリー" in mock_model.generate_content.call_args.args[0]
+
+def test_post_chat_message_stream_reports_error_event(client, mocker):
+    """POST /analysis/chat/stream: 生成途中で失敗した場合に error イベントで終了するかのテスト"""
+    mocker.patch('gateway.main._verify_token', return_value={'uid': MOCK_USER_ID})
+    mocker.patch('gateway.main._get_all_insights_as_text', return_value="")
+    mocker.patch('traceback.print_exc')
+
+    def broken_stream(*args, **kwargs):
+        yield "途中まで"
+        raise Exception("stream aborted")
+    mocker.patch('gateway.main.stream_chat_response', side_effect=broken_stream)
+
+    response = client.post('/api/analysis/chat/stream', json={"message": "hi"}, headers={'Authorization': 'Bearer test-token'})
+
+    events = _parse_sse(response.get_data(as_text=True))
+    assert events[0] == ('chunk', {"text": "途中まで"})
+    assert events[-1][0] == 'error'
+
+def test_post_chat_message_stream_with_rag_returns_pending_event(client, mocker):
+    """POST /analysis/chat/stream: RAG 指定時はタスクを登録し、request_id を含む done イベントを返すかのテスト"""
+    mocker.patch('gateway.main._verify_token', return_value={'uid': MOCK_USER_ID})
+    mock_task = mocker.patch('gateway.main._create_cloud_task')
+
+    response = client.post('/api/analysis/chat/stream', json={"message": "相談", "use_rag": True, "rag_type": "deep_dive"},
+                           headers={'Authorization': 'Bearer test-token'})
+
+    events = _parse_sse(response.get_data(as_text=True))
+    assert len(events) == 1
+    event, data = events[0]
+    assert event == 'done'
+    assert data['request_id']
+    assert mock_task.call_args.args[1] == '/api/tasks/execute_rag'
+
+def test_post_chat_message_stream_requires_message(client, mocker):
+    """POST /analysis/chat/stream: message がない場合はストリームを開始せず 400 を返すかのテスト"""
+    mocker.patch('gateway.main._verify_token', return_value={'uid': MOCK_USER_ID})
+
+    response = client.post('/api/analysis/chat/stream', json={"chat_history": []}, headers={'Authorization': 'Bearer test-token'})
+
+    assert response.status_code == 400
+
+def test_extract_partial_json_string():
+    """_extract_partial_json_string: 生成途中の JSON から文字列値を取り出せるかのテスト"""
+    assert gateway.main._extract_partial_json_string('{"ti', 'title') == (None, False)
+    assert gateway.main._extract_partial_json_string('{"title": "仕事の', 'title') == ("仕事の", False)
+    assert gateway.main._extract_partial_json_string('{"title": "仕事の悩み", "insights": "##', 'title') == ("仕事の悩み", True)
+    # エスケープの途中で切れている場合は、その手前までを返す
+    assert gateway.main._extract_partial_json_string('{"insights": "a\\', 'insights') == ("a", False)
+    assert gateway.main._extract_partial_json_string('{"insights": "a\\u30', 'insights') == ("a", False)
+    assert gateway.main._extract_partial_json_string('{"insights": "a\\n\\u30a2\\"b', 'insights') == ('a\nア"b', False)
+
+def test_stream_summary_only_emits_title_then_insights(mocker):
+    """stream_summary_only: タイトルを一度だけ送り、続いてインサイトの追加分を順に送るかのテスト"""
+    summary = {"title": "仕事の悩みについて", "insights": "## あなたの傾向\n新しい挑戦にやりがいを感じています。"}
+    raw = json.dumps(summary, ensure_ascii=False)
+    mock_model = MagicMock()
+    mock_model.generate_content.return_value = iter([MagicMock(text=raw[i:i + 7]) for i in range(0, len(raw), 7)])
+    mocker.patch('gateway.main._get_generative_model', return_value=mock_model)
+    mock_gemma = mocker.patch('gateway.main._is_english_with_gemma')
+
+    events = list(gateway.main.stream_summary_only("仕事", "- 質問: はい"))
+
+    assert events[0] == ('title', "仕事の悩みについて")
+    assert [kind for kind, _ in events].count('title') == 1
+    assert "".join(value for kind, value in events if kind == 'insights') == summary["insights"]
+    assert events[-1] == ('result', summary)
+    mock_gemma.assert_not_called()
+
+def test_stream_summary_only_holds_back_english_text(mocker):
+    """stream_summary_only: 英語の応答の途中経過はクライアントに送らず、作り直した結果だけを返すかのテスト"""
+    english = json.dumps({"title": "About your work worries", "insights": "You tend to find new challenges rewarding and meaningful."})
+    mock_model = MagicMock()
+    mock_model.generate_content.return_value = iter([MagicMock(text=english[i:i + 7]) for i in range(0, len(english), 7)])
+    mocker.patch('gateway.main._get_generative_model', return_value=mock_model)
+    regenerated = {"title": "仕事の悩み", "insights": "挑戦にやりがいを感じています。"}
+    mock_regenerate = mocker.patch('gateway.main.generate_summary_only', return_value=regenerated)
+
+    events = list(gateway.main.stream_summary_only("仕事", "- 質問: はい"))
+
+    assert events == [('result', regenerated)]
+    mock_regenerate.assert_called_once_with("仕事", "- 質問: はい")
+
+def test_stream_summary_only_retries_opening_the_stream(mocker):
+    """stream_summary_only: ストリームの開始時の一時的なエラーはリトライするかのテスト"""
+    mocker.patch('tenacity.nap.sleep')
+    summary = {"title": "仕事の悩み", "insights": "挑戦にやりがいを感じています。"}
+    raw = json.dumps(summary, ensure_ascii=False)
+    mock_model = MagicMock()
+    mock_model.generate_content.side_effect = [Exception("503 Service Unavailable"), iter([MagicMock(text=raw)])]
+    mocker.patch('gateway.main._get_generative_model', return_value=mock_model)
+
+    events = list(gateway.main.stream_summary_only("仕事", "- 質問: はい"))
+
+    assert events[-1] == ('result', summary)
+    assert mock_model.generate_content.call_count == 2
+
+def test_stream_summary_only_resets_after_mid_stream_failure(mocker):
+    """stream_summary_only: 途中経過を送った後にストリームが切れた場合は、'reset' を送ってから作り直した結果を返すかのテスト"""
+    def chunks():
+        yield MagicMock(text='{"title": "仕事の悩み", "insights": "挑戦に')
+        raise Exception("stream interrupted")
+    mock_model = MagicMock()
+    mock_model.generate_content.return_value = chunks()
+    mocker.patch('gateway.main._get_generative_model', return_value=mock_model)
+    regenerated = {"title": "仕事の悩み", "insights": "挑戦にやりがいを感じています。"}
+    mocker.patch('gateway.main.generate_summary_only', return_value=regenerated)
+
+    events = list(gateway.main.stream_summary_only("仕事", "- 質問: はい"))
+
+    assert [kind for kind, _ in events] == ['title', 'insights', 'reset', 'result']
+    assert events[-1] == ('result', regenerated)
+
+def test_post_summary_stream_persists_result(client, mocker):
+    """POST /session/<id>/summary?stream=true: 途中経過を送り、完了後にセッションと summaries/turn_N に保存するかのテスト"""
+    mocker.patch('gateway.main._verify_token', return_value={'uid': MOCK_USER_ID})
+    mock_create_task = mocker.patch('gateway.main._create_cloud_task')
+    summary = {"title": "タイトル", "insights": "## 分析\n本文"}
+    mocker.patch('gateway.main.stream_summary_only', return_value=iter([
+        ('title', "タイトル"), ('insights', "## 分析\n"), ('insights', "本文"), ('result', summary),
+    ]))
+
+    mock_db = mocker.patch('gateway.main.db_firestore')
+    mock_session_ref = MagicMock()
+    mock_session_ref.get.return_value.exists = True
+    mock_session_ref.get.return_value.to_dict.return_value = {'topic': '仕事', 'turn': 2}
+    mock_db.collection.return_value.document.return_value.collection.return_value.document.return_value = mock_session_ref
+    mock_swipe = MagicMock()
+    mock_swipe.to_dict.return_value = {"question_id": "q1", "answer": True}
+    mock_swipes = MagicMock()
+    mock_swipes.order_by.return_value.stream.return_value = [mock_swipe]
+    mock_summaries = MagicMock()
+    mock_session_ref.collection.side_effect = lambda name: {'swipes': mock_swipes, 'summaries': mock_summaries}.get(name, MagicMock())
+
+    response = client.post(f'/api/session/{MOCK_SESSION_ID}/summary?stream=true', headers={'Authorization': 'Bearer test-token'})
+
+    assert response.mimetype == 'text/event-stream'
+    events = _parse_sse(response.get_data(as_text=True))
+    assert [event for event, _ in events] == ['title', 'insights', 'insights', 'done']
+    assert events[-1][1] == {**summary, "turn": 2, "max_turns": gateway.main.MAX_TURNS}
+    assert mock_session_ref.update.call_args.args[0]['latest_insights'] == summary["insights"]
+    mock_summaries.document.assert_called_once_with('turn_2')
+    mock_summaries.document.return_value.set.assert_called_once_with({**summary, "turn": 2})
+    assert mock_create_task.call_count == 3
+
+def test_post_summary_stream_forwards_reset_event(client, mocker):
+    """POST /session/<id>/summary?stream=true: 途中経過を取り消す 'reset' が 'done' の前にクライアントへ送られるかのテスト"""
+    mocker.patch('gateway.main._verify_token', return_value={'uid': MOCK_USER_ID})
+    mocker.patch('gateway.main._create_cloud_task')
+    summary = {"title": "仕事の悩み", "insights": "本文"}
+    mocker.patch('gateway.main.stream_summary_only', return_value=iter([('title', "Work"), ('reset', None), ('result', summary)]))
+    mock_db = mocker.patch('gateway.main.db_firestore')
+    mock_session_ref = mock_db.collection.return_value.document.return_value.collection.return_value.document.return_value
+    mock_session_ref.get.return_value.exists = True
+    mock_session_ref.get.return_value.to_dict.return_value = {'topic': '仕事', 'turn': 1}
+    mock_swipes = MagicMock()
+    mock_swipes.order_by.return_value.stream.return_value = [MagicMock(to_dict=lambda: {"question_id": "q1", "answer": True})]
+    mock_session_ref.collection.side_effect = lambda name: mock_swipes if name == 'swipes' else MagicMock()
+
+    response = client.post(f'/api/session/{MOCK_SESSION_ID}/summary?stream=true', headers={'Authorization': 'Bearer test-token'})
+
+    events = _parse_sse(response.get_data(as_text=True))
+    assert [event for event, _ in events] == ['title', 'reset', 'done']
+    assert events[-1][1]['title'] == "仕事の悩み"
+
+def _digest_entry(session_id, day, title="タイトル"):
+    return {
+        'session_id': session_id,
+        'created_at': datetime(2024, 5, day, tzinfo=timezone.utc),
+        'topic': '仕事',
+        'title': title,
+        'insights': f'{session_id} のインサイト',
+    }
+
+def test_get_all_insights_as_text_reads_digest_document(mocker):
+    """_get_all_insights_as_text: ダイジェストが存在する場合は1ドキュメントの読み込みだけで済むかのテスト"""
+    mock_db = mocker.patch('gateway.main.db_firestore')
+    mock_digest = MagicMock(exists=True)
+    mock_digest.to_dict.return_value = {'sessions': [_digest_entry('s2', 2), _digest_entry('s1', 1)], 'version': 3}
+    mock_db.collection.return_value.document.return_value.get.return_value = mock_digest
+
+    text = gateway.main._get_all_insights_as_text(MOCK_USER_ID)
+
+    assert text.startswith("## セッション記録 (2024-05-02 - 仕事)\n### タイトル\ns2 のインサイト")
+    assert "s1 のインサイト" in text
+    mock_db.collection.assert_called_once_with(gateway.main.INSIGHTS_DIGEST_COLLECTION)
+    # sessions コレクションへのクエリは発行されない
+    mock_db.collection.return_value.document.return_value.collection.assert_not_called()
+
+def test_get_insights_digest_builds_missing_digest(mocker):
+    """_get_insights_digest: ダイジェストがない場合は sessions から構築して保存するかのテスト"""
+    mock_db = mocker.patch('gateway.main.db_firestore')
+    mock_digest_ref = MagicMock()
+    mock_digest_ref.get.return_value = MagicMock(exists=False)
+    mock_session = MagicMock(id='s1')
+    mock_session.to_dict.return_value = {'created_at': datetime(2024, 5, 1, tzinfo=timezone.utc), 'topic': '仕事', 'title': 'T', 'latest_insights': 'I'}
+    mock_db.collection.side_effect = lambda name: MagicMock(document=lambda doc_id: mock_digest_ref) if name == gateway.main.INSIGHTS_DIGEST_COLLECTION else mock_db.users
+    mock_db.users.document.return_value.collection.return_value.where.return_value.order_by.return_value.limit.return_value.stream.return_value = [mock_session]
+
+    mocker.patch('gateway.main.time.time', return_value=1700000000.0)
+
+    digest = gateway.main._get_insights_digest(MOCK_USER_ID)
+
+    assert digest['version'] == 1700000000000
+    assert digest['sessions'] == [{'session_id': 's1', 'created_at': datetime(2024, 5, 1, tzinfo=timezone.utc), 'topic': '仕事', 'title': 'T', 'insights': 'I'}]
+    created = mock_digest_ref.create.call_args.args[0]
+    assert created['sessions'] == digest['sessions']
+
+def test_update_insights_digest_replaces_entry_and_bumps_version(mocker):
+    """_update_insights_digest: 同じセッションのエントリを置き換え、直近の枠からあふれたものを畳み込み待ちに回すかのテスト"""
+    mocker.patch('gateway.main.INSIGHTS_RECENT_SESSIONS', 3)
+    mock_create_task = mocker.patch('gateway.main._create_cloud_task')
+    mock_db = mocker.patch('gateway.main.db_firestore')
+    mock_digest_ref = mock_db.collection.return_value.document.return_value
+    mock_snapshot = MagicMock(exists=True)
+    mock_snapshot.to_dict.return_value = {'sessions': [_digest_entry('s3', 3), _digest_entry('s2', 2, "古いタイトル"), _digest_entry('s1', 1)], 'version': 4}
+    mock_digest_ref.get.return_value = mock_snapshot
+    mock_transaction = mock_db.transaction.return_value
+
+    version = gateway.main._update_insights_digest(
+        MOCK_USER_ID, 's2', {'created_at': datetime(2024, 5, 2, tzinfo=timezone.utc), 'topic': '仕事'}, {'title': '新しいタイトル', 'insights': '更新'})
+
+    assert version > 4
+    first_write = mock_transaction.set.call_args_list[0].args[1]
+    assert [s['session_id'] for s in first_write['sessions']] == ['s3', 's2', 's1']
+    assert first_write['sessions'][1]['title'] == '新しいタイトル'
+    assert first_write['pending_fold'] == []
+    mock_create_task.assert_not_called()
+
+    gateway.main._update_insights_digest(
+        MOCK_USER_ID, 's4', {'created_at': datetime(2024, 5, 4, tzinfo=timezone.utc), 'topic': '趣味'}, {'title': '新規', 'insights': '新規'})
+
+    second_write = mock_transaction.set.call_args_list[1].args[1]
+    assert [s['session_id'] for s in second_write['sessions']] == ['s4', 's3', 's2']
+    assert [s['session_id'] for s in second_write['pending_fold']] == ['s1']
+    mock_create_task.assert_called_once()
+    assert mock_create_task.call_args.args == ({'user_id': MOCK_USER_ID}, '/api/tasks/fold_insights')
+    assert mock_create_task.call_args.kwargs['task_id'].startswith('fold-insights-')
+
+def test_schedule_insights_fold_uses_one_named_task_per_window(mocker):
+    """_schedule_insights_fold: 同じ時間枠の畳み込みタスクは同じ名前で、枠の終わりに実行されるよう登録されるかのテスト"""
+    mock_create_task = mocker.patch('gateway.main._create_cloud_task', side_effect=['created', 'duplicate'])
+    mocker.patch('gateway.main.time.time', return_value=1200.0)
+    mocker.patch('gateway.main.INSIGHTS_FOLD_WINDOW_SECONDS', 300)
+
+    assert gateway.main._schedule_insights_fold(MOCK_USER_ID) == 'created'
+    assert gateway.main._schedule_insights_fold(MOCK_USER_ID) == 'duplicate'
+
+    first, second = mock_create_task.call_args_list
+    assert first.kwargs['task_id'] == second.kwargs['task_id']
+    assert first.kwargs['schedule_time'] == datetime.fromtimestamp(1500, tz=timezone.utc)
+
+def test_update_insights_digest_failure_marks_digest_instead_of_deleting(mocker):
+    """_update_insights_digest: 更新に失敗してもダイジェストを削除せず、needs_rebuild の印だけを付けるかのテスト"""
+    mock_db = mocker.patch('gateway.main.db_firestore')
+    mock_digest_ref = mock_db.collection.return_value.document.return_value
+    mock_digest_ref.get.side_effect = RuntimeError("transient")
+
+    assert gateway.main._update_insights_digest(MOCK_USER_ID, 's1', {'topic': '仕事'}, {'title': 'T', 'insights': 'I'}) is None
+
+    mock_digest_ref.delete.assert_not_called()
+    mock_digest_ref.update.assert_called_once_with({'needs_rebuild': True})
+
+def test_get_insights_digest_repairs_marked_digest_keeping_profile_and_briefs(mocker):
+    """_get_insights_digest: needs_rebuild のダイジェストは、profile と briefs を残したまま取りこぼしたセッションを補うかのテスト"""
+    mocker.patch('gateway.main.INSIGHTS_RECENT_SESSIONS', 2)
+    mocker.patch('gateway.main._create_cloud_task')
+    mock_db = mocker.patch('gateway.main.db_firestore')
+    mock_digest_ref = MagicMock()
+    digest = {
+        'sessions': [_digest_entry('s4', 4), _digest_entry('s3', 3)],
+        'pending_fold': [],
+        'briefs': [{**_digest_entry('s2', 2), 'brief': '要点'}],
+        'profile': 'これまでのプロファイル',
+        'version': 9,
+        'needs_rebuild': True,
+    }
+    mock_digest_ref.get.return_value = MagicMock(exists=True, to_dict=lambda: copy.deepcopy(digest))
+    mock_db.collection.side_effect = lambda name: MagicMock(document=lambda doc_id: mock_digest_ref) if name == gateway.main.INSIGHTS_DIGEST_COLLECTION else mock_db.users
+    # 更新に失敗した s5 と、briefs や profile に畳み込み済みの s2 / s1 が返る
+    sessions = []
+    for session_id, day in [('s5', 5), ('s4', 4), ('s3', 3), ('s2', 2), ('s1', 1)]:
+        session = MagicMock(id=session_id)
+        session.to_dict.return_value = {'created_at': datetime(2024, 5, day, tzinfo=timezone.utc), 'topic': '仕事', 'title': 'タイトル', 'latest_insights': f'{session_id} のインサイト'}
+        sessions.append(session)
+    mock_db.users.document.return_value.collection.return_value.where.return_value.order_by.return_value.limit.return_value.stream.return_value = sessions
+
+    repaired = gateway.main._get_insights_digest(MOCK_USER_ID)
+
+    assert [e['session_id'] for e in repaired['sessions']] == ['s5', 's4']
+    assert [e['session_id'] for e in repaired['pending_fold']] == ['s3']
+    assert repaired['profile'] == 'これまでのプロファイル'
+    assert [b['session_id'] for b in repaired['briefs']] == ['s2']
+    assert repaired['version'] > 9
+    written = mock_db.transaction.return_value.set.call_args.args[1]
+    assert 'needs_rebuild' not in written
+    assert written['profile'] == 'これまでのプロファイル'
+
+def test_format_insights_text_orders_profile_briefs_and_sessions():
+    """_format_insights_text: プロファイル、過去の要点、直近と畳み込み待ちのセッション全文の順に並べるかのテスト"""
+    digest = {
+        'profile': '挑戦を好むが、疲れをためやすい。',
+        'briefs': [{**_digest_entry('s1', 1), 'brief': '転職への迷い'}],
+        'sessions': [_digest_entry('s3', 3)],
+        'pending_fold': [_digest_entry('s2', 2)],
+    }
+
+    text = gateway.main._format_insights_text(digest)
+
+    assert text.index('挑戦を好む') < text.index('転職への迷い') < text.index('s3 のインサイト') < text.index('s2 のインサイト')
+    assert "- (2024-05-01 - 仕事) タイトル: 転職への迷い" in text
+
+def test_fold_insights_digest_condenses_pending_sessions(mocker):
+    """_fold_insights_digest: 畳み込み待ちのセッションを要点にまとめ、上限を超えた古い要点をプロファイルに畳み込むかのテスト"""
+    mocker.patch('gateway.main.INSIGHTS_MAX_BRIEFS', 2)
+    mock_db = mocker.patch('gateway.main.db_firestore')
+    mock_digest_ref = mock_db.collection.return_value.document.return_value
+    digest = {
+        'sessions': [_digest_entry('s4', 4)],
+        'pending_fold': [_digest_entry('s3', 3), _digest_entry('s2', 2)],
+        'briefs': [{**_digest_entry('s1', 1), 'brief': '最初の要点'}],
+        'profile': '',
+        'version': 7,
+    }
+    mock_digest_ref.get.return_value = MagicMock(exists=True, to_dict=lambda: copy.deepcopy(digest))
+    mock_model = MagicMock()
+    mock_model.generate_content.side_effect = lambda prompt: MagicMock(text="プロファイル" if "これまでのプロファイル" in prompt else "要点")
+    mocker.patch('gateway.main._get_generative_model', return_value=mock_model)
+
+    assert gateway.main._fold_insights_digest(MOCK_USER_ID) is True
+
+    # 2件の要点 + 1回のプロファイル畳み込み
+    assert mock_model.generate_content.call_count == 3
+    written = mock_db.transaction.return_value.update.call_args.args[1]
+    assert written['pending_fold'] == []
+    assert [b['session_id'] for b in written['briefs']] == ['s3', 's2']
+    assert written['profile'] == "プロファイル"
+    assert written['version'] > 7
+    fold_prompt = mock_model.generate_content.call_args_list[-1].args[0]
+    assert '最初の要点' in fold_prompt
+
+def test_fold_insights_digest_skips_when_nothing_pending(mocker):
+    """_fold_insights_digest: 畳み込み待ちがない場合はモデルを呼ばないかのテスト"""
+    mock_db = mocker.patch('gateway.main.db_firestore')
+    mock_db.collection.return_value.document.return_value.get.return_value = MagicMock(exists=True, to_dict=lambda: {'sessions': [], 'pending_fold': []})
+    mock_get_model = mocker.patch('gateway.main._get_generative_model')
+
+    assert gateway.main._fold_insights_digest(MOCK_USER_ID) is False
+    mock_get_model.assert_not_called()
+
+def test_post_summary_updates_insights_digest(client, mocker):
+    """post_summary: セッションの完了時にダイジェストが更新されるかのテスト"""
+    mocker.patch('gateway.main._verify_token', return_value={'uid': MOCK_USER_ID})
+    mocker.patch('gateway.main.generate_summary_only', return_value={"title": "T", "insights": "I"})
+    mocker.patch('gateway.main._create_cloud_task')
+    mock_update_digest = mocker.patch('gateway.main._update_insights_digest')
+    mock_db = mocker.patch('gateway.main.db_firestore')
+    mock_session_ref = MagicMock()
+    session_data = {'topic': '仕事', 'turn': 1, 'created_at': datetime(2024, 5, 1, tzinfo=timezone.utc)}
+    mock_session_ref.get.return_value = MagicMock(exists=True, to_dict=lambda: session_data)
+    mock_db.collection.return_value.document.return_value.collection.return_value.document.return_value = mock_session_ref
+    mock_swipes = MagicMock()
+    mock_swipes.order_by.return_value.stream.return_value = [MagicMock(to_dict=lambda: {"question_id": "q1", "answer": False})]
+    mock_session_ref.collection.side_effect = lambda name: mock_swipes if name == 'swipes' else MagicMock()
+
+    response = client.post(f'/api/session/{MOCK_SESSION_ID}/summary', headers={'Authorization': 'Bearer test-token'})
+
+    assert response.status_code == 200
+    mock_update_digest.assert_called_once_with(MOCK_USER_ID, MOCK_SESSION_ID, session_data, {"title": "T", "insights": "I"})
+
+def test_read_document_once_memoizes_within_request(mocker):
+    """_read_document_once: 同じリクエスト内では同じドキュメントを一度だけ読み込むかのテスト"""
+    mock_db = mocker.patch('gateway.main.db_firestore')
+    mock_db.collection.return_value.document.return_value.get.return_value = MagicMock(exists=True, to_dict=lambda: {'v': 1})
+
+    with flask_app.test_request_context('/api/analysis/graph'):
+        assert gateway.main._read_document_once('analysis_cache', MOCK_USER_ID) == {'v': 1}
+        assert gateway.main._read_document_once('analysis_cache', MOCK_USER_ID) == {'v': 1}
+        gateway.main._forget_document_read('analysis_cache', MOCK_USER_ID)
+        gateway.main._read_document_once('analysis_cache', MOCK_USER_ID)
+        context = gateway.main._request_context()
+        assert (context.reads, context.saved_reads) == (2, 1)
+
+    assert mock_db.collection.return_value.document.return_value.get.call_count == 2
+
+def test_read_document_once_outside_request_always_reads(mocker):
+    """_read_document_once: リクエスト外 (バックグラウンド処理) ではメモ化しないかのテスト"""
+    mock_db = mocker.patch('gateway.main.db_firestore')
+    mock_db.collection.return_value.document.return_value.get.return_value = MagicMock(exists=False)
+
+    assert gateway.main._read_document_once('recommendation_cache', MOCK_USER_ID) is None
+    assert gateway.main._read_document_once('recommendation_cache', MOCK_USER_ID) is None
+    assert mock_db.collection.return_value.document.return_value.get.call_count == 2
+
+def test_proactive_suggestion_reads_insights_digest_once(client, mocker):
+    """GET /analysis/proactive_suggestion: グラフ生成とハンドラの両方で使うダイジェストを一度だけ読み込むかのテスト"""
+    mocker.patch('gateway.main._verify_token', return_value={'uid': MOCK_USER_ID})
+    mock_db = mocker.patch('gateway.main.db_firestore')
+    documents = {
+        'analysis_cache': MagicMock(exists=False),
+        gateway.main.INSIGHTS_DIGEST_COLLECTION: MagicMock(exists=True, to_dict=lambda: {'sessions': [_digest_entry('s1', 1)], 'version': 1}),
+    }
+    gets = Counter()
+    def collection_side_effect(name):
+        def get():
+            gets[name] += 1
+            return documents.get(name, MagicMock(exists=False))
+        return MagicMock(document=lambda doc_id: MagicMock(get=get))
+    mock_db.collection.side_effect = collection_side_effect
+    mocker.patch('gateway.main.generate_graph_data', return_value={"nodes": [{"id": "仕事", "type": "topic", "size": 10}], "edges": []})
+    mocker.patch('gateway.main._get_embeddings', return_value=None)
+    mocker.patch('gateway.main.GOOGLE_BOOKS_API_KEY', None)
+    mock_summarize = mocker.patch('gateway.main._summarize_internal_context', return_value="要約")
+    mock_model = MagicMock()
+    mock_model.generate_content.return_value.text = "検索クエリ"
+    mocker.patch('gateway.main._get_generative_model', return_value=mock_model)
+    mocker.patch('gateway.main._generate_rag_based_advice', return_value=("外部情報", []))
+    mocker.patch('gateway.main._call_gemini_with_schema', return_value={"initialSummary": "提案", "actions": [], "nodeLabel": "AIからの提案", "nodeId": "proactive_suggestion"})
+
+    response = client.get('/api/analysis/proactive_suggestion', headers={'Authorization': 'Bearer test-token'})
+
+    assert response.status_code == 200
+    assert gets[gateway.main.INSIGHTS_DIGEST_COLLECTION] == 1
+    assert "s1 のインサイト" in mock_summarize.call_args.args[0]
+    # グラフ生成時に外れたノードを求めるための analysis_cache の再読み込みも、リクエスト内の結果を使う
+    assert gets['analysis_cache'] == 1
+    assert response.headers['X-Firestore-Reads-Saved'] == '2'
+
+def test_merge_graph_data_combines_and_caps_nodes():
+    """_merge_graph_data: 同じラベルのノード・エッジを合算し、ノード数の上限を守るかのテスト"""
+    base = {
+        "nodes": [{"id": "仕事", "type": "topic", "size": 10}, {"id": "残業", "type": "issue", "size": 5}, {"id": "疲れ", "type": "emotion", "size": 2}],
+        "edges": [{"source": "仕事", "target": "残業", "weight": 3}, {"source": "残業", "target": "疲れ", "weight": 1}],
+    }
+    session = {
+        "nodes": [{"id": " 仕事 ", "type": "topic", "size": 4}, {"id": "ＡＩ", "type": "keyword", "size": 6}],
+        "edges": [{"source": "仕事", "target": "残業", "weight": 2}, {"source": "残業", "target": "ai", "weight": 4}, {"source": "仕事", "target": "仕事", "weight": 9}],
+    }
+
+    merged = gateway.main._merge_graph_data(base, [session], max_nodes=3)
+
+    assert merged["nodes"] == [
+        {"id": "仕事", "type": "topic", "size": 14},
+        {"id": "ＡＩ", "type": "keyword", "size": 6},
+        {"id": "残業", "type": "issue", "size": 5},
+    ]
+    # 上限で落ちた「疲れ」へのエッジと自己ループは含まれない
+    assert merged["edges"] == [
+        {"source": "仕事", "target": "残業", "weight": 5},
+        {"source": "残業", "target": "ＡＩ", "weight": 4},
+    ]
+
+def _mock_analysis_cache(mocker, cached_data):
+    mock_db = mocker.patch('gateway.main.db_firestore')
+    mock_cache_ref = mock_db.collection.return_value.document.return_value
+    mock_cache_ref.get.return_value = MagicMock(exists=cached_data is not None, to_dict=lambda: copy.deepcopy(cached_data))
+    return mock_cache_ref
+
+def test_merge_session_into_graph_merges_incrementally(mocker):
+    """_merge_session_into_graph: セッションの差分だけを抽出してマージし、全体の再生成をしないかのテスト"""
+    base_graph = {"nodes": [{"id": "仕事", "type": "topic", "size": 10}], "edges": []}
+    mock_cache_ref = _mock_analysis_cache(mocker, {
+        'graph_data': base_graph, 'base_graph': base_graph,
+        'base_timestamp': datetime.now(timezone.utc) - timedelta(days=1), 'session_graphs': [],
+    })
+    mock_full = mocker.patch('gateway.main.generate_graph_data')
+    session_graph = {"nodes": [{"id": "仕事", "type": "topic", "size": 3}, {"id": "昇進", "type": "issue", "size": 4}],
+                     "edges": [{"source": "仕事", "target": "昇進", "weight": 2}]}
+    mock_session_graph = mocker.patch('gateway.main.generate_session_graph_data', return_value=session_graph)
+    mock_upsert = mocker.patch('gateway.main._upsert_node_embeddings')
+    mocker.patch('gateway.main._get_all_insights_as_text', return_value="")
+
+    graph = gateway.main._merge_session_into_graph(MOCK_USER_ID, 's1', "## タイトル\n本文")
+
+    mock_full.assert_not_called()
+    assert mock_session_graph.call_args.args == ("## タイトル\n本文", base_graph["nodes"])
+    assert graph["nodes"] == [{"id": "仕事", "type": "topic", "size": 13}, {"id": "昇進", "type": "issue", "size": 4}]
+    # 新しいラベルだけがベクトル化される
+    assert mock_upsert.call_args.args[1] == [{"id": "昇進", "type": "issue", "size": 4}]
+    written = mock_cache_ref.set.call_args.args[0]
+    assert written['graph_data'] == graph
+    assert written['base_graph'] == base_graph
+    assert written['session_graphs'] == [{'session_id': 's1', 'graph': session_graph}]
+
+def test_merge_session_into_graph_replaces_resummarized_session(mocker):
+    """_merge_session_into_graph: 同じセッションの差分は置き換えられ、二重に加算されないかのテスト"""
+    base_graph = {"nodes": [{"id": "仕事", "type": "topic", "size": 10}], "edges": []}
+    old_session_graph = {"nodes": [{"id": "仕事", "type": "topic", "size": 5}], "edges": []}
+    mock_cache_ref = _mock_analysis_cache(mocker, {
+        'graph_data': gateway.main._merge_graph_data(base_graph, [old_session_graph]), 'base_graph': base_graph,
+        'base_timestamp': datetime.now(timezone.utc), 'session_graphs': [{'session_id': 's1', 'graph': old_session_graph}],
+    })
+    mocker.patch('gateway.main.generate_session_graph_data', return_value={"nodes": [{"id": "仕事", "type": "topic", "size": 2}], "edges": []})
+    mocker.patch('gateway.main._upsert_node_embeddings')
+    mocker.patch('gateway.main._get_all_insights_as_text', return_value="")
+
+    graph = gateway.main._merge_session_into_graph(MOCK_USER_ID, 's1', "本文")
+
+    assert graph["nodes"] == [{"id": "仕事", "type": "topic", "size": 12}]
+    assert len(mock_cache_ref.set.call_args.args[0]['session_graphs']) == 1
+
+@pytest.mark.parametrize("cached_data", [
+    None,
+    {'graph_data': {"nodes": []}},  # 差分マージ導入前のキャッシュ
+    {'graph_data': {"nodes": []}, 'base_graph': {"nodes": [], "edges": []}, 'base_timestamp': datetime.now(timezone.utc) - timedelta(days=8), 'session_graphs': []},
+])
+def test_merge_session_into_graph_falls_back_to_full_rebuild(mocker, cached_data):
+    """_merge_session_into_graph: キャッシュがない・古い場合は全体を作り直すかのテスト"""
+    _mock_analysis_cache(mocker, cached_data)
+    mock_full = mocker.patch('gateway.main._get_graph_from_cache_or_generate', return_value={"nodes": []})
+    mock_session_graph = mocker.patch('gateway.main.generate_session_graph_data')
+
+    gateway.main._merge_session_into_graph(MOCK_USER_ID, 's1', "本文")
+
+    mock_full.assert_called_once_with(MOCK_USER_ID, force_regenerate=True)
+    mock_session_graph.assert_not_called()
+
+def test_merge_session_into_graph_rebuilds_after_max_incremental_updates(mocker):
+    """_merge_session_into_graph: 差分が規定数たまったら全体を作り直すかのテスト"""
+    mocker.patch('gateway.main.GRAPH_FULL_REBUILD_EVERY', 2)
+    _mock_analysis_cache(mocker, {
+        'graph_data': {"nodes": []}, 'base_graph': {"nodes": [{"id": "a", "type": "topic", "size": 1}], "edges": []},
+        'base_timestamp': datetime.now(timezone.utc),
+        'session_graphs': [{'session_id': 's1', 'graph': {}}, {'session_id': 's2', 'graph': {}}],
+    })
+    mock_full = mocker.patch('gateway.main._get_graph_from_cache_or_generate')
+
+    gateway.main._merge_session_into_graph(MOCK_USER_ID, 's3', "本文")
+
+    mock_full.assert_called_once_with(MOCK_USER_ID, force_regenerate=True)
+
+def test_handle_update_graph_passes_session(client, mocker):
+    """/tasks/update_graph: ペイロードのセッションが差分マージに渡されるかのテスト"""
+    mock_merge = mocker.patch('gateway.main._merge_session_into_graph')
+
+    response = client.post('/api/tasks/update_graph', json={'user_id': 'uid', 'session_id': 's1', 'session_text': '本文'})
+
+    assert response.status_code == 200
+    mock_merge.assert_called_once_with('uid', 's1', '本文')
+
+def test_create_cloud_task_with_name_and_schedule(mocker):
+    """_create_cloud_task: タスク名と実行時刻を指定でき、同名のタスクは重複として扱われるかのテスト"""
+    from google.api_core import exceptions as google_exceptions
+    mock_tasks_client = MagicMock()
+    mock_tasks_client.queue_path.return_value = "projects/p/locations/l/queues/q"
+    mocker.patch('gateway.main.tasks_client', mock_tasks_client)
+    mocker.patch('gateway.main.SERVICE_URL', "http://service.url")
+    run_at = datetime(2024, 5, 1, 0, 2, tzinfo=timezone.utc)
+
+    assert gateway.main._create_cloud_task({"user_id": "u"}, "/target", task_id="update-graph-abc-1", schedule_time=run_at) == 'created'
+    task_arg = mock_tasks_client.create_task.call_args.kwargs['task']
+    assert task_arg['name'] == "projects/p/locations/l/queues/q/tasks/update-graph-abc-1"
+    assert task_arg['schedule_time'].seconds == int(run_at.timestamp())
+
+    mock_tasks_client.create_task.side_effect = google_exceptions.AlreadyExists("exists")
+    assert gateway.main._create_cloud_task({"user_id": "u"}, "/target", task_id="update-graph-abc-1") == 'duplicate'
+
+def test_windowed_task_id_is_stable_within_window():
+    """_windowed_task_id: 同じユーザー・同じ時間枠では同じタスク名になり、枠の終わりに実行されるかのテスト"""
+    first, run_at = gateway.main._windowed_task_id('update-graph', "uid", 120, now=1200.0)
+    second, _ = gateway.main._windowed_task_id('update-graph', "uid", 120, now=1319.0)
+    next_window, _ = gateway.main._windowed_task_id('update-graph', "uid", 120, now=1320.0)
+    other_user, _ = gateway.main._windowed_task_id('update-graph', "other", 120, now=1200.0)
+    other_kind, _ = gateway.main._windowed_task_id('update-books', "uid", 120, now=1200.0)
+
+    assert first == second
+    assert len({first, next_window, other_user, other_kind}) == 4
+    assert run_at == datetime.fromtimestamp(1320, tz=timezone.utc)
+
+def test_schedule_graph_update_counts_collapsed_tasks(mocker):
+    """_schedule_graph_update: セッションを更新待ちに記録し、同じ枠で重複したタスクを集約数として数えるかのテスト"""
+    mock_db = mocker.patch('gateway.main.db_firestore')
+    mock_create_task = mocker.patch('gateway.main._create_cloud_task', side_effect=['created', 'duplicate', 'duplicate'])
+
+    for session_id in ['s1', 's2', 's3']:
+        gateway.main._schedule_graph_update(MOCK_USER_ID, session_id, f"{session_id} の要約")
+
+    queue_ref = mock_db.collection.return_value.document.return_value
+    mock_db.collection.assert_called_with(gateway.main.GRAPH_UPDATE_QUEUE_COLLECTION)
+    queued = queue_ref.set.call_args_list[0]
+    assert queued.args[0]['sessions']['s1']['session_text'] == "s1 の要約"
+    assert queued.kwargs == {'merge': True}
+    assert mock_create_task.call_args.args == ({'user_id': MOCK_USER_ID, 'coalesced': True}, '/api/tasks/update_graph')
+    stats = gateway.main._graph_update_stats_snapshot()
+    assert (stats['requested'], stats['scheduled'], stats['collapsed']) == (3, 1, 2)
+    assert stats['collapsed_ratio'] == pytest.approx(2 / 3)
+
+def test_process_graph_update_queue_merges_all_pending_sessions_once(mocker):
+    """_process_graph_update_queue: 更新待ちのセッションを1回のマージで処理し、キューから取り除くかのテスト"""
+    mock_db = mocker.patch('gateway.main.db_firestore')
+    queued = {
+        's2': {'session_text': '二つ目', 'queued_at': datetime(2024, 5, 1, 0, 1, tzinfo=timezone.utc)},
+        's1': {'session_text': '一つ目', 'queued_at': datetime(2024, 5, 1, 0, 0, tzinfo=timezone.utc)},
+    }
+    mock_db.collection.return_value.document.return_value.get.return_value = MagicMock(exists=True, to_dict=lambda: {'sessions': copy.deepcopy(queued)})
+    mock_merge = mocker.patch('gateway.main._merge_sessions_into_graph', return_value={"nodes": []})
+
+    gateway.main._process_graph_update_queue(MOCK_USER_ID)
+
+    mock_merge.assert_called_once()
+    assert [s['session_id'] for s in mock_merge.call_args.args[1]] == ['s1', 's2']
+    removed = mock_db.transaction.return_value.update.call_args.args[1]
+    assert set(removed) == {"sessions.`s1`", "sessions.`s2`"}
+    assert gateway.main._graph_update_stats_snapshot()['sessions_merged'] == 2
+
+def test_process_graph_update_queue_skips_when_already_processed(mocker):
+    """_process_graph_update_queue: 先行するタスクが処理済みの場合は何もしないかのテスト"""
+    mock_db = mocker.patch('gateway.main.db_firestore')
+    mock_db.collection.return_value.document.return_value.get.return_value = MagicMock(exists=True, to_dict=lambda: {'sessions': {}})
+    mock_merge = mocker.patch('gateway.main._merge_sessions_into_graph')
+
+    assert gateway.main._process_graph_update_queue(MOCK_USER_ID) is None
+    mock_merge.assert_not_called()
+    assert gateway.main._graph_update_stats_snapshot()['empty_runs'] == 1
+
+def test_full_graph_rebuild_drops_queued_sessions_it_covers(mocker):
+    """_get_graph_from_cache_or_generate: 作り直しを始める前に更新待ちになったセッションだけをキューから取り除くかのテスト"""
+    mock_db = mocker.patch('gateway.main.db_firestore')
+    before = datetime.now(timezone.utc) - timedelta(minutes=1)
+    after = datetime.now(timezone.utc) + timedelta(minutes=1)
+    mock_db.collection.return_value.document.return_value.get.return_value = MagicMock(exists=True, to_dict=lambda: {'sessions': {
+        's1': {'session_text': '一つ目', 'queued_at': before},
+        's2': {'session_text': '二つ目', 'queued_at': after},
+    }})
+    mocker.patch('gateway.main._get_all_insights_as_text', return_value="インサイト")
+    mocker.patch('gateway.main.generate_graph_data', return_value=MOCK_GRAPH_DATA)
+    mocker.patch('gateway.main._upsert_node_embeddings')
+    mocker.patch('gateway.main._remove_departed_node_embeddings')
+    mocker.patch('gateway.main._create_cloud_task')
+
+    gateway.main._get_graph_from_cache_or_generate(MOCK_USER_ID, force_regenerate=True)
+
+    written = mock_db.collection.return_value.document.return_value.set.call_args.args[0]
+    assert before < written['base_timestamp'] < after
+    assert written['session_graphs'] == []
+    removed = mock_db.transaction.return_value.update.call_args.args[1]
+    assert set(removed) == {"sessions.`s1`"}
+
+def test_process_graph_update_queue_after_rebuild_does_not_double_count(mocker):
+    """_process_graph_update_queue: 全体の作り直しに含まれたセッションは差分として再び加算されず、キューからは取り除かれるかのテスト"""
+    rebuilt_at = datetime.now(timezone.utc) - timedelta(minutes=5)
+    # s1 を含めて作り直した直後のキャッシュ
+    base_graph = {"nodes": [{"id": "仕事", "type": "topic", "size": 8}], "edges": [{"source": "仕事", "target": "睡眠", "weight": 3}]}
+    cache = {'graph_data': base_graph, 'base_graph': base_graph, 'base_timestamp': rebuilt_at, 'session_graphs': []}
+    queue = {'sessions': {
+        's1': {'session_text': '一つ目', 'queued_at': rebuilt_at - timedelta(seconds=30)},
+        's2': {'session_text': '二つ目', 'queued_at': rebuilt_at + timedelta(seconds=30)},
+    }}
+    mock_db = mocker.patch('gateway.main.db_firestore')
+    cache_ref, queue_ref = MagicMock(), MagicMock()
+    cache_ref.get.return_value = MagicMock(exists=True, to_dict=lambda: copy.deepcopy(cache))
+    queue_ref.get.return_value = MagicMock(exists=True, to_dict=lambda: copy.deepcopy(queue))
+    refs = {'analysis_cache': cache_ref, gateway.main.GRAPH_UPDATE_QUEUE_COLLECTION: queue_ref}
+    mock_db.collection.side_effect = lambda name: MagicMock(document=MagicMock(return_value=refs[name]))
+    mock_session_graph = mocker.patch('gateway.main.generate_session_graph_data', return_value={
+        "nodes": [{"id": "仕事", "type": "topic", "size": 2}], "edges": [{"source": "仕事", "target": "睡眠", "weight": 1}]})
+    mock_full = mocker.patch('gateway.main.generate_graph_data')
+    mocker.patch('gateway.main._upsert_node_embeddings')
+    mocker.patch('gateway.main._remove_departed_node_embeddings')
+
+    graph = gateway.main._process_graph_update_queue(MOCK_USER_ID)
+
+    mock_full.assert_not_called()
+    assert mock_session_graph.call_count == 1
+    assert mock_session_graph.call_args.args[0] == '二つ目'
+    assert graph["nodes"] == [{"id": "仕事", "type": "topic", "size": 10}]
+    written = cache_ref.set.call_args.args[0]
+    assert [g['session_id'] for g in written['session_graphs']] == ['s2']
+    removed = mock_db.transaction.return_value.update.call_args.args[1]
+    assert set(removed) == {"sessions.`s1`", "sessions.`s2`"}
+
+def test_process_stats_are_logged_periodically_as_json(client, mocker, capsys):
+    """after_request: 間隔ごとに1回だけ、グラフ更新の集約数を含む統計を1行の JSON としてログに出すかのテスト"""
+    mocker.patch('gateway.main._stats_next_log_at', 0)
+    mocker.patch('gateway.main._create_cloud_task', side_effect=['created', 'duplicate'])
+    mocker.patch('gateway.main.db_firestore')
+    gateway.main._schedule_graph_update(MOCK_USER_ID, 's1', "一つ目")
+    gateway.main._schedule_graph_update(MOCK_USER_ID, 's2', "二つ目")
+    capsys.readouterr()
+
+    client.get('/api/')
+    client.get('/api/')
+
+    lines = [json.loads(line) for line in capsys.readouterr().out.splitlines() if line.startswith('{') and 'process_stats' in line]
+    assert len(lines) == 1
+    graph_updates = lines[0]['process_stats']['graph_updates']
+    assert (graph_updates['requested'], graph_updates['collapsed']) == (2, 1)
+    assert graph_updates['collapsed_ratio'] == pytest.approx(0.5)
+
+def test_handle_update_graph_processes_coalesced_queue(client, mocker):
+    """/tasks/update_graph: 集約されたタスクでは更新待ちのキューを処理するかのテスト"""
+    mock_process = mocker.patch('gateway.main._process_graph_update_queue')
+
+    response = client.post('/api/tasks/update_graph', json={'user_id': 'uid', 'coalesced': True})
+
+    assert response.status_code == 200
+    mock_process.assert_called_once_with('uid')
+
+def _mock_book_cache(mocker, cached):
+    mock_db = mocker.patch('gateway.main.db_firestore')
+    mock_reco_ref = mock_db.collection.return_value.document.return_value
+    mock_reco_ref.get.return_value = MagicMock(exists=cached is not None, to_dict=lambda: cached)
+    return mock_reco_ref
+
+def test_update_book_recommendations_regenerates_for_new_insights(mocker):
+    """_update_book_recommendations: ダイジェストの version が変わっていれば推薦を作り直し、version を保存するかのテスト"""
+    mocker.patch('gateway.main.GOOGLE_BOOKS_API_KEY', 'key')
+    mocker.patch('gateway.main._get_insights_digest', return_value={'sessions': [_digest_entry('s1', 1)], 'version': 4})
+    mock_reco_ref = _mock_book_cache(mocker, {'recommendations': [], 'insights_version': 3})
+    mock_generate = mocker.patch('gateway.main._generate_book_recommendations', return_value={"recommendations": MOCK_BOOK_RECOMMENDATIONS})
+
+    assert gateway.main._update_book_recommendations(MOCK_USER_ID) == MOCK_BOOK_RECOMMENDATIONS
+
+    assert "s1 のインサイト" in mock_generate.call_args.args[0]
+    written = mock_reco_ref.set.call_args.args[0]
+    assert written['insights_version'] == 4
+    assert written['recommendations'] == MOCK_BOOK_RECOMMENDATIONS
+
+def test_update_book_recommendations_skips_when_up_to_date(mocker):
+    """_update_book_recommendations: 推薦の元になった version から変わっていなければ作り直さないかのテスト"""
+    mocker.patch('gateway.main.GOOGLE_BOOKS_API_KEY', 'key')
+    mocker.patch('gateway.main._get_insights_digest', return_value={'sessions': [_digest_entry('s1', 1)], 'version': 4})
+    _mock_book_cache(mocker, {'recommendations': MOCK_BOOK_RECOMMENDATIONS, 'insights_version': 4})
+    mock_generate = mocker.patch('gateway.main._generate_book_recommendations', return_value={"recommendations": MOCK_BOOK_RECOMMENDATIONS})
+
+    assert gateway.main._update_book_recommendations(MOCK_USER_ID) is None
+    mock_generate.assert_not_called()
+    assert gateway.main._book_update_stats['up_to_date'] == 1
+
+    gateway.main._update_book_recommendations(MOCK_USER_ID, force=True)
+    mock_generate.assert_called_once()
+
+def test_full_graph_generation_schedules_books_instead_of_running_them(mocker):
+    """_get_graph_from_cache_or_generate: グラフ生成中に書籍推薦を実行せず、別タスクとして登録するかのテスト"""
+    mocker.patch('gateway.main.db_firestore')
+    mocker.patch('gateway.main._get_all_insights_as_text', return_value="インサイト")
+    mocker.patch('gateway.main.generate_graph_data', return_value=MOCK_GRAPH_DATA)
+    mocker.patch('gateway.main._upsert_node_embeddings')
+    mocker.patch('gateway.main.GOOGLE_BOOKS_API_KEY', 'key')
+    mock_generate_books = mocker.patch('gateway.main._generate_book_recommendations')
+    mock_create_task = mocker.patch('gateway.main._create_cloud_task', return_value='created')
+
+    gateway.main._get_graph_from_cache_or_generate(MOCK_USER_ID, force_regenerate=True)
+
+    mock_generate_books.assert_not_called()
+    assert mock_create_task.call_args.args == ({'user_id': MOCK_USER_ID}, '/api/tasks/update_book_recommendations')
+    assert mock_create_task.call_args.kwargs['task_id'].startswith('update-books-')
+
+def test_get_analysis_graph_force_schedules_immediate_book_refresh(client, mocker):
+    """GET /analysis/graph?force=true: 書籍推薦の作り直しを待たずに、すぐに実行されるタスクとして登録するかのテスト"""
+    mocker.patch('gateway.main._verify_token', return_value={'uid': MOCK_USER_ID})
+    mocker.patch('gateway.main.db_firestore')
+    mocker.patch('gateway.main._get_graph_from_cache_or_generate', return_value=MOCK_GRAPH_DATA)
+    mock_create_task = mocker.patch('gateway.main._create_cloud_task')
+
+    response = client.get('/api/analysis/graph?force=true', headers={'Authorization': 'Bearer test-token'})
+
+    assert response.status_code == 200
+    mock_create_task.assert_called_once_with({'user_id': MOCK_USER_ID, 'force': True}, '/api/tasks/update_book_recommendations')
+
+def test_get_analysis_graph_force_enqueues_only_immediate_book_refresh(client, mocker):
+    """GET /analysis/graph?force=true: グラフを作り直しても、書籍推薦のタスクはすぐに実行されるもの1つだけを登録するかのテスト"""
+    mocker.patch('gateway.main._verify_token', return_value={'uid': MOCK_USER_ID})
+    mocker.patch('gateway.main.db_firestore')
+    mocker.patch('gateway.main._get_all_insights_as_text', return_value="インサイト")
+    mocker.patch('gateway.main.generate_graph_data', return_value=MOCK_GRAPH_DATA)
+    mocker.patch('gateway.main._upsert_node_embeddings')
+    mocker.patch('gateway.main._remove_departed_node_embeddings')
+    mock_create_task = mocker.patch('gateway.main._create_cloud_task', return_value='created')
+
+    response = client.get('/api/analysis/graph?force=true', headers={'Authorization': 'Bearer test-token'})
+
+    assert response.status_code == 200
+    book_tasks = [c for c in mock_create_task.call_args_list if c.args[1] == '/api/tasks/update_book_recommendations']
+    assert len(book_tasks) == 1
+    assert book_tasks[0].args[0] == {'user_id': MOCK_USER_ID, 'force': True}
+
+def test_handle_update_book_recommendations(client, mocker):
+    """/tasks/update_book_recommendations: ペイロードのユーザーで書籍推薦を更新するかのテスト"""
+    mock_update = mocker.patch('gateway.main._update_book_recommendations')
+
+    response = client.post('/api/tasks/update_book_recommendations', json={'user_id': 'uid', 'force': True})
+
+    assert response.status_code == 200
+    mock_update.assert_called_once_with('uid', force=True)
+
+def test_get_analysis_graph_serves_stale_cache_and_refreshes_in_background(client, mocker):
+    """GET /analysis/graph: 期限切れのキャッシュはそのまま返し、作り直しはタスクに任せるかのテスト"""
+    mocker.patch('gateway.main._verify_token', return_value={'uid': MOCK_USER_ID})
+    mock_db = mocker.patch('gateway.main.db_firestore')
+    mock_db.collection.return_value.document.return_value.get.return_value = MagicMock(exists=True, to_dict=lambda: {
+        'graph_data': MOCK_GRAPH_DATA, 'timestamp': datetime.now(timezone.utc) - timedelta(hours=30)})
+    mock_generate = mocker.patch('gateway.main.generate_graph_data')
+    mock_create_task = mocker.patch('gateway.main._create_cloud_task', return_value='created')
+
+    response = client.get('/api/analysis/graph', headers={'Authorization': 'Bearer test-token'})
+
+    assert response.status_code == 200
+    assert response.get_json() == MOCK_GRAPH_DATA
+    assert response.headers['X-Graph-Cache'] == 'stale'
+    mock_generate.assert_not_called()
+    mock_create_task.assert_called_once()
+    assert mock_create_task.call_args.args == ({'user_id': MOCK_USER_ID}, '/api/tasks/update_graph')
+    assert mock_create_task.call_args.kwargs['task_id'].startswith('refresh-graph-')
+
+def test_stale_graph_refresh_is_deduplicated_per_user(mocker):
+    """_get_graph_from_cache_or_generate: 同じ時間枠の期限切れの読み込みでは、同じ名前のタスクが登録されるかのテスト"""
+    mock_db = mocker.patch('gateway.main.db_firestore')
+    mock_db.collection.return_value.document.return_value.get.return_value = MagicMock(exists=True, to_dict=lambda: {
+        'graph_data': MOCK_GRAPH_DATA, 'timestamp': datetime.now(timezone.utc) - timedelta(days=2)})
+    mock_create_task = mocker.patch('gateway.main._create_cloud_task', side_effect=['created', 'duplicate'])
+    mocker.patch('gateway.main.time.time', return_value=6000.0)
+
+    gateway.main._get_graph_from_cache_or_generate(MOCK_USER_ID)
+    gateway.main._get_graph_from_cache_or_generate(MOCK_USER_ID)
+
+    task_ids = {c.kwargs['task_id'] for c in mock_create_task.call_args_list}
+    assert len(task_ids) == 1
+    assert gateway.main._graph_cache_stats['refresh_scheduled'] == 1
+    assert gateway.main._graph_cache_stats['refresh_deduplicated'] == 1
+
+def test_missing_graph_cache_still_generates_synchronously(mocker):
+    """_get_graph_from_cache_or_generate: キャッシュがない場合だけはその場で生成するかのテスト"""
+    mock_db = mocker.patch('gateway.main.db_firestore')
+    mock_db.collection.return_value.document.return_value.get.return_value = MagicMock(exists=False)
+    mocker.patch('gateway.main._get_all_insights_as_text', return_value="インサイト")
+    mock_generate = mocker.patch('gateway.main.generate_graph_data', return_value={"nodes": [], "edges": []})
+    mock_create_task = mocker.patch('gateway.main._create_cloud_task')
+
+    gateway.main._get_graph_from_cache_or_generate(MOCK_USER_ID)
+
+    mock_generate.assert_called_once()
+    mock_create_task.assert_not_called()
+    assert gateway.main._graph_cache_stats['miss'] == 1
+
+def test_get_analysis_graph_returns_etag_and_304_when_unchanged(client, mocker):
+    """GET /analysis/graph: キャッシュの更新時刻から ETag を返し、一致する If-None-Match には本文なしの 304 を返すかのテスト"""
+    mocker.patch('gateway.main._verify_token', return_value={'uid': MOCK_USER_ID})
+    mock_db = mocker.patch('gateway.main.db_firestore')
+    mock_db.collection.return_value.document.return_value.get.return_value = MagicMock(exists=True, to_dict=lambda: {
+        'graph_data': MOCK_GRAPH_DATA, 'timestamp': datetime(2026, 1, 1, tzinfo=timezone.utc)})
+
+    first = client.get('/api/analysis/graph', headers={'Authorization': 'Bearer test-token'})
+    etag = first.headers['ETag']
+    second = client.get('/api/analysis/graph', headers={'Authorization': 'Bearer test-token', 'If-None-Match': etag})
+
+    assert first.status_code == 200
+    assert first.headers['Cache-Control'] == 'private, no-cache'
+    assert not etag.startswith('W/')
+    assert second.status_code == 304
+    assert second.data == b''
+    assert second.headers['ETag'] == etag
+
+def test_get_analysis_graph_etag_changes_with_cache_timestamp(client, mocker):
+    """GET /analysis/graph: キャッシュが更新されると古い ETag では 304 にならないかのテスト"""
+    mocker.patch('gateway.main._verify_token', return_value={'uid': MOCK_USER_ID})
+    mock_db = mocker.patch('gateway.main.db_firestore')
+    mock_db.collection.return_value.document.return_value.get.return_value = MagicMock(exists=True, to_dict=lambda: {
+        'graph_data': MOCK_GRAPH_DATA, 'timestamp': datetime(2026, 1, 2, tzinfo=timezone.utc)})
+    old_etag = gateway.main._make_etag('graph', MOCK_USER_ID, datetime(2026, 1, 1, tzinfo=timezone.utc))
+
+    response = client.get('/api/analysis/graph', headers={'Authorization': 'Bearer test-token', 'If-None-Match': f'"{old_etag}"'})
+
+    assert response.status_code == 200
+    assert response.get_json() == MOCK_GRAPH_DATA
+    assert response.headers['ETag'] != f'"{old_etag}"'
+
+def test_get_analysis_summary_etag_follows_topic_counts(client, mocker):
+    """GET /analysis/summary: 集計結果が同じなら 304 を、セッションが増えて集計が変われば同じ ETag でも 200 を返すかのテスト"""
+    mocker.patch('gateway.main._verify_token', return_value={'uid': MOCK_USER_ID})
+    mock_db = mocker.patch('gateway.main.db_firestore')
+    sessions = [MagicMock(to_dict=lambda: {'status': 'completed', 'topic': '仕事'})]
+    mock_db.collection.return_value.document.return_value.collection.return_value.where.return_value.stream.side_effect = lambda: list(sessions)
+    headers = {'Authorization': 'Bearer test-token'}
+
+    first = client.get('/api/analysis/summary', headers=headers)
+    unchanged = client.get('/api/analysis/summary', headers={**headers, 'If-None-Match': first.headers['ETag']})
+    # ダイジェストを経由しない完了経路でセッションが増えた場合
+    sessions.append(MagicMock(to_dict=lambda: {'status': 'completed', 'topic': '人間関係'}))
+    changed = client.get('/api/analysis/summary', headers={**headers, 'If-None-Match': first.headers['ETag']})
+
+    assert first.status_code == 200
+    assert unchanged.status_code == 304
+    assert unchanged.data == b''
+    assert changed.status_code == 200
+    assert changed.get_json()['total_sessions'] == 2
+    assert changed.headers['ETag'] != first.headers['ETag']
+
+def test_get_book_recommendations_returns_etag(client, mocker):
+    """GET /analysis/book_recommendations: キャッシュ済みのおすすめに ETag が付き、再検証で 304 になるかのテスト"""
+    mocker.patch('gateway.main._verify_token', return_value={'uid': MOCK_USER_ID})
+    mocker.patch('gateway.main.GOOGLE_BOOKS_API_KEY', 'fake-api-key')
+    mock_db = mocker.patch('gateway.main.db_firestore')
+    mock_db.collection.return_value.document.return_value.get.return_value = MagicMock(exists=True, to_dict=lambda: {
+        'recommendations': MOCK_BOOK_RECOMMENDATIONS, 'timestamp': datetime(2026, 1, 1, tzinfo=timezone.utc)})
+
+    first = client.get('/api/analysis/book_recommendations', headers={'Authorization': 'Bearer test-token'})
+    second = client.get('/api/analysis/book_recommendations', headers={'Authorization': 'Bearer test-token', 'If-None-Match': first.headers['ETag']})
+
+    assert first.status_code == 200
+    assert first.get_json() == MOCK_BOOK_RECOMMENDATIONS
+    assert second.status_code == 304
+
+def test_get_home_suggestion_etag_differs_from_graph_etag(mocker):
+    """_graph_etag: 同じキャッシュから作ってもエンドポイントごとに異なる ETag になるかのテスト"""
+    mock_db = mocker.patch('gateway.main.db_firestore')
+    mock_db.collection.return_value.document.return_value.get.return_value = MagicMock(exists=True, to_dict=lambda: {
+        'graph_data': MOCK_GRAPH_DATA, 'timestamp': datetime(2026, 1, 1, tzinfo=timezone.utc)})
+
+    with gateway.main.app.test_request_context():
+        graph_etag = gateway.main._graph_etag('graph', MOCK_USER_ID)
+        home_etag = gateway.main._graph_etag('home_suggestion', MOCK_USER_ID)
+
+    assert graph_etag and home_etag
+    assert graph_etag != home_etag
+
+def test_node_embedding_id_is_deterministic_per_user_and_label():
+    """_node_embedding_id: 表記ゆれのある同じラベルは同じIDに、ユーザーやラベルが違えば別のIDになるかのテスト"""
+    assert gateway.main._node_embedding_id(MOCK_USER_ID, "仕事") == gateway.main._node_embedding_id(MOCK_USER_ID, " 仕事 ")
+    assert gateway.main._node_embedding_id(MOCK_USER_ID, "Work") == gateway.main._node_embedding_id(MOCK_USER_ID, "ｗｏｒｋ")
+    assert gateway.main._node_embedding_id(MOCK_USER_ID, "仕事") != gateway.main._node_embedding_id("other_user", "仕事")
+    assert gateway.main._node_embedding_id(MOCK_USER_ID, "仕事") != gateway.main._node_embedding_id(MOCK_USER_ID, "趣味")
+
+def test_upsert_node_embeddings_overwrites_documents_in_place(mocker):
+    """_upsert_node_embeddings: ラベルから決まるIDでドキュメントとデータポイントを上書きするかのテスト"""
+    mock_db = mocker.patch('gateway.main.db_firestore')
+    mocker.patch('gateway.main._get_embeddings', return_value=[[0.1, 0.2]])
+    mock_index = mocker.patch('gateway.main.aiplatform.MatchingEngineIndex')
+
+    gateway.main._upsert_node_embeddings(MOCK_USER_ID, [{"id": "仕事"}, {"id": "仕事 "}])
+
+    expected_id = gateway.main._node_embedding_id(MOCK_USER_ID, "仕事")
+    mock_db.collection.return_value.document.assert_called_once_with(expected_id)
+    datapoints = mock_index.return_value.upsert_datapoints.call_args.kwargs['datapoints']
+    assert [dp['datapoint_id'] for dp in datapoints] == [expected_id]
+
+def test_graph_regeneration_removes_departed_node_embeddings(mocker):
+    """_get_graph_from_cache_or_generate: 作り直したグラフから外れたノードのデータポイントを削除するかのテスト"""
+    mock_db = mocker.patch('gateway.main.db_firestore')
+    mock_db.collection.return_value.document.return_value.get.return_value = MagicMock(exists=True, to_dict=lambda: {
+        'graph_data': {'nodes': [{'id': '仕事'}, {'id': '睡眠'}], 'edges': []}, 'timestamp': datetime.now(timezone.utc)})
+    mocker.patch('gateway.main._get_all_insights_as_text', return_value="インサイト")
+    mocker.patch('gateway.main.generate_graph_data', return_value={"nodes": [{"id": "仕事", "size": 5}, {"id": "趣味", "size": 3}], "edges": []})
+    mocker.patch('gateway.main._get_embeddings', return_value=[[0.1], [0.2]])
+    mocker.patch('gateway.main._create_cloud_task')
+    mock_index = mocker.patch('gateway.main.aiplatform.MatchingEngineIndex')
+
+    gateway.main._get_graph_from_cache_or_generate(MOCK_USER_ID, force_regenerate=True)
+
+    mock_index.return_value.remove_datapoints.assert_called_once_with(
+        datapoint_ids=[gateway.main._node_embedding_id(MOCK_USER_ID, '睡眠')])
+
+def test_reconcile_node_embeddings_removes_orphans_and_adds_missing(mocker):
+    """_reconcile_node_embeddings: グラフにないドキュメントを削除し、ベクトルのないノードを登録するかのテスト"""
+    mock_db = mocker.patch('gateway.main.db_firestore')
+    mock_db.collection.return_value.document.return_value.get.return_value = MagicMock(exists=True, to_dict=lambda: {
+        'graph_data': {'nodes': [{'id': '仕事'}, {'id': '趣味'}], 'edges': []}})
+    work_id = gateway.main._node_embedding_id(MOCK_USER_ID, '仕事')
+    mock_db.collection.return_value.where.return_value.stream.return_value = [
+        MagicMock(id=work_id), MagicMock(id='random-legacy-id-1'), MagicMock(id='random-legacy-id-2')]
+    mock_index = mocker.patch('gateway.main.aiplatform.MatchingEngineIndex')
+    mock_upsert = mocker.patch('gateway.main._upsert_node_embeddings')
+
+    result = gateway.main._reconcile_node_embeddings(MOCK_USER_ID)
+
+    assert result == {'removed': 2, 'added': 1}
+    mock_index.return_value.remove_datapoints.assert_called_once_with(datapoint_ids=['random-legacy-id-1', 'random-legacy-id-2'])
+    assert mock_upsert.call_args.args[1] == [{'id': '趣味'}]
+
+def test_handle_reconcile_embeddings_fans_out_per_user(client, mocker):
+    """/tasks/reconcile_embeddings: user_id がない場合は、ユーザーごとの照合タスクを登録するかのテスト"""
+    mock_db = mocker.patch('gateway.main.db_firestore')
+    mock_db.collection.return_value.select.return_value.stream.return_value = [
+        MagicMock(to_dict=lambda: {'user_id': 'user_a'}), MagicMock(to_dict=lambda: {'user_id': 'user_a'}),
+        MagicMock(to_dict=lambda: {'user_id': 'user_b'})]
+    mock_create_task = mocker.patch('gateway.main._create_cloud_task', return_value='created')
+
+    response = client.post('/api/tasks/reconcile_embeddings', json={})
+
+    assert response.status_code == 200
+    assert [c.args[0] for c in mock_create_task.call_args_list] == [{'user_id': 'user_a'}, {'user_id': 'user_b'}]
+    assert all(c.args[1] == '/api/tasks/reconcile_embeddings' for c in mock_create_task.call_args_list)
+
+def test_get_embeddings_sends_only_misses_and_preserves_order(mocker):
+    """_get_embeddings: キャッシュにないテキストだけを重複なしで API に送り、入力順にベクトルを返すかのテスト"""
+    mock_request = mocker.patch('gateway.main._request_embeddings', side_effect=lambda texts: [[float(len(t))] for t in texts])
+
+    gateway.main._get_embeddings(["不安"])
+    result = gateway.main._get_embeddings(["転職", " 不安 ", "転職", "人間関係"])
+
+    assert result == [[2.0], [2.0], [2.0], [4.0]]
+    assert mock_request.call_args_list[-1].args[0] == ["転職", "人間関係"]
+    assert gateway.main._embedding_cache_stats['memory_hit'] == 1
+    assert gateway.main._embedding_cache_stats['miss'] == 3
+
+def test_get_embeddings_serves_repeated_texts_from_memory(mocker):
+    """_get_embeddings: 一度ベクトル化したテキストは API を呼ばずに返し、返り値の変更がキャッシュに影響しないかのテスト"""
+    mock_request = mocker.patch('gateway.main._request_embeddings', return_value=[[0.1, 0.2]])
+
+    first = gateway.main._get_embeddings(["不安"])
+    first[0].append(9.9)
+    second = gateway.main._get_embeddings(["不安"])
+
+    assert second == [pytest.approx([0.1, 0.2])]
+    mock_request.assert_called_once()
+
+def test_get_embeddings_uses_firestore_tier(mocker):
+    """_get_embeddings: プロセス内キャッシュにない場合、Firestore 層のベクトルを使い、残りだけを API に送るかのテスト"""
+    mocker.patch('gateway.main.PERSISTENT_CACHE_ENABLED', True)
+    mock_db = mocker.patch('gateway.main.db_firestore')
+    cached_key = gateway.main._embedding_cache_key(gateway.main.EMBEDDING_MODEL_NAME, "不安")
+    mock_db.get_all.return_value = [MagicMock(id=cached_key, exists=True, to_dict=lambda: {
+        **gateway.main._encode_vectors([[0.5]], 'float32'), 'expires_at': datetime.now(timezone.utc) + timedelta(days=1)})]
+    mock_request = mocker.patch('gateway.main._request_embeddings', return_value=[[0.75]])
+    mock_thread = mocker.patch('gateway.main.threading.Thread')
+
+    result = gateway.main._get_embeddings(["不安", "転職"])
+
+    assert result == [[0.5], [0.75]]
+    mock_request.assert_called_once_with(["転職"])
+    assert gateway.main._embedding_cache_stats['firestore_hit'] == 1
+    persisted = mock_thread.call_args.kwargs['args'][1]
+    assert list(persisted) == [gateway.main._embedding_cache_key(gateway.main.EMBEDDING_MODEL_NAME, "転職")]
+
+def test_persist_embeddings_stores_encoded_bytes(mocker):
+    """_persist_embeddings: ベクトルを数値の配列ではなく _encode_vectors のバイト列で保存し、読み出しで復元できるかのテスト"""
+    mock_db = mocker.patch('gateway.main.db_firestore')
+    vector = [0.25, -1.5, 3.0]
+
+    gateway.main._persist_embeddings(gateway.main.EMBEDDING_MODEL_NAME, {'key': tuple(vector)})
+
+    written = mock_db.batch.return_value.set.call_args.args[1]
+    assert 'vector' not in written
+    assert isinstance(written['vectors'], bytes)
+    assert (written['vector_encoding'], written['vector_dim']) == ('float32', 3)
+    mock_db.get_all.return_value = [MagicMock(id='key', exists=True, to_dict=lambda: written)]
+    assert gateway.main._get_persisted_embeddings(['key']) == {'key': vector}
+
+def test_get_embeddings_without_cache_skips_both_tiers(mocker):
+    """_get_embeddings: cache=False (RAG のチャンク) ではプロセス内・Firestore のどちらの層も読み書きしないかのテスト"""
+    mocker.patch('gateway.main.PERSISTENT_CACHE_ENABLED', True)
+    mock_db = mocker.patch('gateway.main.db_firestore')
+    mock_request = mocker.patch('gateway.main._request_embeddings', return_value=[[0.5]])
+    mock_thread = mocker.patch('gateway.main.threading.Thread')
+
+    assert gateway.main._get_embeddings(["チャンク"], cache=False) == [[0.5]]
+    assert gateway.main._get_embeddings(["チャンク"], cache=False) == [[0.5]]
+
+    assert mock_request.call_count == 2
+    assert len(gateway.main._embedding_cache) == 0
+    mock_db.get_all.assert_not_called()
+    mock_thread.assert_not_called()
+
+def test_get_embeddings_keeps_float32_arrays_in_memory(mocker):
+    """_get_embeddings: プロセス内の層には float のタプルではなく float32 の配列を保持するかのテスト"""
+    mocker.patch('gateway.main._request_embeddings', return_value=[[0.25, 0.5]])
+
+    assert gateway.main._get_embeddings(["不安"]) == [[0.25, 0.5]]
+
+    cached = gateway.main._embedding_cache.get(gateway.main._embedding_cache_key(gateway.main.EMBEDDING_MODEL_NAME, "不安"))
+    assert isinstance(cached, np.ndarray) and cached.dtype == np.float32
+
+def test_plan_embedding_batches_respects_instance_and_token_limits(mocker):
+    """_plan_embedding_batches: 件数とトークン数のどちらかの上限に達したところでバッチを分けるかのテスト"""
+    mocker.patch('gateway.main.EMBEDDING_MAX_INSTANCES_PER_REQUEST', 3)
+    mocker.patch('gateway.main.EMBEDDING_MAX_TOKENS_PER_REQUEST', 10)
+
+    assert gateway.main._plan_embedding_batches(["a"] * 7) == [(0, 3), (3, 6), (6, 7)]
+    assert gateway.main._plan_embedding_batches(["aaaa", "aaaa", "aaaa", "a"]) == [(0, 2), (2, 4)]
+    # 上限を超える1件だけのテキストも単独のバッチにする
+    assert gateway.main._plan_embedding_batches(["a" * 20, "a"]) == [(0, 1), (1, 2)]
+
+def test_request_embeddings_dispatches_batches_concurrently_in_order(mocker):
+    """_request_embeddings: 複数のバッチを並行して送り、入力順に結果を並べるかのテスト"""
+    mocker.patch('gateway.main.EMBEDDING_MAX_INSTANCES_PER_REQUEST', 2)
+    started = threading.Barrier(3, timeout=5)
+    def embed(batch):
+        started.wait()  # 3つのバッチが同時に送られていなければタイムアウトする
+        return [[float(text)] for text in batch]
+    mocker.patch('gateway.main._embed_batch', side_effect=embed)
+
+    result = gateway.main._request_embeddings(["1", "2", "3", "4", "5"])
+
+    assert result == [[1.0], [2.0], [3.0], [4.0], [5.0]]
+
+def test_request_embeddings_retries_only_failed_batch(mock_text_embedding_model, mocker):
+    """_request_embeddings: 失敗したバッチだけが再送されるかのテスト"""
+    mocker.patch('tenacity.nap.sleep')
+    mocker.patch('traceback.print_exc')
+    mocker.patch('gateway.main.EMBEDDING_MAX_INSTANCES_PER_REQUEST', 2)
+    calls = Counter()
+    def get_embeddings(batch):
+        calls[tuple(batch)] += 1
+        if batch == ["c", "d"] and calls[tuple(batch)] == 1:
+            raise Exception("Transient error")
+        return [MagicMock(values=[ord(text)]) for text in batch]
+    mock_text_embedding_model.get_embeddings.side_effect = get_embeddings
+
+    result = gateway.main._request_embeddings(["a", "b", "c", "d"])
+
+    assert result == [[97], [98], [99], [100]]
+    assert calls == {("a", "b"): 1, ("c", "d"): 2}
+
+@pytest.mark.parametrize("encoding, tolerance", [('float32', 1e-7), ('float16', 1e-3), ('int8', 1e-2)])
+def test_encode_decode_vectors_round_trip(encoding, tolerance):
+    """_encode_vectors / _decode_vectors: 各形式でベクトルを誤差の範囲内で復元できるかのテスト"""
+    vectors = [[0.5, -0.25, 0.125, 0.0], [0.0, 0.0, 0.0, 0.0], [-1.0, 0.75, 0.3, 0.01]]
+
+    fields = gateway.main._encode_vectors(vectors, encoding)
+    matrix = gateway.main._decode_vectors(fields)
+
+    assert isinstance(fields['vectors'], bytes)
+    assert matrix.dtype.name == 'float32'
+    assert matrix.shape == (3, 4)
+    assert abs(matrix - vectors).max() <= tolerance
+
+def test_encoded_vectors_are_compact():
+    """_encode_vectors: 768次元 x 50チャンクが、旧形式の倍精度の配列より十分小さくなるかのテスト"""
+    vectors = [[0.01 * (i % 7)] * 768 for i in range(50)]
+
+    assert len(gateway.main._encode_vectors(vectors, 'float16')['vectors']) == 50 * 768 * 2
+    int8_fields = gateway.main._encode_vectors(vectors, 'int8')
+    assert len(int8_fields['vectors']) + len(int8_fields['vector_scales']) == 50 * 768 + 50 * 4
+
+def test_decode_vectors_rejects_malformed_data():
+    """_decode_vectors: 次元と長さが合わないデータや未知の形式は None を返すかのテスト"""
+    fields = gateway.main._encode_vectors([[0.1, 0.2, 0.3]], 'float32')
+
+    assert gateway.main._decode_vectors({**fields, 'vector_dim': 2}) is None
+    assert gateway.main._decode_vectors({**fields, 'vector_encoding': 'bfloat16'}) is None
+    assert gateway.main._decode_vectors({**gateway.main._encode_vectors([[0.1]], 'int8'), 'vector_scales': b''}) is None
+
+def test_get_cached_chunks_and_embeddings_reads_binary_format(mocker):
+    """_get_cached_chunks_and_embeddings: バイト列の形式のキャッシュは書き換えずにそのまま読み込むかのテスト"""
+    mock_doc_ref = MagicMock()
+    mock_doc_ref.get.return_value = MagicMock(exists=True, to_dict=lambda: {
+        'chunks': ['chunk1', 'chunk2'],
+        **gateway.main._encode_vectors([[0.1, 0.2], [0.3, 0.4]], 'float16'),
+        'cached_at': datetime.now(timezone.utc),
+    })
+    mocker.patch('gateway.main._get_url_cache_doc_ref', return_value=mock_doc_ref)
+    mock_thread = mocker.patch('gateway.main.threading.Thread')
+
+    chunks, embeddings = gateway.main._get_cached_chunks_and_embeddings("http://example.com")
+
+    assert chunks == ['chunk1', 'chunk2']
+    assert embeddings.shape == (2, 2)
+    mock_thread.assert_not_called()
+
+def test_migrate_legacy_rag_cache_keeps_cached_at(mocker):
+    """_migrate_legacy_rag_cache: 旧形式のフィールドを削除し、cached_at には触れずに書き換えるかのテスト"""
+    mock_doc_ref = MagicMock()
+
+    gateway.main._migrate_legacy_rag_cache(mock_doc_ref, "http://example.com", [[0.1, 0.2]])
+
+    update = mock_doc_ref.update.call_args.args[0]
+    assert update['embeddings'] is gateway.main.firestore.DELETE_FIELD
+    assert 'cached_at' not in update
+    assert gateway.main._decode_vectors(update).shape == (1, 2)
+
+def test_top_k_similar_chunks_matches_cosine_ranking():
+    """_top_k_similar_chunks: コサイン類似度の高い順に上位 k 個を返すかのテスト"""
+    chunks = ["a", "b", "c", "d"]
+    matrix = gateway.main._stack_embeddings([[[1.0, 0.0], [10.0, 1.0]], [[0.0, 1.0], [-1.0, 0.0]]])
+
+    assert gateway.main._top_k_similar_chunks([1.0, 0.1], matrix, chunks, k=3) == ["b", "a", "c"]
+    assert gateway.main._top_k_similar_chunks([1.0, 0.1], matrix, chunks, k=10) == ["b", "a", "c", "d"]
+
+def test_top_k_similar_chunks_handles_zero_vectors():
+    """_top_k_similar_chunks: ゼロベクトルのチャンクは類似度 0、ゼロベクトルのクエリでも例外にならないかのテスト"""
+    chunks = ["zero", "opposite", "same"]
+    matrix = gateway.main._stack_embeddings([[[0.0, 0.0], [-1.0, 0.0], [1.0, 0.0]]])
+
+    assert gateway.main._top_k_similar_chunks([1.0, 0.0], matrix, chunks, k=3) == ["same", "zero", "opposite"]
+    assert len(gateway.main._top_k_similar_chunks([0.0, 0.0], matrix, chunks, k=2)) == 2
+    assert gateway.main._top_k_similar_chunks([1.0, 0.0], gateway.main._stack_embeddings([]), [], k=3) == []
+
+def test_stack_embeddings_mixes_cached_matrices_and_fresh_lists():
+    """_stack_embeddings: キャッシュ由来の行列と新たに生成したリストを入力順に1つの float32 行列にまとめるかのテスト"""
+    cached = gateway.main._decode_vectors(gateway.main._encode_vectors([[0.5, 0.5]], 'float32'))
+
+    matrix = gateway.main._stack_embeddings([cached, [[1.0, 2.0], [3.0, 4.0]], []])
+
+    assert matrix.dtype.name == 'float32'
+    assert matrix.tolist() == [[0.5, 0.5], [1.0, 2.0], [3.0, 4.0]]
+
+def test_load_urls_in_parallel_runs_concurrently_and_keeps_input_order(mocker):
+    """_load_urls_in_parallel: URL を並行して読み込み、終わった順ではなく入力順に結果を返すかのテスト"""
+    started = threading.Barrier(3, timeout=5)
+    delays = {"http://a": 0.2, "http://b": 0.0, "http://c": 0.1}
+    mocker.patch('gateway.main._get_cached_chunks_for_urls', return_value={})
+    def load(url, check_cache=True):
+        started.wait()  # 3つの URL が同時に読み込まれていなければタイムアウトする
+        time.sleep(delays[url])
+        return [f"{url} chunk"], [[1.0]]
+    mocker.patch('gateway.main._load_url_chunks', side_effect=load)
+
+    loaded = gateway.main._load_urls_in_parallel(["http://a", "http://b", "http://c"])
+
+    assert [url for url, _, _ in loaded] == ["http://a", "http://b", "http://c"]
+    assert loaded[0][1] == ["http://a chunk"]
+
+def test_load_urls_in_parallel_skips_slow_and_failed_urls(mocker):
+    """_load_urls_in_parallel: 期限に間に合わない URL と失敗した URL を除いて返すかのテスト"""
+    mocker.patch('gateway.main.RAG_URL_DEADLINE_SECONDS', 0.2)
+    release = threading.Event()
+    mocker.patch('gateway.main._get_cached_chunks_for_urls', return_value={})
+    def load(url, check_cache=True):
+        if url == "http://slow":
+            release.wait(5)
+        if url == "http://broken":
+            raise RuntimeError("boom")
+        return [f"{url} chunk"], [[1.0]]
+    mocker.patch('gateway.main._load_url_chunks', side_effect=load)
+
+    started_at = time.monotonic()
+    loaded = gateway.main._load_urls_in_parallel(["http://slow", "http://broken", "http://ok"])
+    elapsed = time.monotonic() - started_at
+    release.set()
+
+    assert [url for url, _, _ in loaded] == ["http://ok"]
+    assert elapsed < 2
+
+def test_load_urls_in_parallel_respects_overall_deadline(mocker):
+    """_load_urls_in_parallel: URL ごとの期限より先に全体の期限が来たら、その時点で返すかのテスト"""
+    mocker.patch('gateway.main.RAG_URL_DEADLINE_SECONDS', 10)
+    mocker.patch('gateway.main.RAG_FETCH_DEADLINE_SECONDS', 0.2)
+    release = threading.Event()
+    mocker.patch('gateway.main._get_cached_chunks_for_urls', return_value={})
+    def load(url, check_cache=True):
+        if url != "http://fast":
+            release.wait(5)
+        return [f"{url} chunk"], [[1.0]]
+    mocker.patch('gateway.main._load_url_chunks', side_effect=load)
+
+    started_at = time.monotonic()
+    loaded = gateway.main._load_urls_in_parallel(["http://fast", "http://slow1", "http://slow2"])
+    elapsed = time.monotonic() - started_at
+    release.set()
+
+    assert [url for url, _, _ in loaded] == ["http://fast"]
+    assert elapsed < 2
+
+def test_load_urls_in_parallel_measures_url_deadline_from_worker_start(mocker):
+    """_load_urls_in_parallel: ワーカーの空きを待っていた URL の期限は、待ち始めた時刻ではなく読み込みを始めた時刻から測るかのテスト"""
+    mocker.patch('gateway.main.RAG_URL_CONCURRENCY', 1)
+    mocker.patch('gateway.main.RAG_URL_DEADLINE_SECONDS', 0.3)
+    mocker.patch('gateway.main.RAG_FETCH_DEADLINE_SECONDS', 3)
+    mocker.patch('gateway.main._get_cached_chunks_for_urls', return_value={})
+    delays = {"http://slow": 0.8, "http://queued": 0.1}
+    def load(url, check_cache=True):
+        time.sleep(delays[url])
+        return [f"{url} chunk"], [[1.0]]
+    mocker.patch('gateway.main._load_url_chunks', side_effect=load)
+
+    loaded = gateway.main._load_urls_in_parallel(["http://slow", "http://queued"])
+
+    # slow は期限切れで除かれ、その後ろで待っていた queued は始まってから 0.1 秒で終わるため間に合う
+    assert [url for url, _, _ in loaded] == ["http://queued"]
+
+def test_search_engines_concurrently_merges_with_provenance(mocker):
+    """_search_engines_concurrently: 両エンジンを同時に検索し、順位を交互にたどって重複をまとめ、取得元を記録するかのテスト"""
+    started = threading.Barrier(2, timeout=5)
+    results = {"engine1": ["http://a", "http://shared", "http://b"], "engine2": ["http://shared", "http://c"]}
+    def search(project_id, location, engine_id, query):
+        started.wait()  # 2つのエンジンが同時に検索されていなければタイムアウトする
+        return results[engine_id]
+    mocker.patch('gateway.main._search_with_vertex_ai_search', side_effect=search)
+
+    found = gateway.main._search_engines_concurrently("proj", [('similar_cases', "engine1"), ('suggestions', "engine2")], "query")
+
+    assert list(found) == ["http://a", "http://shared", "http://c", "http://b"]
+    assert found["http://shared"] == ['suggestions', 'similar_cases']
+    assert found["http://a"] == ['similar_cases']
+
+def test_search_engines_concurrently_skips_timed_out_engine(mocker):
+    """_search_engines_concurrently: 期限までに応答しなかったエンジンの結果を使わずに返すかのテスト"""
+    mocker.patch('gateway.main.RAG_SEARCH_TIMEOUT_SECONDS', 0.2)
+    release = threading.Event()
+    def search(project_id, location, engine_id, query):
+        if engine_id == "slow":
+            release.wait(5)
+        return [f"http://{engine_id}"]
+    mocker.patch('gateway.main._search_with_vertex_ai_search', side_effect=search)
+
+    started_at = time.monotonic()
+    found = gateway.main._search_engines_concurrently("proj", [('similar_cases', "slow"), ('suggestions', "fast")], "query")
+    elapsed = time.monotonic() - started_at
+    release.set()
+
+    assert found == {"http://fast": ['suggestions']}
+    assert elapsed < 2
+
+def test_generate_rag_based_advice_embeds_query_while_extracting_keywords(mocker, mock_generative_model):
+    """_generate_rag_based_advice: クエリのベクトル化とキーワード抽出が並行して行われるかのテスト"""
+    started = threading.Barrier(2, timeout=5)
+    def extract(query):
+        started.wait()
+        return "キーワード"
+    def embed(texts):
+        if texts == ["query"]:
+            started.wait()  # キーワード抽出と同時に呼ばれていなければタイムアウトする
+        return [[0.3, 0.4]] * len(texts)
+    mocker.patch('gateway.main._extract_keywords_for_search', side_effect=extract)
+    mocker.patch('gateway.main._get_embeddings', side_effect=embed)
+    mocker.patch('gateway.main._search_with_vertex_ai_search', return_value=["http://example.com"])
+    mocker.patch('gateway.main._get_cached_chunks_for_urls', return_value={"http://example.com": (["チャンク"], [[0.3, 0.4]])})
+    mock_generative_model.generate_content.return_value.text = "アドバイス"
+
+    advice, sources = gateway.main._generate_rag_based_advice("query", "proj", "sim_id", "sug_id")
+
+    assert advice == "アドバイス"
+    assert sources == ["http://example.com"]
+
+def test_get_cached_chunks_for_urls_uses_single_get_all(mocker):
+    """_get_cached_chunks_for_urls: 全 URL を1回の get_all で読み込み、期限切れ・形の不正・未登録をミスとして扱うかのテスト"""
+    mock_db = mocker.patch('gateway.main.db_firestore')
+    mock_db.collection.return_value.document.side_effect = lambda doc_id: MagicMock(id=doc_id)
+    doc_id = lambda url: gateway.main.hashlib.sha256(url.encode('utf-8')).hexdigest()
+    now = datetime.now(timezone.utc)
+    valid = {'chunks': ['c1', 'c2'], **gateway.main._encode_vectors([[0.1, 0.2], [0.3, 0.4]]), 'cached_at': now}
+    documents = {
+        "http://hit": MagicMock(exists=True, to_dict=lambda: valid),
+        "http://stale": MagicMock(exists=True, to_dict=lambda: {**valid, 'cached_at': now - timedelta(days=RAG_CACHE_TTL_DAYS + 1)}),
+        "http://mismatch": MagicMock(exists=True, to_dict=lambda: {**valid, 'chunks': ['c1']}),
+        "http://missing": MagicMock(exists=False),
+    }
+    for url, doc in documents.items():
+        doc.id = doc_id(url)
+    mock_db.get_all.return_value = list(documents.values())
+
+    hits = gateway.main._get_cached_chunks_for_urls(list(documents))
+
+    mock_db.get_all.assert_called_once()
+    assert len(mock_db.get_all.call_args.args[0]) == 4
+    assert list(hits) == ["http://hit"]
+    assert hits["http://hit"][0] == ['c1', 'c2']
+    assert hits["http://hit"][1].shape == (2, 2)
+
+def test_get_cached_chunks_for_urls_treats_errors_as_misses(mocker):
+    """_get_cached_chunks_for_urls: Firestore の読み込みに失敗した場合は全てミスとして扱うかのテスト"""
+    mock_db = mocker.patch('gateway.main.db_firestore')
+    mock_db.get_all.side_effect = Exception("Firestore unavailable")
+
+    assert gateway.main._get_cached_chunks_for_urls(["http://a", "http://b"]) == {}
+
+def test_load_urls_in_parallel_only_fetches_cache_misses(mocker):
+    """_load_urls_in_parallel: キャッシュにある URL は読み込まず、ミスの URL だけをキャッシュ確認なしで読み込むかのテスト"""
+    mocker.patch('gateway.main._get_cached_chunks_for_urls', return_value={"http://hit": (["cached"], [[1.0]])})
+    mock_load = mocker.patch('gateway.main._load_url_chunks', return_value=(["fresh"], [[2.0]]))
+
+    loaded = gateway.main._load_urls_in_parallel(["http://miss", "http://hit"])
+
+    assert [(url, chunks) for url, chunks, _ in loaded] == [("http://miss", ["fresh"]), ("http://hit", ["cached"])]
+    mock_load.assert_called_once_with("http://miss", check_cache=False)
+
+def test_next_digest_version_never_goes_backwards(mocker):
+    """_next_digest_version: 作り直したダイジェストの version が、以前に発行した version を下回らないかのテスト"""
+    mocker.patch('gateway.main.time.time', return_value=1700000000.0)
+
+    rebuilt = gateway.main._next_digest_version(0)
+
+    assert rebuilt == 1700000000000
+    # 同じミリ秒内に続けて更新されても増え続ける
+    assert gateway.main._next_digest_version(rebuilt) == rebuilt + 1
+    assert gateway.main._next_digest_version(rebuilt + 5) == rebuilt + 6
+
+def test_post_summary_without_swipes_updates_insights_digest(client, mocker):
+    """post_summary: 記録のないセッションを完了にする場合もダイジェストが更新されるかのテスト"""
+    mocker.patch('gateway.main._verify_token', return_value={'uid': MOCK_USER_ID})
+    mock_update_digest = mocker.patch('gateway.main._update_insights_digest')
+    mock_db = mocker.patch('gateway.main.db_firestore')
+    mock_session_ref = MagicMock()
+    session_data = {'topic': '仕事', 'turn': 1}
+    mock_session_ref.get.return_value = MagicMock(exists=True, to_dict=lambda: session_data)
+    mock_session_ref.collection.return_value.order_by.return_value.stream.return_value = []
+    mock_db.collection.return_value.document.return_value.collection.return_value.document.return_value = mock_session_ref
+
+    response = client.post(f'/api/session/{MOCK_SESSION_ID}/summary', headers={'Authorization': 'Bearer test-token'})
+
+    assert response.status_code == 200
+    assert response.get_json()['title'] == "対話の記録がありません"
+    mock_session_ref.update.assert_called_once_with({'status': 'completed', 'title': '対話の記録がありません'})
+    mock_update_digest.assert_called_once_with(MOCK_USER_ID, MOCK_SESSION_ID, session_data, {'title': '対話の記録がありません'})